@@ -0,0 +1,249 @@
+""" This suggests values for the country and city or town fields of the stop
+form as they are typed, so that a place already used on other stops is entered
+the same way again rather than as a near-duplicate. Suggestions come from a
+prefix index held in memory by each app process - the distinct values of each
+field, with the number of stops using them, kept as a sorted list of folded
+keys which is searched with bisect - so nothing is read from the database for
+a keystroke. The index is built from the stops before the process serves
+requests (see wsgi.py), or by the first request to use it, and is rebuilt on
+a background thread once it is older than AUTOCOMPLETE_MAX_AGE (which picks
+up the stops written by other processes) while the old index is still used.
+The stops written by this process are added to and taken away from it as
+they are written. """
+from bisect import bisect_left, insort
+from heapq import nlargest
+from threading import Lock, RLock, Thread
+from time import monotonic
+from flask import current_app
+from extension import AppExtension
+from search import fold
+from storage import STORES
+
+# the stop form fields which are suggested
+FIELDS = ('country', 'city_town')
+
+# the most suggestions returned for a prefix
+MAX_SUGGESTIONS = 10
+
+# the suggestions for prefixes up to this long, which match the most values,
+# are kept once they have been found
+TOP_PREFIX_LENGTH = 3
+
+# sorts after any folded text, to find the last key starting with a prefix
+LAST_CHAR = '\U0010ffff'
+
+
+def value_counts_pipeline(field):
+    """ Creates an aggregate MongoDB query, run on the stops collection,
+    which returns each value of a stop field with the number of stops using
+    it. field is one of FIELDS, never user input. """
+    return [
+        {
+            u"$match": {
+                field: {u"$type": u"string", u"$ne": u""}
+            }
+        },
+        {
+            u"$group": {
+                u"_id": u"$" + field,
+                u"count": {
+                    u"$sum": 1
+                }
+            }
+        }
+    ]
+
+
+class PrefixIndex:
+    """
+    The values of each field in FIELDS, as a dict of value to the number of
+    stops using it and a sorted list of (folded value, value) keys. Prefixes
+    are looked up by bisecting the keys and then ranking the values which
+    start with the prefix, so a lookup takes time in proportion to the number
+    of those values - the suggestions for the shortest prefixes, which match
+    the most values, are kept until one of their values changes. Every read
+    and write holds the lock, so the index can be used by several threads at
+    once, and only one build runs at a time.
+    """
+
+    def __init__(self, max_age=None):
+        self._lock = RLock()
+        # held while the index is built, so it is only built once at a time
+        self._build_lock = Lock()
+        self.max_age = max_age
+        self._counts = {}
+        self._keys = {}
+        # (field, prefix) -> the top MAX_SUGGESTIONS values starting with a
+        # prefix up to TOP_PREFIX_LENGTH long
+        self._top = {}
+        # the changes made while the index is being built, which are made
+        # again on the new index - None while it is not being built
+        self._pending = None
+        self._rebuilding = False
+        self.built_at = None
+        self.clear()
+
+    @classmethod
+    def from_config(cls, app):
+        """ Creates an index which is used for AUTOCOMPLETE_MAX_AGE seconds
+        before it is rebuilt. """
+        return cls(app.config['AUTOCOMPLETE_MAX_AGE'] or None)
+
+    def clear(self):
+        """ Empties the index, so it is built again when it is next used. """
+        with self._lock:
+            self._counts = {field: {} for field in FIELDS}
+            self._keys = {field: [] for field in FIELDS}
+            self._top = {}
+            self.built_at = None
+
+    def build(self):
+        """ Builds the index from the values of the stops in the database,
+        waiting for any build already running to finish first. The stops
+        this process writes while the values are read are added to the new
+        index - a stop may then be counted twice until the next build, which
+        only changes the order of the suggestions. """
+        with self._build_lock:
+            self._build()
+
+    def _build(self):
+        """ Builds the index - the build lock must already be held. """
+        with self._lock:
+            self._pending = []
+
+        try:
+            counts = {field: STORES.stops.value_counts(field)
+                      for field in FIELDS}
+            keys = {field: sorted((fold(value), value) for value in values)
+                    for field, values in counts.items()}
+        except Exception:
+            with self._lock:
+                self._pending = None
+            raise
+
+        with self._lock:
+            pending, self._pending = self._pending, None
+            self._counts, self._keys, self._top = counts, keys, {}
+            self.built_at = monotonic()
+
+            for stops, sign in pending:
+                self._apply(stops, sign)
+
+    def _rebuild(self, app):
+        """ Rebuilds the index on a background thread, logging rather than
+        raising any error - the old index is used until the next try. """
+        try:
+            with app.app_context():
+                self.build()
+        except Exception:  # pylint: disable=broad-except
+            app.logger.exception('Rebuilding the stop suggestions failed.')
+        finally:
+            with self._lock:
+                self._rebuilding = False
+
+    def _ensure_built(self):
+        """ Builds the index if it has not been built - other requests wait
+        for the same build rather than starting their own. If the index is
+        too old, a rebuild is started in the background and the old index is
+        used until it has finished. """
+        if self.built_at is None:
+            with self._build_lock:
+                if self.built_at is None:
+                    self._build()
+            return
+
+        if not self.max_age or monotonic() - self.built_at <= self.max_age:
+            return
+
+        with self._lock:
+            if self._rebuilding:
+                return
+            self._rebuilding = True
+
+        # pylint: disable=protected-access
+        Thread(target=self._rebuild, args=(current_app._get_current_object(),),
+               daemon=True).start()
+
+    def _apply(self, stops, sign):
+        """ Adds the values of stops to the index (or, with a sign of -1,
+        takes them away) - a value is removed once no stops use it. The lock
+        must already be held. """
+        for stop in stops:
+            for field in FIELDS:
+                value = stop.get(field)
+                if not value:
+                    continue
+
+                counts, keys = self._counts[field], self._keys[field]
+                count = counts.get(value, 0) + sign
+                folded = fold(value)
+
+                if count > 0:
+                    if value not in counts:
+                        insort(keys, (folded, value))
+                    counts[value] = count
+                elif value in counts:
+                    del counts[value]
+                    del keys[bisect_left(keys, (folded, value))]
+
+                # the value may move in or out of the top suggestions of its
+                # shortest prefixes
+                for length in range(1, TOP_PREFIX_LENGTH + 1):
+                    self._top.pop((field, folded[:length]), None)
+
+    def _change(self, stops, sign):
+        """ Applies a change to the index, and to the index being built if
+        there is one. """
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append((stops, sign))
+
+            # the stops will be read when the index is built
+            if self.built_at is not None:
+                self._apply(stops, sign)
+
+    def add(self, *stops):
+        """ Adds the values of stops which have been written. """
+        self._change(stops, 1)
+
+    def remove(self, *stops):
+        """ Takes away the values of stops which have been removed (or the
+        previous values of stops which have been updated). """
+        self._change(stops, -1)
+
+    def _matches(self, field, prefix, limit):
+        """ Returns up to limit values of field starting with the folded
+        prefix, most used first - the lock must already be held. """
+        keys, counts = self._keys[field], self._counts[field]
+        low = bisect_left(keys, (prefix,))
+        high = bisect_left(keys, (prefix + LAST_CHAR,), low)
+
+        return [value for _, value in
+                nlargest(limit, keys[low:high],
+                         key=lambda key: counts[key[1]])]
+
+    def suggest(self, field, prefix, limit=MAX_SUGGESTIONS):
+        """ Returns up to limit values of field starting with prefix,
+        ignoring case and accents - those used by the most stops first, and
+        then in alphabetical order. """
+        prefix = fold(prefix.strip())
+        if not prefix:
+            return []
+
+        self._ensure_built()
+
+        with self._lock:
+            if len(prefix) > TOP_PREFIX_LENGTH or limit > MAX_SUGGESTIONS:
+                return self._matches(field, prefix, limit)
+
+            top = self._top.get((field, prefix))
+            if top is None:
+                top = self._top[(field, prefix)] = \
+                    self._matches(field, prefix, MAX_SUGGESTIONS)
+
+            return top[:limit]
+
+
+# the suggestions for the stop form of the app being used - each app is given
+# its own index by create_app()
+SUGGESTIONS = AppExtension('suggestions', PrefixIndex.from_config)
@@ -0,0 +1,85 @@
+""" Load test for the read path - the trips listing, trip detail page and the
+JSON read API. Each URL is requested by a number of concurrent clients for a
+fixed time and the requests per second and latency percentiles are reported.
+
+Run it against two running copies of the app to compare them, e.g. one with
+QUERY_WORKERS=0 (queries run one after another) and one with the default:
+
+    python benchmarks/read_path.py --base-url http://localhost:5000 \
+        --trip-id 5dee3e228f1db52b29cfce59 --clients 200 --duration 30
+"""
+import argparse
+import threading
+import time
+from urllib.error import URLError
+from urllib.request import urlopen
+
+
+def percentile(values, percent):
+    """ Returns the value below which percent of the sorted values fall. """
+    if not values:
+        return 0.0
+
+    index = min(len(values) - 1, int(round(percent / 100 * (len(values) - 1))))
+    return values[index]
+
+
+def run(url, clients, duration):
+    """ Requests url from clients threads until duration (seconds) has
+    passed. Returns the latency of each request and the number of errors. """
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    stop_at = time.monotonic() + duration
+
+    def client():
+        """ Requests the url repeatedly, recording how long each takes. """
+        while time.monotonic() < stop_at:
+            started = time.monotonic()
+            try:
+                with urlopen(url, timeout=30) as response:
+                    response.read()
+            except (URLError, OSError):
+                with lock:
+                    errors[0] += 1
+                continue
+
+            with lock:
+                latencies.append(time.monotonic() - started)
+
+    threads = [threading.Thread(target=client) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return sorted(latencies), errors[0]
+
+
+def main():
+    """ Runs the benchmark for each read path URL and prints the results. """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--base-url', default='http://localhost:5000')
+    parser.add_argument('--trip-id', required=True,
+                        help='A public trip to request the detail for.')
+    parser.add_argument('--clients', type=int, default=200)
+    parser.add_argument('--duration', type=float, default=30,
+                        help='Seconds to run each URL for.')
+    args = parser.parse_args()
+
+    paths = ['/trips/', '/trip/%s/detailed/' % args.trip_id, '/api/trips/',
+             '/api/trip/%s/' % args.trip_id]
+
+    print('%-45s %10s %10s %10s %8s' % ('url', 'req/s', 'p50 (ms)',
+                                        'p99 (ms)', 'errors'))
+    for path in paths:
+        latencies, errors = run(args.base_url + path, args.clients,
+                                args.duration)
+        print('%-45s %10.1f %10.1f %10.1f %8d' % (
+            path, len(latencies) / args.duration,
+            percentile(latencies, 50) * 1000,
+            percentile(latencies, 99) * 1000, errors))
+
+
+if __name__ == '__main__':
+    main()
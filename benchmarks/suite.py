@@ -0,0 +1,378 @@
+""" Benchmark suite for the app's routes and the util.py helpers. The app is
+run in-process (requests are made with the Flask test client, so no web
+server is needed) against a local mongod, which is filled with a seeded
+synthetic dataset. The latency percentiles and throughput of each benchmark
+are written to a JSON file, which can be compared with an earlier run to flag
+regressions:
+
+    python benchmarks/suite.py --seed-data --dataset small \
+        --output before.json
+    python benchmarks/suite.py --dataset small --output after.json \
+        --compare before.json --threshold 10
+
+--seed-data drops the users, trips, stops and meta collections of the
+database in --mongo-uri, so it must be a database used only for benchmarks.
+
+With --storage memory the app keeps its data in memory instead (and the
+dataset is always seeded), so the results show the time spent in the app
+itself - comparing them with a MongoDB run shows how much is database time.
+--latency-ms makes every call to the in-memory stores wait as long as a
+database round trip first, and --query-workers sets QUERY_WORKERS, so the
+gain from running a request's independent queries at the same time (see
+parallel.py) can be measured without MongoDB:
+
+    python benchmarks/suite.py --storage memory --latency-ms 2 \
+        --query-workers 0 --filter stop_ --output sync.json
+    python benchmarks/suite.py --storage memory --latency-ms 2 \
+        --query-workers 8 --filter stop_ --output threaded.json
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime
+from flask import session
+from read_path import percentile
+
+# datasets which can be seeded - the large trip has the most stops and is
+# used for the trip page and helper benchmarks
+DATASETS = {
+    'small': {'users': 1000, 'trips': 1000, 'max_stops': 200,
+              'large_trip_stops': 200},
+    'medium': {'users': 10000, 'trips': 10000, 'max_stops': 2000,
+               'large_trip_stops': 1000},
+    'large': {'users': 10000, 'trips': 100000, 'max_stops': 2000,
+              'large_trip_stops': 2000}
+}
+
+
+def measure(make_worker, iterations, concurrency, warmup):
+    """
+    Runs a benchmark. make_worker is called once per thread and returns the
+    function to time - each thread runs it iterations / concurrency times,
+    after warmup untimed runs. Returns the latency figures (in milliseconds)
+    and the throughput (operations per second).
+    """
+    latencies = []
+    lock = threading.Lock()
+    per_thread = max(1, iterations // concurrency)
+
+    def run(worker):
+        """ Runs the worker, recording how long each run takes. """
+        timings = []
+        for _ in range(warmup):
+            worker()
+        for _ in range(per_thread):
+            started = time.perf_counter()
+            worker()
+            timings.append((time.perf_counter() - started) * 1000)
+        with lock:
+            latencies.extend(timings)
+
+    threads = [threading.Thread(target=run, args=(make_worker(),))
+               for _ in range(concurrency)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'count': len(latencies),
+        'mean_ms': round(sum(latencies) / len(latencies), 3),
+        'p50_ms': round(percentile(latencies, 50), 3),
+        'p95_ms': round(percentile(latencies, 95), 3),
+        'p99_ms': round(percentile(latencies, 99), 3),
+        'max_ms': round(latencies[-1], 3),
+        'ops_per_s': round(len(latencies) / elapsed, 1)
+    }
+
+
+class SlowStore:
+    """ Stands in for a store, waiting for latency seconds before each call
+    as a query sent to a database would. """
+
+    def __init__(self, store, latency):
+        self._store = store
+        self._latency = latency
+
+    def __getattr__(self, name):
+        attr = getattr(self._store, name)
+        if name.startswith('_') or not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            """ Waits for the round trip and then makes the call. """
+            time.sleep(self._latency)
+            return attr(*args, **kwargs)
+
+        return call
+
+
+def add_latency(stores, latency):
+    """ Makes every call to the stores of an app wait for latency seconds
+    first. """
+    for name in ('users', 'trips', 'stops', 'meta'):
+        setattr(stores, name, SlowStore(getattr(stores, name), latency))
+
+
+def compare(baseline, results, threshold):
+    """ Returns the benchmarks whose p50 latency rose, or throughput fell,
+    by more than threshold percent compared to the baseline run. """
+    regressions = []
+    limit = threshold / 100
+
+    for name, result in sorted(results.items()):
+        before = baseline.get(name)
+        if not before:
+            continue
+
+        if result['p50_ms'] > before['p50_ms'] * (1 + limit):
+            regressions.append((name, 'p50_ms', before['p50_ms'],
+                                result['p50_ms']))
+        if result['ops_per_s'] < before['ops_per_s'] * (1 - limit):
+            regressions.append((name, 'ops_per_s', before['ops_per_s'],
+                                result['ops_per_s']))
+
+    return regressions
+
+
+def git_commit():
+    """ Returns the commit the benchmarks were run at, if known. """
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def route_benchmarks(trip_id, large_trip_id, stop_id):
+    """ Returns the route benchmarks as (name, url) - each url is requested
+    by a user who is logged in as the owner of the large trip. The stop forms
+    read the trip duration once their permission check has passed. """
+    return [
+        ('route:stop_new_form', '/trip/%s/stop/new/' % large_trip_id),
+        ('route:stop_update_form',
+         '/trip/%s/stop/%s/update/' % (large_trip_id, stop_id)),
+        ('route:show_trips', '/trips/'),
+        ('route:show_trips_user', '/trips/user/'),
+        ('route:trip_detailed', '/trip/%s/detailed/' % trip_id),
+        ('route:trip_detailed_large', '/trip/%s/detailed/' % large_trip_id),
+        ('route:api_trips', '/api/trips/'),
+        ('route:api_trip', '/api/trip/%s/' % trip_id),
+        ('route:api_trip_large', '/api/trip/%s/' % large_trip_id)
+    ]
+
+
+def route_worker(app, user_id, url):
+    """ Returns a function which requests url with a logged in client. """
+    def make_worker():
+        client = app.test_client()
+        with client.session_transaction() as client_session:
+            client_session['USERNAME'] = str(user_id)
+
+        def request():
+            response = client.get(url)
+            assert response.status_code == 200, \
+                '%s returned %d' % (url, response.status_code)
+            # streamed responses are only generated as they are read
+            response.get_data()
+
+        return request
+
+    return make_worker
+
+
+def shared_worker(func):
+    """ Returns a make_worker for measure() where every thread runs the
+    same function. """
+    return lambda: func
+
+
+def helper_benchmarks(app, util, user_id, trip, stop):
+    """ Returns the util.py helper benchmarks as (name, function). Helpers
+    which use the session or the request's identity map are run in a new
+    request context each time. """
+    trip_id = str(trip['_id'])
+    stop_id = str(stop['_id'])
+
+    def in_request(func):
+        """ Runs func in a new request context, logged in as user_id. """
+        def run():
+            with app.test_request_context():
+                session['USERNAME'] = str(user_id)
+                func()
+        return run
+
+    return [
+        ('helper:check_user_permission', in_request(
+            lambda: util.check_user_permission(check_trip_owner=True,
+                                               trip_id=trip_id))),
+        ('helper:check_user_permission_stop', in_request(
+            lambda: util.check_user_permission(check_stop_owner=True,
+                                               trip_id=trip_id,
+                                               stop_id=stop_id))),
+        ('helper:get_trip', in_request(lambda: util.get_trip(trip_id))),
+        ('helper:get_stop', in_request(lambda: util.get_stop(stop_id))),
+        ('helper:get_trip_duration',
+         lambda: util.get_trip_duration(trip_id)),
+        ('helper:get_stop_costs',
+         lambda: util.get_stop_costs(stop, trip['travelers'])),
+        ('helper:check_id', lambda: util.check_id(trip_id)),
+        ('helper:encode_decode_cursor',
+         lambda: util.decode_cursor(util.encode_cursor(trip))),
+        ('helper:last_change', util.last_change),
+        ('helper:record_change', util.record_change)
+    ]
+
+
+def main():
+    """ Seeds the data if asked to, runs every benchmark and writes the
+    results. Exits with status 1 if any regressions were found. """
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--storage', choices=('mongo', 'memory'),
+                        default='mongo',
+                        help='Where the app keeps its data.')
+    parser.add_argument('--mongo-uri',
+                        default='mongodb://localhost:27017/travelpal_benchmark')
+    parser.add_argument('--dataset', choices=sorted(DATASETS),
+                        default='small')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed for the generated data.')
+    parser.add_argument('--seed-data', action='store_true',
+                        help='Drop the collections and seed the dataset.')
+    parser.add_argument('--iterations', type=int, default=200,
+                        help='Timed runs of each benchmark.')
+    parser.add_argument('--concurrency', type=int, default=1,
+                        help='Threads running each benchmark at once.')
+    parser.add_argument('--warmup', type=int, default=5,
+                        help='Untimed runs by each thread before timing.')
+    parser.add_argument('--latency-ms', type=float, default=0,
+                        help='Time each call to the in-memory stores waits '
+                             'for, as for a database round trip.')
+    parser.add_argument('--query-workers', type=int,
+                        help='Threads used to run independent queries at the '
+                             'same time (QUERY_WORKERS), 0 runs them one '
+                             'after another.')
+    parser.add_argument('--warm-cache', action='store_true',
+                        help='Keep the query cache on, so repeated requests '
+                             'are served from it.')
+    parser.add_argument('--filter', default='',
+                        help='Only run benchmarks whose name contains this.')
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--compare', help='Earlier results file to compare '
+                                          'against.')
+    parser.add_argument('--threshold', type=float, default=10,
+                        help='Percent change flagged as a regression.')
+    args = parser.parse_args()
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))))
+
+    # pylint: disable=import-outside-toplevel
+    import util
+    from app import create_app
+    from seed import seed_database
+    from storage import STORES
+
+    config = {'STORAGE': args.storage, 'MONGO_URI': args.mongo_uri,
+              'SECRET_KEY': os.getenv('SECRET_KEY', 'benchmark')}
+    if args.query_workers is not None:
+        config['QUERY_WORKERS'] = args.query_workers
+    # without the cache every request runs its queries
+    if not args.warm_cache:
+        config['CACHE_MAX_SIZE'] = 0
+    app = create_app(config)
+    mongo = args.storage == 'mongo'
+
+    # the in-memory stores start empty every run
+    if args.seed_data or not mongo:
+        if mongo:
+            for collection in ('users', 'trips', 'stops', 'meta'):
+                util.MONGO.db[collection].drop()
+
+        started = time.perf_counter()
+        counts = seed_database(seed=args.seed, **DATASETS[args.dataset])
+        if mongo:
+            util.ensure_indexes()
+        print('Seeded %(users)d users, %(trips)d trips and %(stops)d stops'
+              % counts + ' in %.1fs' % (time.perf_counter() - started))
+
+    # the latency is added once the data is seeded, so only the benchmarks
+    # wait for it
+    if args.latency_ms and not mongo:
+        add_latency(app.extensions['storage'], args.latency_ms / 1000)
+
+    if mongo:
+        large_trip = util.TRIPS.find_one(
+            util.NOT_DELETED, sort=[('summary.number_of_stops', -1)])
+    else:
+        large_trip = STORES.trips.find(counts['large_trip_id'])
+    # the first trip of the public listing, other than the large trip
+    trip = next(row for row in STORES.trips.listing('', 'all', False, False,
+                                                    limit=2)
+                if row['_id'] != large_trip['_id'])
+    stop = next(iter(STORES.stops.for_trip(large_trip['_id'])))
+    user_id = large_trip['owner_id']
+
+    benchmarks = [(name, route_worker(app, user_id, url)) for name, url in
+                  route_benchmarks(trip['_id'], large_trip['_id'],
+                                   stop['_id'])]
+    benchmarks += [(name, shared_worker(func)) for name, func in
+                   helper_benchmarks(app, util, user_id, large_trip, stop)]
+
+    results = {}
+    print('%-36s %10s %10s %10s %10s' % ('benchmark', 'ops/s', 'p50 (ms)',
+                                         'p95 (ms)', 'p99 (ms)'))
+    for name, make_worker in benchmarks:
+        if args.filter not in name:
+            continue
+
+        result = results[name] = measure(make_worker, args.iterations,
+                                         args.concurrency, args.warmup)
+        print('%-36s %10.1f %10.2f %10.2f %10.2f' % (
+            name, result['ops_per_s'], result['p50_ms'], result['p95_ms'],
+            result['p99_ms']))
+
+    with open(args.output, 'w') as output:
+        json.dump({
+            'run': {
+                'date': datetime.utcnow().isoformat(),
+                'commit': git_commit(),
+                'python': platform.python_version(),
+                'storage': args.storage,
+                'dataset': dict(DATASETS[args.dataset], name=args.dataset,
+                                seed=args.seed),
+                'latency_ms': args.latency_ms,
+                'query_workers': app.config['QUERY_WORKERS'],
+                'iterations': args.iterations,
+                'concurrency': args.concurrency,
+                'warm_cache': args.warm_cache
+            },
+            'results': results
+        }, output, indent=2)
+    print('Results written to %s' % args.output)
+
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)['results']
+
+        regressions = compare(baseline, results, args.threshold)
+        for name, metric, before, after in regressions:
+            print('REGRESSION %s %s: %s -> %s' % (name, metric, before,
+                                                  after))
+
+        if regressions:
+            sys.exit(1)
+        print('No regressions over %s%%.' % args.threshold)
+
+
+if __name__ == '__main__':
+    main()
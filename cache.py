@@ -0,0 +1,155 @@
+""" This provides an in-process cache for the results of the trips listing and
+trip detail queries. Each entry is keyed by the version of the data it was
+built from - the change stamp for listings and the trip's updated_at for trip
+details - so a write made through another process (which cannot remove this
+process's entries) still stops them being used. Entries are also removed by
+the trip and stop write routes when the data they were built from changes, so
+they do not take up space once they cannot be used. """
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+from bson.objectid import ObjectId
+from extension import AppExtension
+
+
+class ResultCache:
+    """
+    A least recently used cache with a maximum number of entries and an
+    optional time to live (in seconds).
+
+    Listing entries are keyed by ('trips', viewer, show, after, before,
+    dates, version), trip detail entries by ('trip', trip_id, updated_at) and
+    calendars by ('calendar', user_id, owner version). The trip_id's each entry contains are
+    recorded so that a change to one trip only removes the entries it appears
+    in.
+    """
+
+    def __init__(self, max_size=1000, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        # trip_id -> set of listing keys which contain the trip
+        self._trip_keys = {}
+        self._lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        """ Returns the cached value for key, or None if there is not one. """
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            value, expires, _ = entry
+            if expires is not None and expires <= monotonic():
+                self._remove(key)
+                self.expirations += 1
+                self.misses += 1
+                return None
+
+            # mark as most recently used
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, trip_ids=()):
+        """ Adds a value to the cache. trip_ids are the trips the value was
+        built from, so it can be removed when any of them change. """
+        expires = monotonic() + self.ttl if self.ttl else None
+        trip_ids = frozenset(trip_ids)
+
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (value, expires, trip_ids)
+
+            for trip_id in trip_ids:
+                self._trip_keys.setdefault(trip_id, set()).add(key)
+
+            # remove least recently used entries once the cache is full
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        """ Removes an entry - the lock must already be held. """
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return False
+
+        for trip_id in entry[2]:
+            keys = self._trip_keys.get(trip_id)
+            if keys:
+                keys.discard(key)
+                if not keys:
+                    del self._trip_keys[trip_id]
+
+        return True
+
+    def _invalidate(self, keys):
+        """ Removes the entries for keys - the lock must already be held. """
+        for key in list(keys):
+            if self._remove(key):
+                self.invalidations += 1
+
+    def invalidate_trip(self, trip_id):
+        """ Removes the detail entries for a trip and every listing page it
+        appears on. Used when the trip's details or stops change. The listing
+        pages filtered by date are removed too, as a change to the trip's
+        dates can move it onto them. """
+        trip_id = ObjectId(trip_id)
+
+        with self._lock:
+            self._invalidate(list(self._trip_keys.get(trip_id, ())) +
+                             [key for key in self._entries
+                              if key[0] == 'trips' and len(key) > 5
+                              and key[5]])
+
+    def invalidate_listings(self, owner_id, public):
+        """ Removes the listing pages which could include a trip owned by
+        owner_id, and owner_id's calendars - used when trips are added or
+        removed, or when a change could move a trip between pages. Public
+        trips appear on every viewer's 'all' listing. """
+        owner_id = str(owner_id)
+
+        with self._lock:
+            self._invalidate([key for key in self._entries
+                              if (key[0] == 'trips' and
+                                  (key[1] == owner_id or
+                                   (public and key[2] != 'user'))) or
+                              (key[0] == 'calendar' and key[1] == owner_id)])
+
+    @classmethod
+    def from_config(cls, app):
+        """ Creates a cache sized from the app config. """
+        return cls(app.config['CACHE_MAX_SIZE'], app.config['CACHE_TTL'])
+
+    def clear(self):
+        """ Removes every entry from the cache. """
+        with self._lock:
+            self._entries.clear()
+            self._trip_keys.clear()
+
+    def stats(self):
+        """ Returns the cache counters, used to size the cache. """
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations
+            }
+
+
+# cache used by the listing and trip detail routes of the app being used -
+# each app is given its own by create_app()
+RESULTS = AppExtension('result_cache', ResultCache.from_config)
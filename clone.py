@@ -0,0 +1,72 @@
+""" This copies a whole trip, along with all of its stops, into another user's
+account so it can be used as the starting point for their own trip. """
+from bson.objectid import ObjectId
+from util import utc_now
+from storage import STORES
+from stop_dates import trip_fields
+from autocomplete import SUGGESTIONS
+
+# number of stops read and written at a time
+CLONE_BATCH_SIZE = 1000
+
+
+def _copy_stops(trip_id, new_trip):
+    """
+    Copies the stops of a trip to a new trip, reading them from one cursor
+    and writing them with an insert_many for each batch, with the new trip's
+    fields (see stop_dates.trip_fields). Returns the number of stops copied.
+
+    Stops are chained by _id order, so they are read in that order and given
+    new _id's here - ObjectIds created by one process always increase, so the
+    copies keep the same order.
+    """
+    stops = STORES.stops.for_trip(trip_id, batch_size=CLONE_BATCH_SIZE)
+    fields = dict(trip_fields(new_trip), trip_id=new_trip['_id'],
+                  updated_at=utc_now())
+    copied = 0
+    batch = []
+
+    for stop in stops:
+        stop.update(fields, _id=ObjectId())
+        batch.append(stop)
+
+        if len(batch) == CLONE_BATCH_SIZE:
+            STORES.stops.insert_many(batch)
+            SUGGESTIONS.add(*batch)
+            copied += len(batch)
+            batch = []
+
+    if batch:
+        STORES.stops.insert_many(batch)
+        SUGGESTIONS.add(*batch)
+        copied += len(batch)
+
+    return copied
+
+
+def clone_trip(trip, owner_id):
+    """
+    Copies a trip and all of its stops to owner_id's account. The copy is
+    private and keeps the trip summary, as its stops are the same. If the
+    stops cannot be copied the new trip is removed again. Returns the _id of
+    the new trip.
+    """
+    new_trip = {field: value for field, value in trip.items()
+                if field != '_id'}
+    new_trip.update({
+        'owner_id': ObjectId(owner_id),
+        'owner_display_name': STORES.users.find(owner_id)['display_name'],
+        'public': False,
+        'updated_at': utc_now()
+    })
+
+    new_trip_id = STORES.trips.insert(new_trip)
+
+    try:
+        _copy_stops(trip['_id'], dict(new_trip, _id=new_trip_id))
+    except Exception:
+        STORES.stops.delete_for_trip(new_trip_id)
+        STORES.trips.remove(new_trip_id)
+        raise
+
+    return new_trip_id
@@ -0,0 +1,189 @@
+""" This contains the flask cli commands used to maintain the database, e.g.
+flask rebuild-summaries """
+from time import perf_counter
+import click
+from flask import current_app
+from util import MONGO, ensure_indexes, check_indexes, record_change
+from views import BP
+from summary import rebuild_summaries, check_summaries
+from export import FORMATS, export_trips
+from purge import purge_deleted_trips, sweep_orphaned_stops, \
+    PURGE_BATCH_SIZE
+from seed import seed_database
+from owners import set_display_name, backfill_owner_names
+from storage import STORES
+from stop_dates import backfill_stop_dates
+
+
+@BP.cli.command('rebuild-summaries')
+@click.option('--check', is_flag=True,
+              help='Only report trips whose summary does not match the stops.')
+@click.option('--missing', is_flag=True,
+              help='Only rebuild the summaries which do not list the trip\'s '
+                   'cities yet.')
+@click.option('--batch-size', default=500, show_default=True,
+              help='Number of trips processed per batch.')
+def rebuild_summaries_command(check, missing, batch_size):
+    """
+    Recalculates the summary stored on each trip from the stops collection.
+    With --check the summaries are compared against the stops instead and the
+    command fails if any of them have drifted.
+    """
+    if check:
+        mismatched = check_summaries(batch_size=batch_size)
+
+        for trip_id in mismatched:
+            click.echo('Summary does not match stops for trip %s' % trip_id)
+
+        if mismatched:
+            raise click.ClickException(
+                '%d trip summaries do not match - run flask rebuild-summaries'
+                ' to repair them.' % len(mismatched))
+
+        click.echo('All trip summaries match.')
+        return
+
+    updated = rebuild_summaries(batch_size=batch_size, missing=missing)
+    click.echo('Rebuilt the summary for %d trips.' % updated)
+
+
+@BP.cli.command('ensure-indexes')
+@click.option('--check', is_flag=True,
+              help='Also explain each query the app issues and fail if any of '
+                   'them scan a whole collection.')
+def ensure_indexes_command(check):
+    """ Creates the indexes the app needs, if they do not already exist. """
+    created = ensure_indexes()
+    click.echo('Indexes in place: %s' % ', '.join(created))
+
+    if check:
+        collection_scans = check_indexes()
+
+        for collection, query, sort in collection_scans:
+            click.echo('COLLSCAN on %s for query %s sorted by %s'
+                       % (collection, query, sort))
+
+        if collection_scans:
+            raise click.ClickException(
+                '%d queries are not using an index.' % len(collection_scans))
+
+        click.echo('All queries are using an index.')
+
+
+@BP.cli.command('export-trips')
+@click.option('--format', 'export_format', type=click.Choice(sorted(FORMATS)),
+              default='ndjson', show_default=True,
+              help='Format of the export.')
+@click.option('--batch-size', type=int,
+              help='Number of trips read from the database at a time, '
+                   'defaults to EXPORT_BATCH_SIZE.')
+@click.option('--output', type=click.File('w'), default='-',
+              help='File to write the export to, defaults to stdout.')
+def export_trips_command(export_format, batch_size, output):
+    """ Exports every trip, public or not, along with its stops and their
+    dates and costs. """
+    rows = FORMATS[export_format][0]
+    batch_size = batch_size or current_app.config['EXPORT_BATCH_SIZE']
+
+    for row in rows(export_trips(everything=True,
+                                 batch_size=batch_size)):
+        output.write(row)
+
+
+@BP.cli.command('purge-deleted')
+@click.option('--sweep', is_flag=True,
+              help='Also remove stops whose trip no longer exists.')
+@click.option('--batch-size', default=PURGE_BATCH_SIZE, show_default=True,
+              help='Number of stops removed by each delete.')
+def purge_deleted_command(sweep, batch_size):
+    """ Removes the trips marked as deleted along with their stops, carrying
+    on from where any interrupted purge stopped. """
+    purged = purge_deleted_trips(batch_size=batch_size)
+    click.echo('Purged %d deleted trips.' % purged)
+
+    if sweep:
+        removed = sweep_orphaned_stops(batch_size=batch_size)
+        click.echo('Removed %d orphaned stops.' % removed)
+
+
+@BP.cli.command('backfill-owner-names')
+@click.option('--batch-size', default=500, show_default=True,
+              help='Number of owners whose trips are updated per batch.')
+def backfill_owner_names_command(batch_size):
+    """ Copies each owner's display name onto their trips which do not have
+    it yet, e.g. trips created before it was stored on them. """
+    updated = backfill_owner_names(batch_size=batch_size)
+    click.echo('Set the owner display name on the trips of %d users.'
+               % updated)
+
+
+@BP.cli.command('backfill-stop-dates')
+def backfill_stop_dates_command():
+    """ Stores the start and end dates, and the trip fields used by the trip
+    search, on the stops which do not have them yet, e.g. stops added before
+    they were stored. """
+    updated = backfill_stop_dates()
+    if updated:
+        record_change()
+    click.echo('Set the dates of %d stops.' % updated)
+
+
+@BP.cli.command('set-display-name')
+@click.argument('username')
+@click.argument('display_name')
+def set_display_name_command(username, display_name):
+    """ Changes the display name of a user, along with the copy of it on each
+    of their trips. """
+    user = STORES.users.find_by_username(username.lower())
+    if not user:
+        raise click.ClickException('No user with username %s.' % username)
+
+    set_display_name(user['_id'], display_name.strip())
+    click.echo('Display name of %s changed to %s.'
+               % (user['username'], display_name.strip()))
+
+
+@BP.cli.command('seed')
+@click.option('--users', default=1000, show_default=True,
+              help='Number of users to create.')
+@click.option('--trips', default=10000, show_default=True,
+              help='Number of trips to create.')
+@click.option('--max-stops', default=2000, show_default=True,
+              help='Most stops a trip can have.')
+@click.option('--large-trip-stops', default=0, show_default=True,
+              help='Also create a trip with this many stops.')
+@click.option('--seed', default=0, show_default=True,
+              help='Seed for the generated data - the same seed always '
+                   'generates the same data.')
+@click.option('--batch-size', default=1000, show_default=True,
+              help='Number of documents written by each insert_many.')
+@click.option('--workers', default=4, show_default=True,
+              help='Number of threads generating and inserting data.')
+@click.option('--drop', is_flag=True,
+              help='Drop the users, trips and stops collections first.')
+@click.confirmation_option('--yes', prompt='This writes synthetic data to '
+                                           'the database - continue?')
+def seed_command(users, trips, max_stops, large_trip_stops, seed, batch_size,
+                 workers, drop):
+    # pylint: disable=too-many-arguments
+    """ Fills the database with synthetic users, trips and stops for load
+    and scale testing. """
+    if drop:
+        for collection in ('users', 'trips', 'stops'):
+            MONGO.db[collection].drop()
+
+    started = perf_counter()
+    counts = seed_database(users=users, trips=trips, max_stops=max_stops,
+                           large_trip_stops=large_trip_stops, seed=seed,
+                           batch_size=batch_size, workers=workers)
+    click.echo('Inserted %(users)d users, %(trips)d trips and %(stops)d '
+               'stops' % counts + ' in %.1fs.' % (perf_counter() - started))
+
+    # the indexes are created after the data has been loaded, which is
+    # faster than maintaining them during the load
+    ensure_indexes()
+    # cached listings and ETags no longer match the data
+    record_change()
+
+    if counts['large_trip_id']:
+        click.echo('Large trip: %s' % counts['large_trip_id'])
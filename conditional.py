@@ -0,0 +1,60 @@
+""" This handles HTTP conditional GET requests for the trip pages. Each page
+is given a strong ETag built from the change stamp of the data it displays and
+the viewer, so a repeat request with a matching If-None-Match can be answered
+with 304 before any query is run or template rendered. """
+from hashlib import sha1
+from flask import request, session, make_response
+
+
+def make_etag(*parts):
+    """ Returns a strong ETag for a page. The viewer is always included as
+    the pages show different buttons (and the navbar) depending on who is
+    logged in. """
+    parts = (session.get('USERNAME', ''),) + parts
+    return sha1('|'.join(str(part) for part in parts).encode()).hexdigest()
+
+
+def trip_last_modified(trip):
+    """ Returns the time a trip, or any of its stops, was last changed. Trips
+    written before updated_at was added use their creation time. """
+    return trip.get('updated_at') or \
+        trip['_id'].generation_time.replace(tzinfo=None)
+
+
+def _revalidate(response):
+    """ Makes sure browsers and proxies check back with the server before
+    reusing a page, and keep a separate copy for each logged in user. """
+    response.cache_control.no_cache = True
+    response.vary.add('Cookie')
+    return response
+
+
+def not_modified(etag, last_modified=None):
+    """
+    Returns a 304 response if the client already has the current version of
+    the page, otherwise None.
+
+    Pages with pending flash messages are always rendered in full, as the
+    message is shown on the page itself.
+    """
+    if '_flashes' in session:
+        return None
+
+    if not request.if_none_match.contains(etag):
+        return None
+
+    response = make_response('', 304)
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified
+
+    return _revalidate(response)
+
+
+def add_validators(response, etag, last_modified=None):
+    """ Adds the ETag and Last-Modified headers to a rendered page. """
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified
+
+    return _revalidate(response)
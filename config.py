@@ -0,0 +1,55 @@
+""" This reads the app settings from the environment (and a .env file, if
+there is one). It is called by create_app() rather than when a module is
+imported, so nothing is read until an app is created. """
+import os
+from dotenv import load_dotenv
+
+
+def load_config():
+    """ Returns the settings for a new app. """
+    # get environment variables
+    load_dotenv()
+
+    return {
+        # where the data is kept - 'mongo', or 'memory' for tests and
+        # benchmarks (nothing is kept when the app stops)
+        'STORAGE': os.getenv('STORAGE', 'mongo'),
+        'MONGO_URI': os.getenv('MONGODB_URI'),
+        'SECRET_KEY': os.getenv('SECRET_KEY'),
+        # number of trips displayed per page on the trips listing
+        'TRIPS_PER_PAGE': int(os.getenv('TRIPS_PER_PAGE', '20')),
+        # maximum number of query results held in the cache, and how long (in
+        # seconds) they are kept for - 0 keeps them until they are invalidated
+        # or the data they were built from changes
+        'CACHE_MAX_SIZE': int(os.getenv('CACHE_MAX_SIZE', '1000')),
+        'CACHE_TTL': int(os.getenv('CACHE_TTL', '300')) or None,
+        # how long (in seconds) the stop form suggestions are used for before
+        # they are rebuilt from the stops - 0 keeps them until the app stops
+        'AUTOCOMPLETE_MAX_AGE': int(os.getenv('AUTOCOMPLETE_MAX_AGE', '600')),
+        # number of threads used to run independent queries for a request at
+        # the same time - 0 runs them one after another
+        'QUERY_WORKERS': int(os.getenv('QUERY_WORKERS', '8')),
+        # number of trips read from the database at a time by the exports
+        'EXPORT_BATCH_SIZE': int(os.getenv('EXPORT_BATCH_SIZE', '500')),
+        # connection pool settings - unset values use the driver defaults
+        'MONGO_MAX_POOL_SIZE': int(os.getenv('MONGO_MAX_POOL_SIZE', '100')),
+        'MONGO_MIN_POOL_SIZE': int(os.getenv('MONGO_MIN_POOL_SIZE', '0')),
+        'MONGO_WAIT_QUEUE_TIMEOUT_MS':
+            int(os.getenv('MONGO_WAIT_QUEUE_TIMEOUT_MS', '0')) or None,
+        'MONGO_SERVER_SELECTION_TIMEOUT_MS':
+            int(os.getenv('MONGO_SERVER_SELECTION_TIMEOUT_MS', '30000')),
+        # queries taking longer than this (in milliseconds) are written to the
+        # slow query log, which is rotated when it reaches the maximum size -
+        # the log is off unless a file is given, or with a threshold of 0
+        'SLOW_QUERY_MS': int(os.getenv('SLOW_QUERY_MS', '100')),
+        'SLOW_QUERY_LOG': os.getenv('SLOW_QUERY_LOG', ''),
+        'SLOW_QUERY_LOG_MAX_BYTES':
+            int(os.getenv('SLOW_QUERY_LOG_MAX_BYTES', '10485760')),
+        'SLOW_QUERY_LOG_BACKUPS': int(os.getenv('SLOW_QUERY_LOG_BACKUPS', '5')),
+        # directory each worker process writes its metrics to, so /metrics
+        # reports every worker - unset reports only the worker serving it
+        'METRICS_DIR': os.getenv('METRICS_DIR', ''),
+        # bearer token needed for /metrics, /db/stats/ and /cache/stats/ -
+        # they are not served at all while it is unset
+        'STATS_TOKEN': os.getenv('STATS_TOKEN', '')
+    }
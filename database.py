@@ -0,0 +1,109 @@
+""" This holds the MongoDB client for the app. The client is only created the
+first time a query is run, rather than when a module is imported or the app
+is created, so importing the app (in tests, CLI commands or worker processes)
+does not need a database or pay for connecting to one. """
+from threading import Lock
+from flask import current_app, has_app_context
+from pymongo import MongoClient
+
+
+class MongoDB:
+    """
+    Creates a MongoClient for each app the first time it is used, from the
+    MONGO_URI and pool settings in its config. An app can be given a client
+    of its own (e.g. one for a test database) with the MONGO_CLIENT config
+    value.
+
+    The app is taken from the app context. Code which runs outside of one,
+    e.g. on a thread the app started, uses the most recently created app.
+    """
+
+    def __init__(self, **client_kwargs):
+        # passed to every MongoClient, e.g. the monitoring event_listeners
+        self.client_kwargs = client_kwargs
+        self._app = None
+        self._lock = Lock()
+
+    def init_app(self, app):
+        """ Sets up an app - its client is created when it is first used. """
+        app.extensions['mongodb'] = {'client': app.config.get('MONGO_CLIENT'),
+                                     'db': None, 'server_version': None}
+        self._app = app
+
+    def _state(self):
+        """ Returns the app being used and its client and database. """
+        # pylint: disable=protected-access
+        app = current_app._get_current_object() if has_app_context() \
+            else self._app
+
+        if app is None or 'mongodb' not in app.extensions:
+            raise RuntimeError('MongoDB has not been set up - the app must be '
+                               'created with create_app().')
+
+        return app, app.extensions['mongodb']
+
+    @property
+    def client(self):
+        """ Returns the MongoClient for the app, creating it if needed. """
+        app, state = self._state()
+
+        if state['client'] is None:
+            with self._lock:
+                if state['client'] is None:
+                    config = app.config
+                    state['client'] = MongoClient(
+                        config['MONGO_URI'],
+                        maxPoolSize=config['MONGO_MAX_POOL_SIZE'],
+                        minPoolSize=config['MONGO_MIN_POOL_SIZE'],
+                        waitQueueTimeoutMS=config['MONGO_WAIT_QUEUE_TIMEOUT_MS'],
+                        serverSelectionTimeoutMS=config[
+                            'MONGO_SERVER_SELECTION_TIMEOUT_MS'],
+                        **self.client_kwargs)
+
+        return state['client']
+
+    @property
+    def db(self):
+        """ Returns the database named in MONGO_URI. """
+        _, state = self._state()
+
+        if state['db'] is None:
+            state['db'] = self.client.get_default_database()
+
+        return state['db']
+
+    @property
+    def server_version(self):
+        """ Returns the (major, minor) version of the app's MongoDB server,
+        which is only asked for the first time it is needed. """
+        _, state = self._state()
+
+        if state['server_version'] is None:
+            state['server_version'] = tuple(
+                self.client.server_info()['versionArray'][:2])
+
+        return state['server_version']
+
+    def collection(self, name):
+        """ Returns a handle for a collection, which can be created before
+        the app is. """
+        return Collection(self, name)
+
+    def close(self):
+        """ Closes the client of the app, if it has one. """
+        _, state = self._state()
+
+        if state['client'] is not None:
+            state['client'].close()
+
+
+class Collection:
+    """ Stands in for a collection in the app's database - every attribute is
+    looked up on the collection when it is used. """
+
+    def __init__(self, mongodb, name):
+        self._mongodb = mongodb
+        self.name = name
+
+    def __getattr__(self, attr):
+        return getattr(self._mongodb.db[self.name], attr)
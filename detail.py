@@ -0,0 +1,323 @@
+""" This builds the trip overview and the list of stops (with their dates and
+costs) displayed by trip_detailed. """
+from datetime import timedelta
+from bson.objectid import ObjectId
+from util import MONGO, NOT_DELETED, get_trip, get_stop_costs
+from summary import MS_PER_DAY, get_trip_detail
+from cache import RESULTS
+from storage import STORES
+
+# MongoDB version which added $setWindowFields
+WINDOW_FUNCTIONS_VERSION = (5, 0)
+
+# cost fields calculated for each stop - per person and total
+COST_FIELDS = ('accom', 'food', 'other')
+
+
+def server_version():
+    """ Returns the (major, minor) version of the MongoDB server of the app
+    being used - each app asks its own server, once. """
+    return MONGO.server_version
+
+
+def trip_detail_pipeline(trip_id):
+    """
+    Creates an aggregate MongoDB query which returns a trip along with all
+    of its stops, including the start and end date of each stop and the
+    stop and trip costs, as a single document.
+
+    Stops are chained from the trip start date in the order they were added,
+    i.e. each stop starts on the date the previous stop ended - the running
+    total of the stop durations is calculated with $setWindowFields.
+    """
+    stop_costs = {}
+    for field, source in zip(COST_FIELDS, (u"$cost_accommodation",
+                                           u"$cost_food", u"$cost_other")):
+        stop_costs[u"stop_total_%s_pp" % field] = {
+            u"$multiply": [u"$duration", source]
+        }
+
+    stop_totals = {}
+    for field in COST_FIELDS:
+        stop_totals[u"stop_total_%s" % field] = {
+            u"$multiply": [u"$$travelers", u"$stop_total_%s_pp" % field]
+        }
+
+    trip_totals = {}
+    for field in COST_FIELDS:
+        trip_totals[u"total_%s_pp" % field] = {
+            u"$sum": u"$stops.stop_total_%s_pp" % field
+        }
+        trip_totals[u"total_%s" % field] = {
+            u"$sum": u"$stops.stop_total_%s" % field
+        }
+
+    return [
+        {
+            u"$match": dict(NOT_DELETED, _id=ObjectId(trip_id))
+        },
+        {
+            u"$lookup": {
+                u"from": u"stops",
+                u"let": {
+                    u"start_date": u"$start_date",
+                    u"travelers": u"$travelers"
+                },
+                u"pipeline": [
+                    {
+                        u"$match": {
+                            u"trip_id": ObjectId(trip_id)
+                        }
+                    },
+                    {
+                        # number of days from the trip start date to the
+                        # end of each stop
+                        u"$setWindowFields": {
+                            u"sortBy": {
+                                u"_id": 1
+                            },
+                            u"output": {
+                                u"days_to_end": {
+                                    u"$sum": u"$duration",
+                                    u"window": {
+                                        u"documents": [u"unbounded",
+                                                       u"current"]
+                                    }
+                                }
+                            }
+                        }
+                    },
+                    {
+                        u"$set": stop_costs
+                    },
+                    {
+                        u"$set": stop_totals
+                    },
+                    {
+                        u"$project": {
+                            u"_id": 0,
+                            u"trip_id": 1,
+                            u"stop_id": u"$_id",
+                            u"duration": 1,
+                            u"travelers": u"$$travelers",
+                            u"country": 1,
+                            u"city_town": 1,
+                            u"currency": 1,
+                            u"stop_start_date": {
+                                u"$add": [
+                                    u"$$start_date",
+                                    {
+                                        u"$multiply": [
+                                            {
+                                                u"$subtract": [
+                                                    u"$days_to_end",
+                                                    u"$duration"
+                                                ]
+                                            },
+                                            MS_PER_DAY
+                                        ]
+                                    }
+                                ]
+                            },
+                            u"stop_end_date": {
+                                u"$add": [
+                                    u"$$start_date",
+                                    {
+                                        u"$multiply": [u"$days_to_end",
+                                                       MS_PER_DAY]
+                                    }
+                                ]
+                            },
+                            u"stop_total_accom_pp": 1,
+                            u"stop_total_food_pp": 1,
+                            u"stop_total_other_pp": 1,
+                            u"stop_total_accom": 1,
+                            u"stop_total_food": 1,
+                            u"stop_total_other": 1,
+                            u"stop_total_cost_pp": {
+                                u"$add": [u"$stop_total_accom_pp",
+                                          u"$stop_total_food_pp",
+                                          u"$stop_total_other_pp"]
+                            },
+                            u"stop_total_cost": {
+                                u"$add": [u"$stop_total_accom",
+                                          u"$stop_total_food",
+                                          u"$stop_total_other"]
+                            }
+                        }
+                    }
+                ],
+                u"as": u"stops"
+            }
+        },
+        {
+            u"$set": dict(trip_totals, **{
+                u"total_duration": {
+                    u"$sum": u"$stops.duration"
+                },
+                u"total_stops": {
+                    u"$size": u"$stops"
+                },
+                u"total_countries": {
+                    u"$size": {u"$setUnion": [u"$stops.country", []]}
+                }
+            })
+        },
+        {
+            u"$set": {
+                u"trip_total_cost_pp": {
+                    u"$add": [u"$total_accom_pp", u"$total_food_pp",
+                              u"$total_other_pp"]
+                },
+                u"trip_total_cost": {
+                    u"$add": [u"$total_accom", u"$total_food",
+                              u"$total_other"]
+                },
+                u"end_date": {
+                    u"$add": [
+                        u"$start_date",
+                        {u"$multiply": [u"$total_duration", MS_PER_DAY]}
+                    ]
+                }
+            }
+        },
+        {
+            u"$set": {
+                u"avg_cost_pn": {
+                    u"$cond": {
+                        u"if": {u"$gt": [u"$total_duration", 0]},
+                        u"then": {
+                            u"$divide": [u"$trip_total_cost",
+                                         u"$total_duration"]
+                        },
+                        u"else": u"$$REMOVE"
+                    }
+                }
+            }
+        }
+    ]
+
+
+def stop_details(trip, stops):
+    """
+    Returns the stops of a trip with their start and end dates and costs
+    (per person and total). Stops must be in the order they were added, as
+    each stop starts on the date the previous stop ended.
+
+    This is used by build_trip_detail and the exports, so the figures match
+    those shown on the trip page.
+    """
+    # loop through stops, creating new array which is passed to the
+    # template - each stop starts on the date the previous stop ended
+    stops_detail = []
+    last_stop_end_date = trip['start_date']
+
+    for stop in stops:
+        last_stop_start_date = last_stop_end_date
+        last_stop_end_date = last_stop_start_date + \
+            timedelta(days=stop['duration'])
+
+        arr = {
+            'trip_id': trip['_id'],
+            'stop_id': stop['_id'],
+            'duration': stop['duration'],
+            'travelers': trip['travelers'],
+            'country': stop['country'],
+            'city_town': stop['city_town'],
+            'currency': stop['currency'],
+
+            'stop_start_date': last_stop_start_date,
+            'stop_end_date': last_stop_end_date
+        }
+        # add costs for the stop (per person and total)
+        arr.update(get_stop_costs(stop, trip['travelers']))
+        # add data to stops_detail array
+        stops_detail.append(arr)
+
+    return stops_detail
+
+
+def build_trip_detail(trip_id):
+    """
+    Returns the trip overview and stops for trip_detailed, calculated in
+    Python. The overview is read from the trip summary and the stop dates
+    and costs are calculated by looping through the stops.
+
+    This is used by the in-memory store and for MongoDB servers without
+    $setWindowFields. Returns (None, None) if the trip does not exist.
+    """
+    trip = get_trip(trip_id)
+
+    if not trip:
+        return None, None
+
+    # stops are displayed in the order they were added
+    stops = STORES.stops.for_trip(trip_id)
+
+    return get_trip_detail(trip), stop_details(trip, stops)
+
+
+def load_trip_detail(trip_id):
+    """ Returns the trip overview and stops for trip_detailed, as calculated
+    by the app's trip store. """
+    return STORES.trips.detail(trip_id)
+
+
+def cached_trip_detail(trip_id, version=None):
+    """ Returns the trip overview and stops for a trip, from the query cache
+    if they are there and otherwise from load_trip_detail. version is the
+    time the trip was last modified (see conditional.trip_last_modified) -
+    every write to the trip or its stops changes it, so a detail cached
+    before a write made by another process is not used. """
+    cache_key = ('trip', ObjectId(trip_id), version)
+    cached = RESULTS.get(cache_key)
+
+    if cached:
+        return cached
+
+    trip_detail, stops_detail = load_trip_detail(trip_id)
+
+    if trip_detail:
+        RESULTS.set(cache_key, (trip_detail, stops_detail),
+                    trip_ids=[trip_detail['_id']])
+
+    return trip_detail, stops_detail
+
+
+def _values_match(value, other):
+    """ Compares two values, allowing for floating point differences in
+    the order costs are added together. """
+    if value is None or other is None:
+        return value is other
+
+    if isinstance(value, float) or isinstance(other, float):
+        return round(value, 2) == round(other, 2)
+
+    return value == other
+
+
+def trip_details_match(trip_id):
+    """ Checks that the trip store (e.g. the MongoDB aggregation) and the
+    Python loop produce the same trip overview and stops for a trip. """
+    trip_detail, stops_detail = load_trip_detail(trip_id)
+    expected_trip, expected_stops = build_trip_detail(trip_id)
+
+    if trip_detail is None or expected_trip is None:
+        return trip_detail is expected_trip
+
+    if len(stops_detail) != len(expected_stops):
+        return False
+
+    for stop, expected in zip(stops_detail, expected_stops):
+        if any(not _values_match(stop.get(field), value)
+               for field, value in expected.items()):
+            return False
+
+    # only compare the figures which are calculated for the overview
+    return all(_values_match(trip_detail.get(field), expected_trip.get(field))
+               for field in ('end_date', 'total_duration', 'total_stops',
+                             'total_countries', 'avg_cost_pn',
+                             'trip_total_cost', 'trip_total_cost_pp',
+                             'total_accom_pp', 'total_food_pp',
+                             'total_other_pp', 'total_accom', 'total_food',
+                             'total_other'))
@@ -0,0 +1,147 @@
+""" This exports every trip along with its stops and their computed dates and
+costs, as newline delimited JSON or CSV. Rows are generated one trip at a time
+from a single cursor so memory use does not grow with the number of trips. """
+import csv
+import io
+import json
+from datetime import datetime
+from operator import itemgetter
+from bson.objectid import ObjectId
+from util import NOT_DELETED
+from summary import get_trip_detail
+from detail import stop_details
+from storage import STORES
+
+# trip fields included in the exports
+TRIP_FIELDS = ('trip_id', 'name', 'owner_id', 'public', 'travelers',
+               'start_date', 'end_date', 'total_duration', 'total_stops',
+               'total_countries', 'trip_total_cost', 'trip_total_cost_pp')
+
+# stop fields included in the exports
+STOP_FIELDS = ('stop_id', 'country', 'city_town', 'currency', 'duration',
+               'stop_start_date', 'stop_end_date', 'stop_total_accom_pp',
+               'stop_total_food_pp', 'stop_total_other_pp',
+               'stop_total_cost_pp', 'stop_total_accom', 'stop_total_food',
+               'stop_total_other', 'stop_total_cost')
+
+# csv files have one row per stop, with the trip fields repeated
+CSV_FIELDS = TRIP_FIELDS + STOP_FIELDS
+
+
+def export_pipeline(query=None):
+    """
+    Creates an aggregate MongoDB query which returns each trip matching
+    query (that has not been deleted) along with its stops. Trips are sorted
+    by _id so the export is in a stable order.
+    """
+    return [
+        {
+            u"$match": {
+                u"$and": [query or {}, NOT_DELETED]
+            }
+        },
+        {
+            u"$sort": {
+                u"_id": 1
+            }
+        },
+        {
+            u"$lookup": {
+                u"from": u"stops",
+                u"localField": u"_id",
+                u"foreignField": u"trip_id",
+                u"as": u"stops"
+            }
+        }
+    ]
+
+
+def visible_trips(user_id=None):
+    """ Returns the query for the trips a user can see - public trips and
+    their own (or just public trips if user_id is None). """
+    if user_id is None:
+        return {u"public": True}
+
+    return {u"$or": [{u"owner_id": user_id}, {u"public": True}]}
+
+
+def export_trips(user_id=None, everything=False, batch_size=500,
+                 owned=False):
+    """
+    Generator which yields a (trip, stops) tuple for each trip user_id can
+    see, or every trip if everything is True (or only user_id's own trips if
+    owned is True) - the trip includes the overview figures shown on
+    trip_detailed and the stops include their dates and costs.
+
+    Trips are read from a single cursor, batch_size trips at a time.
+    """
+    trips = STORES.trips.with_stops(user_id, everything=everything,
+                                    batch_size=batch_size, owned=owned)
+
+    for trip in trips:
+        # stops are chained in the order they were added
+        stops = sorted(trip.pop('stops'), key=itemgetter('_id'))
+        trip_detail = get_trip_detail(trip)
+        trip_detail['trip_id'] = trip_detail['_id']
+
+        yield trip_detail, stop_details(trip, stops)
+
+
+def _export_value(value):
+    """ Converts the values which JSON and CSV do not support to strings. """
+    if isinstance(value, ObjectId):
+        return str(value)
+
+    if isinstance(value, datetime):
+        return value.isoformat()
+
+    return value
+
+
+def _select(document, fields):
+    """ Returns the export values of fields from document, in order. """
+    return [(field, _export_value(document.get(field))) for field in fields]
+
+
+def ndjson_rows(trips):
+    """ Generator which yields each trip (with its stops) as a line of
+    JSON. """
+    for trip, stops in trips:
+        row = dict(_select(trip, TRIP_FIELDS))
+        row['stops'] = [dict(_select(stop, STOP_FIELDS)) for stop in stops]
+
+        yield json.dumps(row) + '\n'
+
+
+def csv_rows(trips):
+    """ Generator which yields the csv header, then a row for each stop.
+    Trips without any stops have a single row with the stop fields left
+    empty. """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def flush():
+        """ Returns the rows written since the last flush. """
+        rows = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return rows
+
+    writer.writerow(CSV_FIELDS)
+    yield flush()
+
+    for trip, stops in trips:
+        trip_values = [value for _, value in _select(trip, TRIP_FIELDS)]
+
+        for stop in stops or [{}]:
+            writer.writerow(trip_values +
+                            [value for _, value in _select(stop, STOP_FIELDS)])
+
+        yield flush()
+
+
+# generator and mimetype for each export format
+FORMATS = {
+    'ndjson': (ndjson_rows, 'application/x-ndjson'),
+    'csv': (csv_rows, 'text/csv')
+}
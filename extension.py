@@ -0,0 +1,43 @@
+""" This holds the objects which each app keeps for itself - the query cache,
+the stop form suggestions and the slow query log - so two apps in the same
+process (e.g. one for each test) never see each other's results. """
+from flask import current_app, has_app_context
+
+
+class AppExtension:
+    """
+    Looks up the object an app keeps in app.extensions under name, created
+    for the app by factory(app) when the app is set up. The app is taken
+    from the app context or, for code which runs outside of one, is the most
+    recently created app (as for the stores in storage.py). Every other
+    attribute is read from the app's object.
+    """
+
+    def __init__(self, name, factory):
+        self.name = name
+        self.factory = factory
+        self._app = None
+
+    def init_app(self, app):
+        """ Creates the object used by an app. """
+        app.extensions[self.name] = self.factory(app)
+        self._app = app
+
+    def current(self):
+        """ Returns the object of the app being used. """
+        # pylint: disable=protected-access
+        app = current_app._get_current_object() if has_app_context() \
+            else self._app
+
+        if app is None or self.name not in app.extensions:
+            raise RuntimeError('%s has not been set up - the app must be '
+                               'created with create_app().' % self.name)
+
+        return app.extensions[self.name]
+
+    def __getattr__(self, name):
+        # only called for attributes this object does not have
+        if name.startswith('_') or name in ('name', 'factory'):
+            raise AttributeError(name)
+
+        return getattr(self.current(), name)
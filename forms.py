@@ -1,7 +1,7 @@
 """ This sets out the structure and validation for each input form used """
 from datetime import datetime, timedelta
 from wtforms import StringField, BooleanField, \
-    IntegerField, DateTimeField, DecimalField, HiddenField
+    IntegerField, DateTimeField, DecimalField, HiddenField, FileField
 from wtforms.validators import DataRequired, NumberRange, Email, Length, \
     InputRequired
 from flask_wtf import FlaskForm
@@ -65,3 +65,10 @@ class StopForm(FlaskForm):
         InputRequired(), NumberRange(min=0)])
     cost_other = DecimalField('Other (Cost)', places=2, validators=[
         InputRequired(), NumberRange(min=0)])
+
+
+class StopImportForm(FlaskForm):
+    """ Fields and validation for Importing Stops from a File """
+    stops_file = FileField('Stops File (CSV or JSON)',
+                           validators=[DataRequired(
+                               message='Please choose a file to import.')])
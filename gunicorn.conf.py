@@ -0,0 +1,51 @@
+""" gunicorn settings for serving the app in production - see wsgi.py. Each
+setting can be changed with the environment variable noted against it. """
+import glob
+import multiprocessing
+import os
+
+bind = '%s:%s' % (os.getenv('IP', '0.0.0.0'), os.getenv('PORT', '5000'))
+
+# requests spend most of their time waiting on MongoDB, so each worker
+# process handles several at once on threads - the usual (2 x CPUs) + 1
+# processes keeps every CPU busy while others are waiting
+workers = int(os.getenv('WEB_CONCURRENCY',
+                        str(multiprocessing.cpu_count() * 2 + 1)))
+worker_class = 'gthread'
+threads = int(os.getenv('WEB_THREADS', '4'))
+
+# the app is loaded by each worker after it has been forked, rather than once
+# by the master, as a MongoDB client must not be shared across a fork
+preload_app = False
+
+# seconds a request can take before its worker is restarted, and to let
+# requests in progress finish when the server is stopped or reloaded
+timeout = int(os.getenv('WEB_TIMEOUT', '30'))
+graceful_timeout = int(os.getenv('WEB_GRACEFUL_TIMEOUT', '30'))
+keepalive = 5
+
+accesslog = '-'
+
+
+def on_starting(server):  # pylint: disable=unused-argument
+    """ Removes the metrics files left in METRICS_DIR by the workers of an
+    earlier run (e.g. one which was killed), so /metrics only reports the
+    workers of this one. """
+    directory = os.getenv('METRICS_DIR')
+    if directory:
+        for path in glob.glob(os.path.join(directory, 'worker-*.json')):
+            os.remove(path)
+
+
+def post_worker_init(worker):  # pylint: disable=unused-argument
+    """ Warms up each worker once it has loaded the app and before it
+    accepts requests. """
+    from wsgi import warm_up  # pylint: disable=import-outside-toplevel
+    warm_up()
+
+
+def worker_exit(server, worker):  # pylint: disable=unused-argument
+    """ Shuts each worker down cleanly once it has stopped accepting
+    requests. """
+    from wsgi import shut_down  # pylint: disable=import-outside-toplevel
+    shut_down()
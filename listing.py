@@ -0,0 +1,220 @@
+""" This builds the trips listing - the public trips and those the user owns
+(or just the user's own trips), a page at a time. It is used by show_trips and
+the JSON read API. """
+from datetime import datetime, timedelta
+from flask import current_app
+from util import encode_cursor, utc_now
+from cache import RESULTS
+from storage import STORES
+
+# date filters of the trips listing, chosen with the 'when' query string
+# value - 'between' also takes 'from' and 'to' dates (YYYY-MM-DD)
+DATE_FILTERS = ('upcoming', 'in_progress', 'between')
+
+
+def date_filter(args, today=None):
+    """
+    Reads the date filter of the trips listing from the query string args.
+    Returns a (dates, filter_args) tuple, where dates are the (start_from,
+    start_to, end_from) bounds on the trip start and end dates - any of which
+    can be None - and filter_args are the query string values to carry over
+    to the page links. If there is no filter, or it is not valid, (None, {})
+    is returned and every trip is listed.
+    """
+    when = args.get('when')
+    if today is None:
+        today = datetime.combine(utc_now().date(), datetime.min.time())
+
+    if when == 'upcoming':
+        # trips start on a day, so this is every trip starting after today
+        return (today + timedelta(days=1), None, None), {'when': when}
+
+    if when == 'in_progress':
+        return (None, today, today), {'when': when}
+
+    if when == 'between':
+        try:
+            date_from = datetime.strptime(args.get('from', ''), '%Y-%m-%d')
+            date_to = datetime.strptime(args.get('to', ''), '%Y-%m-%d')
+        except ValueError:
+            return None, {}
+
+        if date_from > date_to:
+            return None, {}
+
+        # trips which are taking place at any time between the dates
+        return (None, date_to, date_from), {'when': when,
+                                            'from': args['from'],
+                                            'to': args['to']}
+
+    return None, {}
+
+
+def trips_pipeline(user_id, show, after, before, limit, dates=None):
+    """
+    Creates an aggregate MongoDB query which returns up to limit trips of the
+    trips listing, in the order they are paged. after and before are the
+    decoded page cursors, and dates the bounds from date_filter().
+    """
+    if show == 'user':
+        # if user is logged in, show only their trips (i.e. route is
+        # /trips/user)
+        pipeline_filter = {
+            u"$match": {
+                u"deleted_at": {u"$exists": False},
+                u"$or":
+                    [{u"owner_id": user_id}]
+            }
+        }
+    else:
+        pipeline_filter = {
+            u"$match": {
+                u"deleted_at": {u"$exists": False},
+                u"$or":
+                    [{u"owner_id": user_id},
+                     {u"public": True}]
+            }
+        }
+
+    # the start date bounds are part of the range scanned on the
+    # (public, start_date, end_date) index, and the end date is then checked
+    # from the same index entries
+    if dates:
+        start_from, start_to, end_from = dates
+        start_date = {}
+        if start_from:
+            start_date[u"$gte"] = start_from
+        if start_to:
+            start_date[u"$lte"] = start_to
+        if start_date:
+            pipeline_filter[u"$match"][u"start_date"] = start_date
+        if end_from:
+            pipeline_filter[u"$match"][u"end_date"] = {u"$gte": end_from}
+
+    return page_stages(pipeline_filter[u"$match"], after, before, limit)
+
+
+def cursor_filter(after, before, start_field=u"start_date", id_field=u"_id"):
+    """ Returns the query for the trips after (or before) a page cursor, in
+    the order they are paged - the fields can be named for the trip fields
+    copied onto stops (see search.py). """
+    start_date, trip_id = after or before
+    operator = u"$gt" if after else u"$lt"
+
+    return {
+        u"$or": [
+            {start_field: {operator: start_date}},
+            {start_field: start_date, id_field: {operator: trip_id}}
+        ]
+    }
+
+
+def page_stages(match, after, before, limit):
+    """
+    Creates the aggregation stages which return up to limit of the trips
+    matching match as a page of the trips listing, in the order they are
+    paged - these are also used by the trip search (see search.py).
+    """
+    # paging backwards is done by reversing the sort and then flipping the
+    # results once they have been returned
+    direction = -1 if before else 1
+
+    if after or before:
+        match = {u"$and": [match, cursor_filter(after, before)]}
+
+    # create aggregation query for the page of trips - trip figures are read
+    # from the summary stored on each trip, and the owner's display name is
+    # copied onto each trip (see owners.py), so no other collection is read.
+    # One extra trip is returned to tell whether there is another page
+    return [
+        {
+            u"$match": match
+        },
+        {
+            u"$sort": {
+                u"start_date": direction,
+                u"_id": direction
+            }
+        },
+        {
+            u"$limit": limit
+        },
+        {
+            u"$project": {
+                u"number_of_stops": u"$summary.number_of_stops",
+                u"duration": u"$summary.duration",
+                u"total_cost": {
+                    u"$multiply": [
+                        u"$travelers",
+                        {
+                            u"$add": [
+                                u"$summary.total_accom_pp",
+                                u"$summary.total_food_pp",
+                                u"$summary.total_other_pp"
+                            ]
+                        }
+                    ]
+                },
+                u"start_date": 1,
+                u"end_date": 1,
+                u"countries": u"$summary.countries",
+                u"name": 1,
+                u"travelers": 1,
+                u"username": u"$owner_display_name",
+                u"public": 1,
+                u"owner_id": 1
+            }
+        }
+    ]
+
+
+def load_trips(user_id, show, after, before, dates=None, version=None):
+    """
+    Returns a page of the trips listing as a (trips, more_trips) tuple, where
+    more_trips is True if there is another page in the direction being paged.
+    dates are the bounds from date_filter(), if the trips are filtered by
+    date, and version is the change stamp version the page is for. Results
+    are read from the query cache where possible.
+    """
+    per_page = current_app.config['TRIPS_PER_PAGE']
+
+    # results are cached for each viewer, listing, date filter and page, and
+    # for the version of the data, so a page cached before a write made by
+    # another process is not used once the change stamp has moved on
+    cache_key = ('trips', str(user_id), show, after, before, dates, version)
+    get_trips = RESULTS.get(cache_key)
+
+    if get_trips is None:
+        try:
+            # one extra trip is read to tell whether there is another page
+            get_trips = STORES.trips.listing(user_id, show, after, before,
+                                             limit=per_page + 1, dates=dates)
+            RESULTS.set(cache_key, get_trips,
+                        trip_ids=[trip['_id'] for trip in get_trips])
+        except Exception:
+            # if any errors pass through nothing and the page will deal with
+            # output
+            get_trips = []
+
+    # the extra trip is only used to check if there is another page
+    more_trips = len(get_trips) > per_page
+    get_trips = get_trips[:per_page]
+
+    if before:
+        get_trips.reverse()
+
+    return get_trips, more_trips
+
+
+def page_cursors(trips, after, before, more_trips):
+    """ Returns the (previous, next) page cursors for a page of the trips
+    listing - either is None if there is no page in that direction. """
+    prev_cursor = next_cursor = None
+
+    if trips:
+        if after or (before and more_trips):
+            prev_cursor = encode_cursor(trips[0])
+        if before or more_trips:
+            next_cursor = encode_cursor(trips[-1])
+
+    return prev_cursor, next_cursor
@@ -0,0 +1,820 @@
+""" This keeps the app's data in memory (see storage.py for the methods every
+set of stores has). Each app gets its own empty stores, so tests using them
+are isolated from each other and do not need MongoDB, and benchmarks using
+them measure the time spent in the app rather than in the database.
+
+The stores answer the same queries as the MongoDB aggregations - documents are
+copied on the way in and out, as they would be by a database, so changing a
+document which has been read does not change the stored one. """
+from bisect import bisect_left, bisect_right, insort
+from collections import Counter, defaultdict
+from copy import deepcopy
+from datetime import timedelta
+from threading import RLock
+from bson.objectid import ObjectId
+from pymongo.errors import DuplicateKeyError
+from util import utc_now, owner_stamp_id
+from detail import build_trip_detail
+from summary import EMPTY_SUMMARY, TOTAL_FIELDS, stop_totals
+from search import text_words
+from stop_dates import TRIP_FIELDS
+
+# the stores take the same arguments as the MongoDB ones, even where they are
+# not needed (e.g. batch sizes)
+# pylint: disable=unused-argument
+
+# sorts after every ObjectId, to find the last listing key for a start date
+LAST_ID = ObjectId('f' * 24)
+
+# trip fields included in the trips listing, along with those calculated from
+# the summary (see listing.trips_pipeline)
+LISTING_FIELDS = ('_id', 'start_date', 'end_date', 'name', 'travelers',
+                  'public', 'owner_id')
+
+
+def _copy(document):
+    """ Returns a copy of a document, or None. Only the nested values (e.g.
+    the trip summary) need a deep copy. """
+    if document is None:
+        return None
+
+    return {field: deepcopy(value) if isinstance(value, (dict, list))
+            else value for field, value in document.items()}
+
+
+class MemoryDatabase:
+    """
+    The documents of every collection, keyed by _id, along with the sort
+    keys which stand in for the indexes. Every read and write holds the lock,
+    so the stores can be used by several threads at once.
+    """
+
+    def __init__(self):
+        self.lock = RLock()
+        self.users = {}
+        # username -> _id, which is unique as in the users collection
+        self.usernames = {}
+        self.trips = {}
+        # (start_date, _id) of every trip which has not been deleted, in
+        # listing order - and the same for each owner
+        self.listing = []
+        self.owner_listing = defaultdict(list)
+        self.stops = {}
+        # trip_id -> the _id's of its stops, in the order they were added
+        self.trip_stops = defaultdict(list)
+        # (country,) and (country, city_town) -> (trip_start, trip_id, _id)
+        # of each stop there with the trip fields, in the order the trips
+        # are paged - used by the trip search
+        self.stop_dates = defaultdict(list)
+        self.meta = {}
+
+    def index_trip(self, trip):
+        """ Adds a trip to the listings, unless it is deleted. """
+        if 'deleted_at' not in trip:
+            key = (trip['start_date'], trip['_id'])
+            insort(self.listing, key)
+            insort(self.owner_listing[trip['owner_id']], key)
+
+    def unindex_trip(self, trip):
+        """ Removes a trip from the listings, if it is in them. """
+        key = (trip['start_date'], trip['_id'])
+        for keys in (self.listing, self.owner_listing[trip['owner_id']]):
+            index = bisect_left(keys, key)
+            if index < len(keys) and keys[index] == key:
+                del keys[index]
+
+    @staticmethod
+    def _search_keys(stop):
+        """ Returns the stop_dates keys a stop is listed under. """
+        return [(stop['country'],), (stop['country'], stop['city_town'])]
+
+    @staticmethod
+    def _search_key(stop):
+        """ Returns the sort key of a stop in the stop_dates keys. """
+        return stop['trip_start'], stop['trip_id'], stop['_id']
+
+    def index_stop(self, stop):
+        """ Adds a stop to the stops of its trip, and to the search if it
+        has the trip fields. """
+        insort(self.trip_stops[stop['trip_id']], stop['_id'])
+
+        if 'trip_start' in stop:
+            for key in self._search_keys(stop):
+                insort(self.stop_dates[key], self._search_key(stop))
+
+    def unindex_stop(self, stop):
+        """ Removes a stop from the stops of its trip, and from the
+        search. """
+        stop_ids = self.trip_stops.get(stop['trip_id'])
+        if stop_ids:
+            stop_ids.remove(stop['_id'])
+            if not stop_ids:
+                del self.trip_stops[stop['trip_id']]
+
+        if 'trip_start' in stop:
+            for key in self._search_keys(stop):
+                keys = self.stop_dates[key]
+                del keys[bisect_left(keys, self._search_key(stop))]
+                if not keys:
+                    del self.stop_dates[key]
+
+    def trip_stop_ids(self, trip_id):
+        """ Returns the _id's of the stops of a trip, in order. """
+        return self.trip_stops.get(ObjectId(trip_id), [])
+
+
+class MemoryUserStore:
+    """ Users, held in memory. """
+
+    def __init__(self, database):
+        self.database = database
+
+    def find(self, user_id):
+        """ Returns a user, or None. """
+        with self.database.lock:
+            return _copy(self.database.users.get(ObjectId(user_id)))
+
+    def insert(self, user):
+        """ Adds a user and returns its _id. """
+        database = self.database
+        user.setdefault('_id', ObjectId())
+
+        with database.lock:
+            if user['_id'] in database.users or \
+                    user['username'] in database.usernames:
+                raise DuplicateKeyError('User %s already exists.'
+                                        % user['username'])
+
+            database.users[user['_id']] = _copy(user)
+            database.usernames[user['username']] = user['_id']
+
+        return user['_id']
+
+    def insert_many(self, users, ordered=True):
+        """ Adds users. """
+        for user in users:
+            self.insert(user)
+
+    def update(self, user_id, fields):
+        """ Sets fields on a user. """
+        database = self.database
+
+        with database.lock:
+            user = database.users.get(ObjectId(user_id))
+            if user:
+                del database.usernames[user['username']]
+                user.update(_copy(fields))
+                database.usernames[user['username']] = user['_id']
+
+    def find_by_username(self, username):
+        """ Returns the user with a username, or None. """
+        database = self.database
+
+        with database.lock:
+            return _copy(database.users.get(database.usernames.get(username)))
+
+    def display_names(self, user_ids):
+        """ Returns a dict of user _id to display name for the users in
+        user_ids which exist. """
+        users = self.database.users
+
+        with self.database.lock:
+            return {user_id: users[user_id]['display_name']
+                    for user_id in map(ObjectId, user_ids) if user_id in users}
+
+
+class MemoryTripStore:
+    """ Trips, held in memory. """
+
+    def __init__(self, database):
+        self.database = database
+
+    def _find(self, trip_id):
+        """ Returns the stored trip which has not been deleted, or None. """
+        trip = self.database.trips.get(ObjectId(trip_id))
+        return trip if trip and 'deleted_at' not in trip else None
+
+    def _change(self, trip_id, change):
+        """ Calls change with the stored trip (if it exists), keeping the
+        listings in order. """
+        database = self.database
+
+        with database.lock:
+            trip = database.trips.get(ObjectId(trip_id))
+            if trip:
+                database.unindex_trip(trip)
+                change(trip)
+                database.index_trip(trip)
+
+    def find(self, trip_id):
+        """ Returns a trip which has not been deleted, or None. """
+        with self.database.lock:
+            return _copy(self._find(trip_id))
+
+    def find_with_stop(self, trip_id, stop_id):
+        """ Returns a trip along with one of its stops as a (trip, stop)
+        tuple - either is None if it does not exist. """
+        with self.database.lock:
+            trip = self._find(trip_id)
+            if not trip:
+                return None, None
+
+            stop = self.database.stops.get(ObjectId(stop_id))
+            if stop and stop['trip_id'] != trip['_id']:
+                stop = None
+
+            return _copy(trip), _copy(stop)
+
+    def insert(self, trip):
+        """ Adds a trip and returns its _id. """
+        database = self.database
+        trip.setdefault('_id', ObjectId())
+
+        with database.lock:
+            if trip['_id'] in database.trips:
+                raise DuplicateKeyError('Trip %s already exists.'
+                                        % trip['_id'])
+
+            database.trips[trip['_id']] = _copy(trip)
+            database.index_trip(trip)
+
+        return trip['_id']
+
+    def insert_many(self, trips, ordered=True):
+        """ Adds trips. """
+        for trip in trips:
+            self.insert(trip)
+
+    def update(self, trip_id, fields):
+        """ Sets fields on a trip. """
+        fields = _copy(fields)
+        self._change(trip_id, lambda trip: trip.update(fields))
+
+    def update_many(self, updates):
+        """ Sets fields on many trips - updates is a list of (trip_id,
+        fields). """
+        for trip_id, fields in updates:
+            self.update(trip_id, fields)
+
+    def remove(self, trip_id):
+        """ Removes a trip straight away, whether or not it is deleted. """
+        database = self.database
+
+        with database.lock:
+            trip = database.trips.pop(ObjectId(trip_id), None)
+            if trip:
+                database.unindex_trip(trip)
+
+    @staticmethod
+    def _set_end_date(trip):
+        """ Sets the end date of a trip from its start date and summary. """
+        duration = (trip.get('summary') or {}).get('duration', 0)
+        trip['end_date'] = trip['start_date'] + timedelta(days=duration)
+
+    def update_summary(self, trip_id, totals, add_country=None,
+                       remove_country=None, add_city=None, remove_city=None):
+        """ Applies the change in totals (and countries and cities) to the
+        summary of a trip and recalculates its end date. """
+        def change(trip):
+            summary = trip.setdefault('summary', dict(EMPTY_SUMMARY,
+                                                      countries=[],
+                                                      cities=[]))
+            for field, value in totals.items():
+                summary[field] = summary.get(field, 0) + value
+
+            for field, add, remove in (
+                    ('countries', add_country, remove_country),
+                    ('cities', add_city, remove_city)):
+                values = [value for value in summary.get(field, [])
+                          if value != remove]
+                if add is not None and add not in values:
+                    values.append(add)
+                summary[field] = values
+
+            trip['updated_at'] = utc_now()
+            self._set_end_date(trip)
+
+        self._change(trip_id, change)
+
+    def update_end_date(self, trip_id):
+        """ Recalculates the end date of a trip from its start date and
+        summary. """
+        self._change(trip_id, self._set_end_date)
+
+    def summary_batches(self, batch_size, trip_ids=None):
+        """ Generator which yields the trips which have not been deleted
+        (or those of them in trip_ids) in batches of batch_size - only their
+        _id, start_date and summary are included. """
+        database = self.database
+
+        with database.lock:
+            if trip_ids is None:
+                trip_ids = list(database.trips)
+            trip_ids = [ObjectId(trip_id) for trip_id in trip_ids]
+
+        for start in range(0, len(trip_ids), batch_size):
+            batch = []
+
+            with database.lock:
+                for trip_id in trip_ids[start:start + batch_size]:
+                    trip = self._find(trip_id)
+                    if trip:
+                        batch.append({
+                            '_id': trip['_id'],
+                            'start_date': trip['start_date'],
+                            'summary': deepcopy(trip.get('summary'))
+                        })
+
+            if batch:
+                yield batch
+
+    @staticmethod
+    def _listing_row(trip):
+        """ Returns a trip as it is shown in the trips listing. """
+        summary = trip.get('summary') or EMPTY_SUMMARY
+
+        row = {field: trip[field] for field in LISTING_FIELDS if field in trip}
+        row.update({
+            'number_of_stops': summary['number_of_stops'],
+            'duration': summary['duration'],
+            'total_cost': trip['travelers'] * (summary['total_accom_pp'] +
+                                               summary['total_food_pp'] +
+                                               summary['total_other_pp']),
+            'countries': list(summary['countries'])
+        })
+        if 'owner_display_name' in trip:
+            row['username'] = trip['owner_display_name']
+
+        return row
+
+    def listing(self, user_id, show, after, before, limit, dates=None):
+        """
+        Returns up to limit trips of the trips listing (see
+        listing.trips_pipeline), in the order they are paged. The trips are
+        read from the sorted listing keys, starting from the page cursor and
+        within the start date bounds of any date filter, so only the trips on
+        the page (and those hidden from the user) are looked at.
+        """
+        database = self.database
+        start_from, start_to, end_from = dates or (None, None, None)
+        rows = []
+
+        with database.lock:
+            if show == 'user':
+                keys = database.owner_listing.get(user_id, [])
+            else:
+                keys = database.listing
+
+            # the keys with a start date within the bounds
+            low = bisect_left(keys, (start_from,)) if start_from else 0
+            high = bisect_right(keys, (start_to, LAST_ID)) if start_to \
+                else len(keys)
+
+            for index in self._page_indexes(keys, after, before, low, high):
+                if len(rows) == limit:
+                    break
+
+                trip = database.trips[keys[index][1]]
+                if end_from and trip['end_date'] < end_from:
+                    continue
+                if show == 'user' or trip['public'] or \
+                        trip['owner_id'] == user_id:
+                    rows.append(self._listing_row(trip))
+
+        return rows
+
+    @staticmethod
+    def _page_indexes(keys, after, before, low=0, high=None):
+        """ Returns the indexes of the listing keys from low to high (or the
+        end) which come after the page cursor, in the order they are paged -
+        paging backwards reads the keys in reverse, from the cursor. """
+        if high is None:
+            high = len(keys)
+
+        if before:
+            start = min(bisect_left(keys, tuple(before)), high)
+            return range(start - 1, low - 1, -1)
+
+        start = bisect_right(keys, tuple(after)) if after else 0
+        return range(max(start, low), high)
+
+    def text_search(self, user_id, text, after, before, limit):
+        """
+        Returns up to limit of the trips user_id can see matching a text
+        search (see search.text_search_pipeline), in the order they are
+        paged. As with the text index, a trip matches if its name, countries
+        or cities contain any of the words in text, ignoring case and
+        accents. The trips are read from the sorted listing keys, starting
+        from the page cursor.
+        """
+        database = self.database
+        words = text_words(text)
+        rows = []
+
+        with database.lock:
+            keys = database.listing
+
+            for index in self._page_indexes(keys, after, before):
+                if len(rows) == limit:
+                    break
+
+                trip = database.trips[keys[index][1]]
+                if not (trip['public'] or trip['owner_id'] == user_id):
+                    continue
+
+                summary = trip.get('summary') or EMPTY_SUMMARY
+                if words & text_words(' '.join(
+                        [trip['name']] + summary['countries'] +
+                        summary.get('cities', []))):
+                    rows.append(self._listing_row(trip))
+
+        return rows
+
+    def search(self, user_id, search, after, before, limit):
+        """
+        Returns up to limit of the trips user_id can see with a stop
+        matching search (see search.stop_filter), in the order they are
+        paged. The stops of the country (or city or town) are read from its
+        search keys, which are in the order the trips are paged, from the
+        cursor - so only the stops up to the end of the page are read, and
+        only the trips on the page are looked up.
+        """
+        database = self.database
+        date_from, date_to = search['date_from'], search['date_to']
+        # the search keys of the cursor trip are all before this
+        after = after and tuple(after) + (LAST_ID,)
+
+        with database.lock:
+            keys = database.stop_dates.get(
+                (search['country'], search['city_town'])
+                if search['city_town'] else (search['country'],), [])
+
+            trip_ids = []
+            for index in self._page_indexes(keys, after, before):
+                trip_id = keys[index][1]
+                if trip_ids and trip_ids[-1] == trip_id:
+                    continue
+
+                stop = database.stops[keys[index][2]]
+                if stop.get('trip_deleted') or \
+                        not (stop['trip_public'] or
+                             stop['trip_owner_id'] == user_id):
+                    continue
+                # the stop is on the trip between the dates
+                if date_to and not stop['start_date'] <= date_to or \
+                        date_from and not stop['end_date'] >= date_from:
+                    continue
+
+                trip_ids.append(trip_id)
+                if len(trip_ids) == limit:
+                    break
+
+            return [self._listing_row(trip) for trip in
+                    map(self._find, trip_ids) if trip]
+
+    @staticmethod
+    def detail(trip_id):
+        """ Returns the trip overview and stops for trip_detailed. Returns
+        (None, None) if the trip does not exist. """
+        return build_trip_detail(trip_id)
+
+    def with_stops(self, user_id=None, everything=False, batch_size=500,
+                   owned=False):
+        """ Generator which yields the trips user_id can see (or every trip
+        if everything is True, or only the trips user_id owns if owned is
+        True) in _id order, each with a list of its stops. """
+        database = self.database
+
+        with database.lock:
+            trip_ids = sorted(database.trips)
+
+        for trip_id in trip_ids:
+            with database.lock:
+                trip = self._find(trip_id)
+                if not trip or owned and trip['owner_id'] != user_id or \
+                        not (everything or trip['public'] or
+                             trip['owner_id'] == user_id):
+                    continue
+
+                trip = _copy(trip)
+                trip['stops'] = [_copy(database.stops[stop_id]) for stop_id
+                                 in database.trip_stop_ids(trip_id)]
+
+            yield trip
+
+    def deleted_ids(self):
+        """ Returns the _id's of the trips which are marked as deleted. """
+        with self.database.lock:
+            return [trip_id for trip_id, trip in self.database.trips.items()
+                    if 'deleted_at' in trip]
+
+    def record_purge_progress(self, trip_id, stops_removed):
+        """ Adds a batch of removed stops to the purge progress of a
+        trip. """
+        def change(trip):
+            purge = trip.setdefault('purge', {})
+            purge['stops_removed'] = purge.get('stops_removed', 0) + \
+                stops_removed
+            purge['batches'] = purge.get('batches', 0) + 1
+            purge['updated_at'] = utc_now()
+
+        self._change(trip_id, change)
+
+    def remove_if_deleted(self, trip_id):
+        """ Removes a trip, only if it is still marked as deleted. """
+        with self.database.lock:
+            trip = self.database.trips.get(ObjectId(trip_id))
+            if trip and 'deleted_at' in trip:
+                self.remove(trip_id)
+
+    def set_owner_display_names(self, names):
+        """ Sets the owner display name on every trip of each owner - names
+        is a dict of owner_id to display name. """
+        names = {ObjectId(owner_id): name for owner_id, name in names.items()}
+
+        with self.database.lock:
+            for trip in self.database.trips.values():
+                if trip['owner_id'] in names:
+                    trip['owner_display_name'] = names[trip['owner_id']]
+
+    def owners_without_display_name(self):
+        """ Returns the owner_id's of the trips which do not have the owner
+        display name. """
+        with self.database.lock:
+            return list(dict.fromkeys(
+                trip['owner_id'] for trip in self.database.trips.values()
+                if 'owner_display_name' not in trip))
+
+    def ids_without_cities(self):
+        """ Returns the _id's of the trips whose summary does not list their
+        cities, i.e. those last summarised before the cities were stored. """
+        with self.database.lock:
+            return [trip['_id'] for trip in self.database.trips.values()
+                    if 'deleted_at' not in trip and
+                    'cities' not in (trip.get('summary') or {})]
+
+
+class MemoryStopStore:
+    """ Stops, held in memory. """
+
+    def __init__(self, database):
+        self.database = database
+
+    def find(self, stop_id):
+        """ Returns a stop, or None. """
+        with self.database.lock:
+            return _copy(self.database.stops.get(ObjectId(stop_id)))
+
+    def for_trip(self, trip_id, batch_size=0):
+        """ Returns the stops of a trip, in the order they were added. """
+        database = self.database
+
+        with database.lock:
+            return [_copy(database.stops[stop_id])
+                    for stop_id in database.trip_stop_ids(trip_id)]
+
+    def insert(self, stop):
+        """ Adds a stop and returns its _id. """
+        database = self.database
+        stop.setdefault('_id', ObjectId())
+
+        with database.lock:
+            if stop['_id'] in database.stops:
+                raise DuplicateKeyError('Stop %s already exists.'
+                                        % stop['_id'])
+
+            database.stops[stop['_id']] = _copy(stop)
+            database.index_stop(stop)
+
+        return stop['_id']
+
+    def insert_many(self, stops, ordered=True):
+        """ Adds stops. """
+        for stop in stops:
+            self.insert(stop)
+
+    def update(self, stop_id, fields):
+        """ Sets fields on a stop, returning the stop as it was before the
+        update (or None if it does not exist). """
+        database = self.database
+
+        with database.lock:
+            stop = database.stops.get(ObjectId(stop_id))
+            if not stop:
+                return None
+
+            old_stop = _copy(stop)
+            database.unindex_stop(stop)
+            stop.update(_copy(fields))
+            database.index_stop(stop)
+
+        return old_stop
+
+    def delete(self, stop_id, trip_id):
+        """ Removes a stop of a trip, returning the removed stop (or None if
+        it does not exist). """
+        database = self.database
+
+        with database.lock:
+            stop = database.stops.get(ObjectId(stop_id))
+            if not stop or stop['trip_id'] != ObjectId(trip_id):
+                return None
+
+            del database.stops[stop['_id']]
+            database.unindex_stop(stop)
+
+        return stop
+
+    def delete_many(self, stop_ids):
+        """ Removes stops, returning the number removed. """
+        database = self.database
+        removed = 0
+
+        with database.lock:
+            for stop_id in stop_ids:
+                stop = database.stops.pop(ObjectId(stop_id), None)
+                if stop:
+                    database.unindex_stop(stop)
+                    removed += 1
+
+        return removed
+
+    def delete_for_trip(self, trip_id):
+        """ Removes every stop of a trip. """
+        with self.database.lock:
+            self.delete_many(list(self.database.trip_stop_ids(trip_id)))
+
+    def ids_for_trip(self, trip_id, limit=0):
+        """ Returns the _id's of up to limit stops of a trip (0 is no
+        limit). """
+        with self.database.lock:
+            return self.database.trip_stop_ids(trip_id)[:limit or None]
+
+    def country_in_use(self, trip_id, country):
+        """ Checks if any stops of a trip are in a given country. """
+        database = self.database
+
+        with database.lock:
+            return any(database.stops[stop_id]['country'] == country
+                       for stop_id in database.trip_stop_ids(trip_id))
+
+    def city_in_use(self, trip_id, city_town):
+        """ Checks if any stops of a trip are in a given city or town. """
+        database = self.database
+
+        with database.lock:
+            return any(database.stops[stop_id]['city_town'] == city_town
+                       for stop_id in database.trip_stop_ids(trip_id))
+
+    def total_duration(self, trip_id):
+        """ Returns the total duration of the stops of a trip. """
+        database = self.database
+
+        with database.lock:
+            return sum(database.stops[stop_id]['duration']
+                       for stop_id in database.trip_stop_ids(trip_id))
+
+    def summaries(self, trip_ids):
+        """ Returns a dict of trip_id to the summary calculated from its
+        stops - trips without any stops are not included. """
+        database = self.database
+        summaries = {}
+
+        with database.lock:
+            for trip_id in trip_ids:
+                stop_ids = database.trip_stop_ids(trip_id)
+                if not stop_ids:
+                    continue
+
+                summary = dict.fromkeys(TOTAL_FIELDS, 0)
+                countries, cities = {}, {}
+                for stop_id in stop_ids:
+                    stop = database.stops[stop_id]
+                    for field, value in stop_totals(stop).items():
+                        summary[field] += value
+                    # countries and cities are listed in the order stops
+                    # were added
+                    countries.setdefault(stop['country'])
+                    cities.setdefault(stop['city_town'])
+
+                summary['countries'] = list(countries)
+                summary['cities'] = list(cities)
+                summaries[ObjectId(trip_id)] = summary
+
+        return summaries
+
+    def date_chain(self, trip_id, from_stop_id=None):
+        """ Returns the _id, duration, dates and trip fields (see
+        stop_dates.TRIP_FIELDS) of the stops of a trip from from_stop_id
+        onwards (or every stop), in the order they were added, preceded by
+        the stop before from_stop_id if there is one. """
+        database = self.database
+        fields = ('_id', 'duration', 'start_date', 'end_date') + \
+            tuple(TRIP_FIELDS)
+
+        with database.lock:
+            stop_ids = database.trip_stop_ids(trip_id)
+            start = bisect_left(stop_ids, ObjectId(from_stop_id)) \
+                if from_stop_id else 0
+
+            return [{field: database.stops[stop_id][field]
+                     for field in fields if field in database.stops[stop_id]}
+                    for stop_id in stop_ids[max(start - 1, 0):]]
+
+    def set_dates(self, dates, trip_fields=None):
+        """ Sets the dates of stops, along with any trip_fields (see
+        stop_dates.trip_fields) - dates is a list of (stop_id, start_date,
+        end_date). """
+        database = self.database
+
+        with database.lock:
+            for stop_id, start_date, end_date in dates:
+                stop = database.stops.get(ObjectId(stop_id))
+                if stop:
+                    database.unindex_stop(stop)
+                    stop.update(trip_fields or {}, start_date=start_date,
+                                end_date=end_date)
+                    database.index_stop(stop)
+
+    def mark_trip_deleted(self, trip_id):
+        """ Marks the stops of a deleted trip, so the trip search skips them
+        until they are purged. """
+        database = self.database
+
+        with database.lock:
+            for stop_id in database.trip_stop_ids(trip_id):
+                database.stops[stop_id]['trip_deleted'] = True
+
+    def trip_ids_without_dates(self):
+        """ Returns the trip_id's which have stops without dates or the trip
+        fields. """
+        fields = ('start_date',) + tuple(TRIP_FIELDS)
+
+        with self.database.lock:
+            return list({stop['trip_id']
+                         for stop in self.database.stops.values()
+                         if any(field not in stop for field in fields)})
+
+    def value_counts(self, field):
+        """ Returns a dict of each value of a stop field to the number of
+        stops with it (see autocomplete.value_counts_pipeline). """
+        with self.database.lock:
+            return dict(Counter(stop[field] for stop in
+                                self.database.stops.values()
+                                if stop.get(field)))
+
+    def orphaned_trip_ids(self):
+        """ Returns the trip_id's which have stops but no trip. """
+        database = self.database
+
+        with database.lock:
+            return [trip_id for trip_id in database.trip_stops
+                    if trip_id not in database.trips]
+
+
+class MemoryMetaStore:
+    """ Change stamps, held in memory. """
+
+    def __init__(self, database):
+        self.database = database
+
+    def record_change(self, owner_id=None):
+        """ Bumps the change stamp for the trips listings, and the owner's
+        stamp (or the stamp of every owner if owner_id is None), returning
+        the new listings stamp. """
+        meta = self.database.meta
+
+        with self.database.lock:
+            for stamp_id in (owner_stamp_id(owner_id), 'trips'):
+                stamp = meta.setdefault(stamp_id, {'_id': stamp_id,
+                                                   'version': 0})
+                stamp['version'] += 1
+                stamp['updated_at'] = utc_now()
+
+            return dict(stamp)
+
+    def owner_version(self, owner_id):
+        """ Returns the versions of the stamp of every owner and of the
+        owner's own stamp, which are 0 until they are first bumped. """
+        with self.database.lock:
+            return tuple(self.database.meta.get(stamp_id, {}).get('version', 0)
+                         for stamp_id in (owner_stamp_id(None),
+                                          owner_stamp_id(owner_id)))
+
+    def last_change(self):
+        """ Returns the change stamp for the trips listings, or None if
+        nothing has been written yet. """
+        with self.database.lock:
+            return _copy(self.database.meta.get('trips'))
+
+
+class MemoryStores:
+    """ The stores for an app which keeps its data in memory - every app
+    has its own. """
+
+    def __init__(self):
+        database = MemoryDatabase()
+        self.users = MemoryUserStore(database)
+        self.trips = MemoryTripStore(database)
+        self.stops = MemoryStopStore(database)
+        self.meta = MemoryMetaStore(database)
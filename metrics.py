@@ -0,0 +1,339 @@
+""" This records metrics for every request - the count, latency and response
+size by endpoint, and how many MongoDB commands each request issued and how
+much of its time was spent in MongoDB and in rendering templates. They are
+served in the Prometheus text format by /metrics.
+
+The metrics are kept by each worker process and labelled with its pid. With
+METRICS_DIR set, each worker also writes them to a file in that directory
+every WRITE_INTERVAL seconds, from a background thread rather than while
+handling a request, so /metrics reports every worker whichever one serves
+the scrape rather than only its own. """
+import glob
+import json
+import logging
+import os
+from threading import Event, Lock, Thread
+from time import perf_counter
+from flask import request, g
+from jinja2 import Template
+from monitoring import Histogram, LATENCY_BUCKETS, COMMAND_STATS, \
+    POOL_STATS, start_request_counters, add_render_time, \
+    finish_request_counters
+
+# upper bounds (in bytes) of the response size histogram buckets
+SIZE_BUCKETS = (512, 1024, 4096, 16384, 65536, 262144, 1048576)
+
+# upper bounds of the number of MongoDB commands per request buckets
+COMMAND_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50)
+
+# time (in seconds) between writes of a worker's metrics to METRICS_DIR
+WRITE_INTERVAL = 1.0
+
+
+class RequestMetrics:
+    """ Holds the metrics for each endpoint. """
+
+    def __init__(self):
+        self._lock = Lock()
+        # (endpoint, method, status) -> count
+        self.requests = {}
+        # endpoint -> Histogram, for each metric
+        self.latency = {}
+        self.size = {}
+        self.db_commands = {}
+        self.db_ms = {}
+        self.render_ms = {}
+
+    @staticmethod
+    def _histogram(histograms, endpoint, bounds):
+        """ Returns the histogram for an endpoint, creating it if needed. """
+        histogram = histograms.get(endpoint)
+        if histogram is None:
+            histogram = histograms[endpoint] = Histogram(bounds)
+        return histogram
+
+    def record(self, endpoint, method, status, milliseconds, size, counters):
+        """ Records a finished request. size is None if it is not known,
+        e.g. for streamed responses. """
+        with self._lock:
+            key = (endpoint, method, status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+
+            self._histogram(self.latency, endpoint,
+                            LATENCY_BUCKETS).add(milliseconds)
+            if size is not None:
+                self._histogram(self.size, endpoint, SIZE_BUCKETS).add(size)
+
+            self._histogram(self.db_commands, endpoint,
+                            COMMAND_BUCKETS).add(counters['db_commands'])
+            self._histogram(self.db_ms, endpoint,
+                            LATENCY_BUCKETS).add(counters['db_ms'])
+            self._histogram(self.render_ms, endpoint,
+                            LATENCY_BUCKETS).add(counters['render_ms'])
+
+    def snapshot(self):
+        """ Returns a copy of the metrics, taken under the lock. """
+        with self._lock:
+            return {
+                'requests': dict(self.requests),
+                'latency': {endpoint: histogram.stats() for endpoint, histogram
+                            in self.latency.items()},
+                'size': {endpoint: histogram.stats() for endpoint, histogram
+                         in self.size.items()},
+                'db_commands': {endpoint: histogram.stats() for endpoint,
+                                histogram in self.db_commands.items()},
+                'db_ms': {endpoint: histogram.stats() for endpoint, histogram
+                          in self.db_ms.items()},
+                'render_ms': {endpoint: histogram.stats() for endpoint,
+                              histogram in self.render_ms.items()}
+            }
+
+
+REQUESTS = RequestMetrics()
+
+# the thread writing this process's metrics to METRICS_DIR, and the event
+# which stops it
+_writer = {'thread': None}
+_stop_writing = Event()
+
+
+class TimedTemplate(Template):
+    """ Template which adds the time it takes to render to the counters of
+    the request being handled. """
+
+    def render(self, *args, **kwargs):
+        started = perf_counter()
+        try:
+            return super().render(*args, **kwargs)
+        finally:
+            add_render_time((perf_counter() - started) * 1000)
+
+
+def init_app(app):
+    """ Times template rendering and records the metrics for every request
+    handled by the app. """
+    app.jinja_env.template_class = TimedTemplate
+    app.before_request(start_request_metrics)
+    app.after_request(record_request_metrics)
+
+
+def start_request_metrics():
+    """ Records when the request started and starts counting its MongoDB
+    commands and template rendering. """
+    g.metrics_started = perf_counter()
+    start_request_counters()
+
+
+def record_request_metrics(response):
+    """ Records the metrics for the finished request. """
+    started = g.get('metrics_started')
+    counters = finish_request_counters()
+
+    if started is not None and counters is not None:
+        endpoint = request.url_rule.endpoint if request.url_rule else 'none'
+        size = None if response.is_streamed else \
+            response.calculate_content_length()
+
+        REQUESTS.record(endpoint, request.method, response.status_code,
+                        (perf_counter() - started) * 1000, size, counters)
+
+    return response
+
+
+# metrics of each worker process
+
+
+def snapshot():
+    """ Returns the metrics of this process, in a form which can be written
+    as JSON. """
+    metrics = REQUESTS.snapshot()
+    metrics['requests'] = [list(key) + [count] for key, count
+                           in metrics['requests'].items()]
+    metrics['commands'] = COMMAND_STATS.stats()
+    metrics['pool'] = POOL_STATS.stats()
+    return metrics
+
+
+def _snapshot_path(directory, worker):
+    """ Returns the file a worker's metrics are written to. """
+    return os.path.join(directory, 'worker-%s.json' % worker)
+
+
+def write_snapshot(directory):
+    """ Writes the metrics of this process to its file in directory - the
+    file is replaced in one step, so it is never read half written. """
+    path = _snapshot_path(directory, os.getpid())
+    partial = path + '.tmp'
+
+    with open(partial, 'w') as snapshot_file:
+        json.dump(snapshot(), snapshot_file)
+    os.replace(partial, path)
+
+
+def _write_snapshots(directory):
+    """ Writes the metrics of this process to directory every
+    WRITE_INTERVAL seconds until the writer is stopped. """
+    while True:
+        try:
+            write_snapshot(directory)
+        except OSError:
+            logging.getLogger(__name__).exception(
+                'Writing the metrics to %s failed.', directory)
+
+        if _stop_writing.wait(WRITE_INTERVAL):
+            return
+
+
+def start_writer(directory):
+    """ Starts writing the metrics of this process to directory in the
+    background (see wsgi.py), so requests do not wait for the file to be
+    written. """
+    if _writer['thread'] is not None and _writer['thread'].is_alive():
+        return
+
+    _stop_writing.clear()
+    _writer['thread'] = Thread(target=_write_snapshots, args=(directory,),
+                               name='metrics-writer', daemon=True)
+    _writer['thread'].start()
+
+
+def remove_snapshot(directory):
+    """ Stops writing the metrics of this process and removes its file, once
+    it has stopped. """
+    _stop_writing.set()
+    if _writer['thread'] is not None:
+        _writer['thread'].join()
+        _writer['thread'] = None
+
+    try:
+        os.remove(_snapshot_path(directory, os.getpid()))
+    except FileNotFoundError:
+        pass
+
+
+def worker_snapshots(directory=None):
+    """ Returns the metrics of each worker, by pid - those written to
+    directory by the other workers, and this process's own. """
+    snapshots = {}
+
+    for path in glob.glob(_snapshot_path(directory, '*')) \
+            if directory else []:
+        worker = os.path.basename(path)[len('worker-'):-len('.json')]
+        try:
+            with open(path) as snapshot_file:
+                snapshots[worker] = json.load(snapshot_file)
+        # removed by a worker which has stopped since it was listed
+        except (OSError, ValueError):
+            continue
+
+    snapshots[str(os.getpid())] = snapshot()
+    return snapshots
+
+
+# Prometheus text format
+
+
+def _labels(**labels):
+    """ Formats the labels of a sample, escaping the values. """
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, str(value).replace('\\', '\\\\')
+                     .replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in sorted(labels.items()))
+
+
+def _histogram_lines(name, label, histograms, worker, scale=1.0):
+    """ Returns the sample lines of a worker's histogram metric for each
+    label value. Bucket bounds and the sum are multiplied by scale, e.g. to
+    convert milliseconds to seconds. """
+    lines = []
+
+    for value, stats in sorted(histograms.items()):
+        cumulative = 0
+        for bound, count in stats['buckets'].items():
+            cumulative += count
+            upper = bound if bound == '+Inf' else repr(float(bound) * scale)
+            lines.append('%s_bucket%s %d' % (
+                name, _labels(**{label: value, 'le': upper,
+                                 'worker': worker}), cumulative))
+
+        lines.append('%s_sum%s %r' % (
+            name, _labels(**{label: value, 'worker': worker}),
+            stats['total'] * scale))
+        lines.append('%s_count%s %d' % (
+            name, _labels(**{label: value, 'worker': worker}),
+            stats['count']))
+
+    return lines
+
+
+def _metric(name, metric_type, description, lines):
+    """ Returns a metric with its HELP and TYPE lines. """
+    return ['# HELP %s %s' % (name, description),
+            '# TYPE %s %s' % (name, metric_type)] + lines
+
+
+def _histogram_metric(name, description, label, key, snapshots, scale=1.0):
+    """ Returns a histogram metric with the histograms under key in every
+    worker's snapshot. """
+    lines = []
+    for worker, metrics in sorted(snapshots.items()):
+        lines += _histogram_lines(name, label, metrics[key], worker, scale)
+
+    return _metric(name, 'histogram', description, lines)
+
+
+def prometheus_text(snapshots):
+    """ Returns the metrics of every worker in snapshots (see
+    worker_snapshots()) in the Prometheus text exposition format. """
+    workers = sorted(snapshots.items())
+
+    output = []
+    output += _metric(
+        'travelpal_http_requests_total', 'counter',
+        'Requests handled, by endpoint, method and status code.',
+        ['travelpal_http_requests_total%s %d' % (
+            _labels(endpoint=endpoint, method=method, status=status,
+                    worker=worker), count)
+         for worker, metrics in workers
+         for endpoint, method, status, count
+         in sorted(metrics['requests'])])
+    output += _histogram_metric(
+        'travelpal_http_request_duration_seconds',
+        'Time taken to handle a request, by endpoint.',
+        'endpoint', 'latency', snapshots, scale=0.001)
+    output += _histogram_metric(
+        'travelpal_http_response_size_bytes',
+        'Size of the response body, by endpoint.',
+        'endpoint', 'size', snapshots)
+    output += _histogram_metric(
+        'travelpal_request_db_commands',
+        'MongoDB commands issued by a request, by endpoint.',
+        'endpoint', 'db_commands', snapshots)
+    output += _histogram_metric(
+        'travelpal_request_db_seconds',
+        'Time a request spent waiting on MongoDB commands, by endpoint.',
+        'endpoint', 'db_ms', snapshots, scale=0.001)
+    output += _histogram_metric(
+        'travelpal_request_render_seconds',
+        'Time a request spent rendering templates, by endpoint.',
+        'endpoint', 'render_ms', snapshots, scale=0.001)
+    output += _histogram_metric(
+        'travelpal_mongo_command_duration_seconds',
+        'Time taken by MongoDB commands, by command name.',
+        'command', 'commands', snapshots, scale=0.001)
+    output += _metric(
+        'travelpal_mongo_pool_connections', 'gauge',
+        'Connections to MongoDB, by state.',
+        ['travelpal_mongo_pool_connections%s %d' % (
+            _labels(state=state, worker=worker), metrics['pool'][state])
+         for worker, metrics in workers
+         for state in ('open', 'in_use')])
+    output += _histogram_metric(
+        'travelpal_mongo_pool_checkout_wait_seconds',
+        'Time spent waiting to check out a connection from the pool.',
+        'pool', 'checkout_wait', {
+            worker: {'checkout_wait': {'default':
+                                       metrics['pool']['checkout_wait']}}
+            for worker, metrics in workers}, scale=0.001)
+
+    return '\n'.join(output) + '\n'
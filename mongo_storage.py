@@ -0,0 +1,455 @@
+""" This stores the app's data in MongoDB (see storage.py for the methods every
+set of stores has). The queries are the aggregation and update pipelines built
+by the modules which use them - this runs them against the collections in
+util.py, so they are timed for the slow query log. """
+from bson.objectid import ObjectId
+from pymongo import ReturnDocument, UpdateOne, UpdateMany
+from util import USERS, TRIPS, STOPS, META, NOT_DELETED, \
+    trip_and_stop_pipeline, trip_duration_pipeline, utc_now, owner_stamp_id
+from listing import trips_pipeline
+from detail import WINDOW_FUNCTIONS_VERSION, server_version, \
+    trip_detail_pipeline, build_trip_detail
+from summary import END_DATE_STAGE, summary_update_pipeline, \
+    summaries_pipeline
+from export import export_pipeline, visible_trips
+from purge import orphaned_stops_pipeline
+from search import SEARCH_BATCH_SIZE, first_trip_ids, \
+    search_stops_pipeline, search_trips_pipeline, text_search_pipeline
+from stop_dates import TRIP_FIELDS
+from autocomplete import value_counts_pipeline
+
+
+class MongoUserStore:
+    """ Users, in the users collection. """
+
+    @staticmethod
+    def find(user_id):
+        """ Returns a user, or None. """
+        return USERS.find_one({'_id': ObjectId(user_id)})
+
+    @staticmethod
+    def insert(user):
+        """ Adds a user and returns its _id. """
+        return USERS.insert_one(user).inserted_id
+
+    @staticmethod
+    def insert_many(users, ordered=True):
+        """ Adds users - if ordered is False, they may be written in any
+        order. """
+        USERS.insert_many(users, ordered=ordered)
+
+    @staticmethod
+    def update(user_id, fields):
+        """ Sets fields on a user. """
+        USERS.update_one({'_id': ObjectId(user_id)}, {'$set': fields})
+
+    @staticmethod
+    def find_by_username(username):
+        """ Returns the user with a username, or None. """
+        return USERS.find_one({'username': username})
+
+    @staticmethod
+    def display_names(user_ids):
+        """ Returns a dict of user _id to display name for the users in
+        user_ids which exist. """
+        return {user['_id']: user['display_name'] for user in
+                USERS.find({'_id': {'$in': list(user_ids)}},
+                           {'display_name': 1})}
+
+
+class MongoTripStore:
+    """ Trips, in the trips collection. """
+
+    @staticmethod
+    def find(trip_id):
+        """ Returns a trip which has not been deleted, or None. """
+        return TRIPS.find_one(dict(NOT_DELETED, _id=ObjectId(trip_id)))
+
+    @staticmethod
+    def find_with_stop(trip_id, stop_id):
+        """ Returns a trip along with one of its stops as a (trip, stop)
+        tuple, in one query - either is None if it does not exist. """
+        trip = next(TRIPS.aggregate(trip_and_stop_pipeline(trip_id,
+                                                           stop_id)), None)
+        if not trip:
+            return None, None
+
+        stop = trip.pop('stop')
+        return trip, stop[0] if stop else None
+
+    @staticmethod
+    def insert(trip):
+        """ Adds a trip and returns its _id. """
+        return TRIPS.insert_one(trip).inserted_id
+
+    @staticmethod
+    def insert_many(trips, ordered=True):
+        """ Adds trips - if ordered is False, they may be written in any
+        order. """
+        TRIPS.insert_many(trips, ordered=ordered)
+
+    @staticmethod
+    def update(trip_id, fields):
+        """ Sets fields on a trip. """
+        TRIPS.update_one({'_id': ObjectId(trip_id)}, {'$set': fields})
+
+    @staticmethod
+    def update_many(updates):
+        """ Sets fields on many trips at once - updates is a list of
+        (trip_id, fields). """
+        if updates:
+            TRIPS.bulk_write([UpdateOne({'_id': ObjectId(trip_id)},
+                                        {'$set': fields})
+                              for trip_id, fields in updates], ordered=False)
+
+    @staticmethod
+    def remove(trip_id):
+        """ Removes a trip straight away, whether or not it is deleted. """
+        TRIPS.delete_one({'_id': ObjectId(trip_id)})
+
+    @staticmethod
+    def update_summary(trip_id, totals, add_country=None, remove_country=None,
+                       add_city=None, remove_city=None):
+        """ Applies the change in totals (and countries and cities) to the
+        summary of a trip and recalculates its end date, as a single
+        update. """
+        TRIPS.update_one({'_id': ObjectId(trip_id)},
+                         summary_update_pipeline(totals, add_country,
+                                                 remove_country, add_city,
+                                                 remove_city))
+
+    @staticmethod
+    def update_end_date(trip_id):
+        """ Recalculates the end date of a trip from its start date and
+        summary. """
+        TRIPS.update_one({'_id': ObjectId(trip_id)}, [END_DATE_STAGE])
+
+    @staticmethod
+    def summary_batches(batch_size, trip_ids=None):
+        """ Generator which yields the trips which have not been deleted
+        (or those of them in trip_ids) in batches of batch_size - only their
+        _id, start_date and summary are read. """
+        query = dict(NOT_DELETED)
+        if trip_ids is not None:
+            query['_id'] = {'$in': [ObjectId(trip_id) for trip_id in trip_ids]}
+
+        batch = []
+        for trip in TRIPS.find(query, {'start_date': 1, 'summary': 1},
+                               batch_size=batch_size):
+            batch.append(trip)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+
+        if batch:
+            yield batch
+
+    @staticmethod
+    def listing(user_id, show, after, before, limit, dates=None):
+        """ Returns up to limit trips of the trips listing (see
+        listing.trips_pipeline), in the order they are paged. """
+        return list(TRIPS.aggregate(trips_pipeline(user_id, show, after,
+                                                   before, limit, dates)))
+
+    @staticmethod
+    def search(user_id, search, after, before, limit):
+        """ Returns up to limit of the trips user_id can see with a stop
+        matching search, in the order they are paged. The matching stops are
+        read from the index in page order only until limit trips have been
+        found (see search.search_stops_pipeline), and then only those trips
+        are read. """
+        with STOPS.aggregate(search_stops_pipeline(user_id, search, after,
+                                                   before),
+                             batchSize=SEARCH_BATCH_SIZE) as stops:
+            trip_ids = first_trip_ids(stops, limit)
+
+        if not trip_ids:
+            return []
+
+        return list(TRIPS.aggregate(search_trips_pipeline(
+            user_id, trip_ids, after, before, limit)))
+
+    @staticmethod
+    def text_search(user_id, text, after, before, limit):
+        """ Returns up to limit of the trips user_id can see matching a text
+        search (see search.text_search_pipeline), in the order they are
+        paged. """
+        return list(TRIPS.aggregate(text_search_pipeline(user_id, text, after,
+                                                         before, limit)))
+
+    @staticmethod
+    def detail(trip_id):
+        """ Returns the trip overview and stops for trip_detailed, using the
+        aggregation if the server supports it and the Python loop if not.
+        Returns (None, None) if the trip does not exist. """
+        if server_version() < WINDOW_FUNCTIONS_VERSION:
+            return build_trip_detail(trip_id)
+
+        trip_detail = next(TRIPS.aggregate(trip_detail_pipeline(trip_id)),
+                           None)
+        if not trip_detail:
+            return None, None
+
+        stops_detail = trip_detail.pop('stops')
+        return trip_detail, stops_detail
+
+    @staticmethod
+    def with_stops(user_id=None, everything=False, batch_size=500,
+                   owned=False):
+        """ Returns a cursor of the trips user_id can see (or every trip if
+        everything is True, or only the trips user_id owns if owned is True)
+        in _id order, each with a list of its stops. """
+        if owned:
+            query = {'owner_id': user_id}
+        else:
+            query = None if everything else visible_trips(user_id)
+        return TRIPS.aggregate(export_pipeline(query), batchSize=batch_size,
+                               allowDiskUse=True)
+
+    @staticmethod
+    def deleted_ids():
+        """ Returns the _id's of the trips which are marked as deleted. """
+        return [trip['_id'] for trip in
+                TRIPS.find({'deleted_at': {'$exists': True}}, {'_id': 1})]
+
+    @staticmethod
+    def record_purge_progress(trip_id, stops_removed):
+        """ Adds a batch of removed stops to the purge progress of a
+        trip. """
+        TRIPS.update_one({'_id': ObjectId(trip_id)}, {
+            '$inc': {'purge.stops_removed': stops_removed, 'purge.batches': 1},
+            '$set': {'purge.updated_at': utc_now()}
+        })
+
+    @staticmethod
+    def remove_if_deleted(trip_id):
+        """ Removes a trip, only if it is still marked as deleted. """
+        TRIPS.delete_one({'_id': ObjectId(trip_id),
+                          'deleted_at': {'$exists': True}})
+
+    @staticmethod
+    def set_owner_display_names(names):
+        """ Sets the owner display name on every trip of each owner - names
+        is a dict of owner_id to display name. Each owner's trips are changed
+        with a single update_many. """
+        if names:
+            TRIPS.bulk_write([
+                UpdateMany({'owner_id': owner_id},
+                           {'$set': {'owner_display_name': name}})
+                for owner_id, name in names.items()], ordered=False)
+
+    @staticmethod
+    def owners_without_display_name():
+        """ Returns the owner_id's of the trips which do not have the owner
+        display name. """
+        return TRIPS.distinct('owner_id',
+                              {'owner_display_name': {'$exists': False}})
+
+    @staticmethod
+    def ids_without_cities():
+        """ Returns the _id's of the trips whose summary does not list their
+        cities, i.e. those last summarised before the cities were stored. """
+        return [trip['_id'] for trip in
+                TRIPS.find(dict(NOT_DELETED,
+                                **{'summary.cities': {'$exists': False}}),
+                           {'_id': 1})]
+
+
+class MongoStopStore:
+    """ Stops, in the stops collection. """
+
+    @staticmethod
+    def find(stop_id):
+        """ Returns a stop, or None. """
+        return STOPS.find_one({'_id': ObjectId(stop_id)})
+
+    @staticmethod
+    def for_trip(trip_id, batch_size=0):
+        """ Returns a cursor of the stops of a trip, in the order they were
+        added. """
+        return STOPS.find({'trip_id': ObjectId(trip_id)},
+                          batch_size=batch_size).sort('_id', 1)
+
+    @staticmethod
+    def insert(stop):
+        """ Adds a stop and returns its _id. """
+        return STOPS.insert_one(stop).inserted_id
+
+    @staticmethod
+    def insert_many(stops, ordered=True):
+        """ Adds stops - if ordered is False, they may be written in any
+        order. """
+        STOPS.insert_many(stops, ordered=ordered)
+
+    @staticmethod
+    def update(stop_id, fields):
+        """ Sets fields on a stop, returning the stop as it was before the
+        update (or None if it does not exist). """
+        return STOPS.find_one_and_update({'_id': ObjectId(stop_id)},
+                                         {'$set': fields})
+
+    @staticmethod
+    def delete(stop_id, trip_id):
+        """ Removes a stop of a trip, returning the removed stop (or None if
+        it does not exist). """
+        return STOPS.find_one_and_delete({'_id': ObjectId(stop_id),
+                                          'trip_id': ObjectId(trip_id)})
+
+    @staticmethod
+    def delete_many(stop_ids):
+        """ Removes stops, returning the number removed. """
+        return STOPS.delete_many({'_id': {'$in': list(stop_ids)}}) \
+            .deleted_count
+
+    @staticmethod
+    def delete_for_trip(trip_id):
+        """ Removes every stop of a trip at once. """
+        STOPS.delete_many({'trip_id': ObjectId(trip_id)})
+
+    @staticmethod
+    def ids_for_trip(trip_id, limit=0):
+        """ Returns the _id's of up to limit stops of a trip (0 is no
+        limit). """
+        return [stop['_id'] for stop in
+                STOPS.find({'trip_id': ObjectId(trip_id)}, {'_id': 1})
+                .limit(limit)]
+
+    @staticmethod
+    def country_in_use(trip_id, country):
+        """ Checks if any stops of a trip are in a given country. """
+        return STOPS.find_one({'trip_id': ObjectId(trip_id),
+                               'country': country}, {'_id': 1}) is not None
+
+    @staticmethod
+    def city_in_use(trip_id, city_town):
+        """ Checks if any stops of a trip are in a given city or town. """
+        return STOPS.find_one({'trip_id': ObjectId(trip_id),
+                               'city_town': city_town},
+                              {'_id': 1}) is not None
+
+    @staticmethod
+    def total_duration(trip_id):
+        """ Returns the total duration of the stops of a trip. """
+        result = next(STOPS.aggregate(trip_duration_pipeline(trip_id)), None)
+        return result['total_duration'] if result else 0
+
+    @staticmethod
+    def summaries(trip_ids):
+        """ Returns a dict of trip_id to the summary calculated from its
+        stops - trips without any stops are not included. """
+        summaries = {}
+        for doc in STOPS.aggregate(summaries_pipeline(trip_ids)):
+            trip_id = doc.pop('_id')
+            # remove duplicate countries and cities, keeping the first
+            # occurrence
+            doc['countries'] = list(dict.fromkeys(doc['countries']))
+            doc['cities'] = list(dict.fromkeys(doc['cities']))
+            summaries[trip_id] = doc
+
+        return summaries
+
+    @staticmethod
+    def date_chain(trip_id, from_stop_id=None):
+        """ Returns the _id, duration, dates and trip fields (see
+        stop_dates.TRIP_FIELDS) of the stops of a trip from
+        from_stop_id onwards (or every stop), in the order they were added,
+        preceded by the stop before from_stop_id if there is one. """
+        trip_id = ObjectId(trip_id)
+        fields = dict.fromkeys(('duration', 'start_date', 'end_date') +
+                               tuple(TRIP_FIELDS), 1)
+        query = {'trip_id': trip_id}
+        stops = []
+
+        if from_stop_id:
+            previous = STOPS.find_one(
+                {'trip_id': trip_id, '_id': {'$lt': ObjectId(from_stop_id)}},
+                fields, sort=[('_id', -1)])
+            if previous:
+                stops.append(previous)
+            query['_id'] = {'$gte': ObjectId(from_stop_id)}
+
+        return stops + list(STOPS.find(query, fields).sort('_id', 1))
+
+    @staticmethod
+    def set_dates(dates, trip_fields=None):
+        """ Sets the dates of stops, along with any trip_fields (see
+        stop_dates.trip_fields) - dates is a list of (stop_id, start_date,
+        end_date). """
+        STOPS.bulk_write([UpdateOne({'_id': stop_id},
+                                    {'$set': dict(trip_fields or {},
+                                                  start_date=start_date,
+                                                  end_date=end_date)})
+                          for stop_id, start_date, end_date in dates],
+                         ordered=False)
+
+    @staticmethod
+    def mark_trip_deleted(trip_id):
+        """ Marks the stops of a deleted trip, so the trip search skips them
+        until they are purged. """
+        STOPS.update_many({'trip_id': ObjectId(trip_id)},
+                          {'$set': {'trip_deleted': True}})
+
+    @staticmethod
+    def trip_ids_without_dates():
+        """ Returns the trip_id's which have stops without dates or the trip
+        fields. """
+        return STOPS.distinct('trip_id', {'$or': [
+            {field: {'$exists': False}}
+            for field in ('start_date',) + tuple(TRIP_FIELDS)]})
+
+    @staticmethod
+    def value_counts(field):
+        """ Returns a dict of each value of a stop field to the number of
+        stops with it (see autocomplete.value_counts_pipeline). """
+        return {doc['_id']: doc['count'] for doc in
+                STOPS.aggregate(value_counts_pipeline(field),
+                                allowDiskUse=True)}
+
+    @staticmethod
+    def orphaned_trip_ids():
+        """ Returns the trip_id's which have stops but no trip. """
+        return [orphan['_id'] for orphan in
+                STOPS.aggregate(orphaned_stops_pipeline(), allowDiskUse=True)]
+
+
+class MongoMetaStore:
+    """ Change stamps, in the meta collection. """
+
+    @staticmethod
+    def record_change(owner_id=None):
+        """ Bumps the change stamp for the trips listings, and the owner's
+        stamp (or the stamp of every owner if owner_id is None), returning
+        the new listings stamp. """
+        update = {'$inc': {'version': 1}, '$set': {'updated_at': utc_now()}}
+        META.update_one({'_id': owner_stamp_id(owner_id)}, update,
+                        upsert=True)
+
+        return META.find_one_and_update(
+            {'_id': 'trips'}, update, upsert=True,
+            return_document=ReturnDocument.AFTER)
+
+    @staticmethod
+    def owner_version(owner_id):
+        """ Returns the versions of the stamp of every owner and of the
+        owner's own stamp, which are 0 until they are first bumped. """
+        stamp_ids = [owner_stamp_id(None), owner_stamp_id(owner_id)]
+        versions = {stamp['_id']: stamp['version'] for stamp in
+                    META.find({'_id': {'$in': stamp_ids}})}
+
+        return tuple(versions.get(stamp_id, 0) for stamp_id in stamp_ids)
+
+    @staticmethod
+    def last_change():
+        """ Returns the change stamp for the trips listings, or None if
+        nothing has been written yet. """
+        return META.find_one({'_id': 'trips'})
+
+
+class MongoStores:
+    """ The stores for an app which keeps its data in MongoDB. """
+
+    def __init__(self):
+        self.users = MongoUserStore()
+        self.trips = MongoTripStore()
+        self.stops = MongoStopStore()
+        self.meta = MongoMetaStore()
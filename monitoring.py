@@ -0,0 +1,201 @@
+""" This records how the app uses MongoDB, using pymongo's monitoring
+listeners - the latency of each command, and how long requests wait to check
+out a connection from the pool and how many connections are in use. These
+are used to size the connection pool against the number of workers. """
+from threading import Lock, local
+from time import monotonic
+from pymongo import monitoring
+
+# upper bounds (in milliseconds) of the latency histogram buckets
+LATENCY_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+# counters for the request being handled by each thread
+_REQUEST = local()
+
+
+class Histogram:
+    """ Counts how many values were up to each of the bucket bounds, along
+    with the total and maximum value. The lock of the owner must be held. """
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.buckets = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        """ Records a single value. """
+        for index, bound in enumerate(self.bounds):
+            if value <= bound:
+                break
+        else:
+            index = len(self.bounds)
+
+        self.buckets[index] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def stats(self):
+        """ Returns the figures as a dict. """
+        average = self.total / self.count if self.count else 0
+
+        return {
+            'count': self.count,
+            'total': round(self.total, 3),
+            'avg': round(average, 3),
+            'max': round(self.max, 3),
+            'buckets': dict(zip([str(bound) for bound in self.bounds] +
+                                ['+Inf'], self.buckets))
+        }
+
+
+class CommandStats(monitoring.CommandListener):
+    """ Records the latency of every command sent to MongoDB, by command
+    name (find, aggregate, insert, etc.). """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._latency = {}
+        self._failures = {}
+
+    def _record(self, event, failed=False):
+        """ Adds the duration of a finished command. """
+        with self._lock:
+            histogram = self._latency.get(event.command_name)
+            if histogram is None:
+                histogram = self._latency[event.command_name] = \
+                    Histogram()
+
+            milliseconds = event.duration_micros / 1000
+            histogram.add(milliseconds)
+
+            if failed:
+                self._failures[event.command_name] = \
+                    self._failures.get(event.command_name, 0) + 1
+
+        # commands run on the thread which issued them, so they are added to
+        # the counters for the request that thread is handling
+        counters = getattr(_REQUEST, 'counters', None)
+        if counters is not None:
+            counters['db_commands'] += 1
+            counters['db_ms'] += milliseconds
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        self._record(event)
+
+    def failed(self, event):
+        self._record(event, failed=True)
+
+    def stats(self):
+        """ Returns the latency figures (in milliseconds) and number of
+        failures for each command. """
+        with self._lock:
+            return {name: dict(histogram.stats(),
+                               failures=self._failures.get(name, 0))
+                    for name, histogram in self._latency.items()}
+
+
+class PoolStats(monitoring.ConnectionPoolListener):
+    """
+    Records the connection pool usage - the number of connections open and
+    checked out (in use), and how long each check out waited for a
+    connection.
+
+    A connection is checked out on the thread which is going to use it, so
+    the time each thread started waiting is kept in a thread local.
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        self._waiting = local()
+        self.checkout_wait = Histogram()
+        self.checkout_failures = 0
+        self.in_use = 0
+        self.max_in_use = 0
+        self.open = 0
+        self.cleared = 0
+
+    def connection_check_out_started(self, event):
+        self._waiting.started = monotonic()
+
+    def connection_checked_out(self, event):
+        started = getattr(self._waiting, 'started', None)
+
+        with self._lock:
+            if started is not None:
+                self.checkout_wait.add((monotonic() - started) * 1000)
+            self.in_use += 1
+            self.max_in_use = max(self.max_in_use, self.in_use)
+
+    def connection_check_out_failed(self, event):
+        with self._lock:
+            self.checkout_failures += 1
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self.in_use -= 1
+
+    def connection_created(self, event):
+        with self._lock:
+            self.open += 1
+
+    def connection_closed(self, event):
+        with self._lock:
+            self.open -= 1
+
+    def pool_cleared(self, event):
+        with self._lock:
+            self.cleared += 1
+
+    def pool_created(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def stats(self):
+        """ Returns the pool figures. """
+        with self._lock:
+            return {
+                'open': self.open,
+                'in_use': self.in_use,
+                'max_in_use': self.max_in_use,
+                'checkout_wait': self.checkout_wait.stats(),
+                'checkout_failures': self.checkout_failures,
+                'cleared': self.cleared
+            }
+
+
+def start_request_counters():
+    """ Starts counting the commands issued (and the time spent in them)
+    and the time spent rendering templates by this thread. """
+    _REQUEST.counters = {'db_commands': 0, 'db_ms': 0.0, 'render_ms': 0.0}
+
+
+def add_render_time(milliseconds):
+    """ Adds the time spent rendering a template to this thread's
+    counters. """
+    counters = getattr(_REQUEST, 'counters', None)
+    if counters is not None:
+        counters['render_ms'] += milliseconds
+
+
+def finish_request_counters():
+    """ Stops counting for this thread and returns the counters, or None
+    if they were not started. """
+    counters = getattr(_REQUEST, 'counters', None)
+    _REQUEST.counters = None
+    return counters
+
+
+# listeners passed to the MongoClient in util.py
+COMMAND_STATS = CommandStats()
+POOL_STATS = PoolStats()
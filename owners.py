@@ -0,0 +1,41 @@
+""" This maintains the display name of the owner which is copied onto each trip
+(owner_display_name), so the trips listing can show it without joining the
+users collection. It is set when a trip is created or cloned, updated on every
+trip of a user when their display name changes, and can be backfilled for
+existing trips with flask backfill-owner-names. """
+from bson.objectid import ObjectId
+from util import record_change
+from cache import RESULTS
+from storage import STORES
+
+
+def set_display_name(user_id, display_name):
+    """ Changes the display name of a user and of every trip they own, with a
+    single update of the trips. """
+    user_id = ObjectId(user_id)
+
+    STORES.users.update(user_id, {'display_name': display_name})
+    STORES.trips.set_owner_display_names({user_id: display_name})
+    record_change(user_id)
+    # the owner's trips can be on any listing page
+    RESULTS.invalidate_listings(user_id, True)
+
+
+def backfill_owner_names(batch_size=500):
+    """
+    Copies the display name of each owner onto their trips which do not have
+    it yet, i.e. those created before owner_display_name was added. Owners
+    are updated batch_size at a time, with one update of all their trips
+    each. Returns the number of owners whose trips were updated.
+    """
+    owner_ids = STORES.trips.owners_without_display_name()
+
+    for start in range(0, len(owner_ids), batch_size):
+        names = STORES.users.display_names(owner_ids[start:start + batch_size])
+        STORES.trips.set_owner_display_names(names)
+
+    if owner_ids:
+        record_change()
+        RESULTS.clear()
+
+    return len(owner_ids)
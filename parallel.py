@@ -0,0 +1,65 @@
+""" This runs independent database queries for a request at the same time, on
+a pool of threads shared by the app's requests, so the request waits for the
+slowest query rather than for all of them one after another. Each app has its
+own pool, kept in app.extensions, which is shut down with shutdown() or once
+the app is no longer used. Only functions which do not use the request
+(session, flash, g) can be run on the pool. """
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+
+
+class _Done:
+    """ Holds the result of a call which was run straight away, with the
+    same result() method as a Future. """
+
+    def __init__(self, func, args):
+        self._value = func(*args)
+
+    def result(self):
+        """ Returns the result of the call. """
+        return self._value
+
+
+def init_app(app):
+    """ Creates the pool for an app with QUERY_WORKERS threads - with
+    QUERY_WORKERS set to 0 there is no pool and queries are run one after
+    another, as before. The pool's threads are stopped when the app is
+    garbage collected, if shutdown() has not been called by then. """
+    pool = ThreadPoolExecutor(max_workers=app.config['QUERY_WORKERS']) \
+        if app.config['QUERY_WORKERS'] else None
+    app.extensions['query_pool'] = pool
+
+    if pool is not None:
+        weakref.finalize(app, pool.shutdown, wait=False)
+
+
+def shutdown(app, wait=True):
+    """ Stops the pool of an app, letting any queries still running on it
+    finish first if wait is True. Queries started afterwards are run one
+    after another. """
+    pool = app.extensions.get('query_pool')
+    app.extensions['query_pool'] = None
+
+    if pool is not None:
+        pool.shutdown(wait=wait)
+
+
+def _in_app_context(app, func, args):
+    """ Runs func(*args) on a pool thread, in an app context for app so it
+    can use the app config and database. """
+    with app.app_context():
+        return func(*args)
+
+
+def start_query(func, *args):
+    """ Starts running func(*args) on the pool and returns a future - call
+    result() on it once the value is needed. """
+    # pylint: disable=protected-access
+    app = current_app._get_current_object()
+    pool = app.extensions.get('query_pool')
+
+    if pool is None:
+        return _Done(func, args)
+
+    return pool.submit(_in_app_context, app, func, args)
@@ -0,0 +1,137 @@
+""" This removes deleted trips and their stops. Deleting a trip only marks it
+as deleted (so it is hidden straight away) and the stops are then removed in
+the background, in batches, with the progress recorded on the trip so that an
+interrupted purge carries on where it stopped. """
+from threading import Thread
+from bson.objectid import ObjectId
+from flask import current_app
+from util import utc_now, forget_document
+from storage import STORES
+
+# number of stops removed by each delete
+PURGE_BATCH_SIZE = 500
+
+
+def delete_trip(trip_id):
+    """ Marks a trip (and its stops, for the trip search) as deleted, which
+    hides it from every page. Its stops are removed later by purge_trip. """
+    now = utc_now()
+    STORES.trips.update(trip_id, {
+        'deleted_at': now,
+        'updated_at': now,
+        'purge': {'stops_removed': 0, 'batches': 0}
+    })
+    STORES.stops.mark_trip_deleted(trip_id)
+    forget_document('trips', trip_id)
+
+
+def _delete_stops(trip_id, batch_size):
+    """ Generator which removes the stops of a trip batch_size at a time,
+    yielding the number removed by each batch. """
+    while True:
+        stop_ids = STORES.stops.ids_for_trip(trip_id, limit=batch_size)
+
+        if not stop_ids:
+            return
+
+        yield STORES.stops.delete_many(stop_ids)
+
+
+def purge_trip(trip_id, batch_size=PURGE_BATCH_SIZE):
+    """
+    Removes the stops of a deleted trip in batches, recording the progress
+    on the trip after each batch, and then removes the trip itself. As only
+    the stops which are left are read each time, this can be run again after
+    an interruption. Returns the number of stops removed.
+    """
+    trip_id = ObjectId(trip_id)
+    removed = 0
+
+    for count in _delete_stops(trip_id, batch_size):
+        removed += count
+        STORES.trips.record_purge_progress(trip_id, count)
+
+    # only remove the trip if it is still marked as deleted
+    STORES.trips.remove_if_deleted(trip_id)
+
+    return removed
+
+
+def purge_deleted_trips(batch_size=PURGE_BATCH_SIZE):
+    """ Purges every trip which is marked as deleted, including any whose
+    purge was interrupted. Returns the number of trips purged. """
+    purged = 0
+
+    for trip_id in STORES.trips.deleted_ids():
+        purge_trip(trip_id, batch_size)
+        purged += 1
+
+    return purged
+
+
+def _purge_in_background(app, trip_id):
+    """ Runs a purge, logging rather than raising any errors - the trip is
+    still marked as deleted, so it is picked up by the next purge. """
+    with app.app_context():
+        try:
+            if trip_id:
+                purge_trip(trip_id)
+            else:
+                purge_deleted_trips()
+        except Exception:  # pylint: disable=broad-except
+            app.logger.exception('Purge of deleted trips did not finish')
+
+
+def start_purge(trip_id=None):
+    """ Starts purging a deleted trip (or, if trip_id is not given, every
+    deleted trip) in a background thread, so the request does not wait for
+    the stops to be removed. """
+    # pylint: disable=protected-access
+    Thread(target=_purge_in_background,
+           args=(current_app._get_current_object(), trip_id),
+           daemon=True).start()
+
+
+def orphaned_stops_pipeline():
+    """ Creates an aggregate MongoDB query which returns the trip_id (as
+    _id) of each trip which has stops but no longer exists. """
+    return [
+        {
+            # sorting first lets the trip_id index be used for the group
+            u"$sort": {
+                u"trip_id": 1
+            }
+        },
+        {
+            u"$group": {
+                u"_id": u"$trip_id"
+            }
+        },
+        {
+            u"$lookup": {
+                u"from": u"trips",
+                u"localField": u"_id",
+                u"foreignField": u"_id",
+                u"as": u"trip"
+            }
+        },
+        {
+            u"$match": {
+                u"trip": {u"$size": 0}
+            }
+        }
+    ]
+
+
+def sweep_orphaned_stops(batch_size=PURGE_BATCH_SIZE):
+    """
+    Removes stops whose trip no longer exists, e.g. those left behind when
+    trips were deleted before the purge was introduced. Stops of trips which
+    are marked as deleted are left for purge_trip. Returns the number of
+    stops removed.
+    """
+    removed = 0
+    for trip_id in STORES.stops.orphaned_trip_ids():
+        removed += sum(_delete_stops(trip_id, batch_size))
+
+    return removed
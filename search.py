@@ -0,0 +1,199 @@
+""" This searches for the trips which visit a country (or a city or town in
+it), optionally between two dates, using the dates stored on each stop (see
+stop_dates.py), or for the trips whose name, countries or cities contain the
+words of a text search, using the text index on trips. Results are the trips
+the user can see, paged in the same order and with the same cursors as the
+trips listing - the trip start date, visibility and owner are copied onto the
+stops, so a page of trips is found from the stops before any trip is read. """
+import re
+import unicodedata
+from datetime import datetime
+from listing import cursor_filter, page_stages
+from storage import STORES
+
+
+# the longest text search accepted, in characters
+MAX_TEXT_LENGTH = 100
+
+# number of stops read by each batch of the trip search - the stops are read
+# in page order until a page of trips has been found
+SEARCH_BATCH_SIZE = 200
+
+
+def fold(text):
+    """ Returns text in lower case without accents, so that values can be
+    compared as the text index compares them - 'São Paulo' and 'sao paulo'
+    are the same. """
+    decomposed = unicodedata.normalize('NFKD', text)
+    return ''.join(char for char in decomposed
+                   if not unicodedata.combining(char)).casefold()
+
+
+def text_words(text):
+    """ Returns the set of (folded) words in text, split on spaces and
+    punctuation as the text index splits them. """
+    return set(re.findall(r'\w+', fold(text)))
+
+
+def search_args(args):
+    """
+    Reads a search from the query string args. Returns a (search,
+    search_args) tuple, where search is a dict of the text, country,
+    city_town, date_from and date_to and search_args are the query string
+    values to carry over to the page links.
+
+    A 'q' value is a text search, and the other values are not used - text is
+    then the only value set. Otherwise country is needed, and any of the
+    others can be None. If there is neither, or a date is not valid,
+    (None, {}) is returned.
+    """
+    text = args.get('q', '').strip()[:MAX_TEXT_LENGTH]
+    if text_words(text):
+        return {'text': text, 'country': None, 'city_town': None,
+                'date_from': None, 'date_to': None}, {'q': text}
+
+    # countries and cities are stored title cased, as entered on the stop
+    # form
+    country = args.get('country', '').strip().title()
+    city_town = args.get('city_town', '').strip().title() or None
+    if not country:
+        return None, {}
+
+    dates = {}
+    for field in ('from', 'to'):
+        value = args.get(field, '').strip()
+        try:
+            dates[field] = datetime.strptime(value, '%Y-%m-%d') \
+                if value else None
+        except ValueError:
+            return None, {}
+
+    search = {'text': None, 'country': country, 'city_town': city_town,
+              'date_from': dates['from'], 'date_to': dates['to']}
+    carried = {field: args[field].strip()
+               for field in ('country', 'city_town', 'from', 'to')
+               if args.get(field, '').strip()}
+
+    return search, carried
+
+
+def stop_filter(user_id, search, after, before):
+    """ Returns the query for the stops matching a search - those in the
+    country (and city or town) which are on the trip at some point between
+    the dates, of the trips user_id can see after (or before) the page
+    cursor. This is read in page order from the trip_search_country or
+    trip_search_city_town index, which hold every field it tests, so only
+    the index is read (see util.INDEXES). """
+    query = {
+        u"country": search['country'],
+        # $ne rather than $exists, which cannot be told from the index as a
+        # missing field and null have the same key
+        u"trip_deleted": {u"$ne": True},
+        u"$or": [{u"trip_owner_id": user_id}, {u"trip_public": True}]
+    }
+
+    if search['city_town']:
+        query[u"city_town"] = search['city_town']
+
+    # a stop which starts before date_from is still on the trip at
+    # date_from if it has not ended by then
+    if search['date_to']:
+        query[u"start_date"] = {u"$lte": search['date_to']}
+    if search['date_from']:
+        query[u"end_date"] = {u"$gte": search['date_from']}
+
+    if after or before:
+        query = {u"$and": [query, cursor_filter(after, before, u"trip_start",
+                                                u"trip_id")]}
+
+    return query
+
+
+def search_stops_pipeline(user_id, search, after, before):
+    """
+    Creates an aggregate MongoDB query, run on the stops collection, which
+    returns the trip_id of each stop matching search in the order the trips
+    are paged. The stops are read from the index in that order, without a
+    blocking stage, so the results can be read until a page of trips has
+    been found (see first_trip_ids) and the rest are never read.
+    """
+    # paging backwards is done by reversing the sort (see page_stages)
+    direction = -1 if before else 1
+
+    return [
+        {
+            u"$match": stop_filter(user_id, search, after, before)
+        },
+        {
+            u"$sort": {
+                u"trip_start": direction,
+                u"trip_id": direction
+            }
+        },
+        {
+            u"$project": {
+                u"_id": 0,
+                u"trip_id": 1
+            }
+        }
+    ]
+
+
+def first_trip_ids(stops, limit):
+    """ Returns the trip_id's of the first limit trips of stops, which are
+    in page order so the stops of each trip are next to each other - no more
+    stops are read than are needed. """
+    trip_ids = []
+
+    for stop in stops:
+        if not trip_ids or trip_ids[-1] != stop['trip_id']:
+            trip_ids.append(stop['trip_id'])
+            if len(trip_ids) == limit:
+                break
+
+    return trip_ids
+
+
+def search_trips_pipeline(user_id, trip_ids, after, before, limit):
+    """ Creates an aggregate MongoDB query which returns the trips found by
+    search_stops_pipeline as a page of trips. The trips are checked again,
+    in case one has changed since its stops were written. """
+    return page_stages({
+        u"_id": {u"$in": trip_ids},
+        u"deleted_at": {u"$exists": False},
+        u"$or": [{u"owner_id": user_id}, {u"public": True}]
+    }, after, before, limit)
+
+
+def text_search_pipeline(user_id, text, after, before, limit):
+    """
+    Creates an aggregate MongoDB query which returns up to limit of the trips
+    user_id can see whose name, countries or cities contain any of the words
+    in text, as a page of trips in the order they are paged. The $text match
+    has to be in the first stage, which page_stages() makes it.
+    """
+    return page_stages({
+        u"$text": {u"$search": text},
+        u"deleted_at": {u"$exists": False},
+        u"$or": [{u"owner_id": user_id}, {u"public": True}]
+    }, after, before, limit)
+
+
+def search_trips(user_id, search, after, before, per_page):
+    """ Returns a page of the trips matching a search (or text search) as a
+    (trips, more_trips) tuple, as load_trips does for the trips listing. """
+    # one extra trip is read to tell whether there is another page
+    if search['text']:
+        found = STORES.trips.text_search(user_id, search['text'], after,
+                                         before, limit=per_page + 1)
+    else:
+        found = STORES.trips.search(user_id, search, after, before,
+                                    limit=per_page + 1)
+
+    more_trips = len(found) > per_page
+    found = found[:per_page]
+
+    if before:
+        found.reverse()
+
+    return found, more_trips
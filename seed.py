@@ -0,0 +1,264 @@
+""" This generates synthetic users, trips and stops, which are used by the
+benchmarks and for load testing (flask seed). The documents have the same
+shape as those written by user_new, trip_new and trip_stop_new (with the trip
+summary filled in) and the same seed always generates the same documents,
+including their _id's, so runs can be compared.
+
+The data is skewed like real usage - a few users own most of the trips and
+most trips have a few stops, with a long tail of much longer trips. """
+import random
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from itertools import accumulate
+from operator import itemgetter
+from bson.objectid import ObjectId
+from util import utc_now
+from summary import EMPTY_SUMMARY, stop_totals
+from storage import STORES
+from stop_dates import trip_fields
+
+# country -> (currency, cities) used for the generated stops
+COUNTRIES = {
+    'Argentina': ('ARS', ['Buenos Aires', 'Mendoza', 'Salta']),
+    'Australia': ('AUD', ['Sydney', 'Melbourne', 'Perth']),
+    'Brazil': ('BRL', ['Rio De Janeiro', 'Sao Paulo', 'Salvador']),
+    'Canada': ('CAD', ['Toronto', 'Vancouver', 'Montreal']),
+    'Chile': ('CLP', ['Santiago', 'Valparaiso', 'Puerto Natales']),
+    'China': ('CNY', ['Beijing', 'Shanghai', 'Xian']),
+    'Croatia': ('EUR', ['Zagreb', 'Split', 'Dubrovnik']),
+    'Czech Republic': ('CZK', ['Prague', 'Brno', 'Cesky Krumlov']),
+    'Denmark': ('DKK', ['Copenhagen', 'Aarhus', 'Odense']),
+    'Egypt': ('EGP', ['Cairo', 'Luxor', 'Aswan']),
+    'France': ('EUR', ['Paris', 'Lyon', 'Nice']),
+    'Germany': ('EUR', ['Berlin', 'Munich', 'Hamburg']),
+    'Greece': ('EUR', ['Athens', 'Thessaloniki', 'Santorini']),
+    'Hungary': ('HUF', ['Budapest', 'Debrecen', 'Eger']),
+    'Iceland': ('ISK', ['Reykjavik', 'Akureyri', 'Vik']),
+    'India': ('INR', ['Delhi', 'Mumbai', 'Jaipur']),
+    'Indonesia': ('IDR', ['Jakarta', 'Ubud', 'Yogyakarta']),
+    'Ireland': ('EUR', ['Dublin', 'Cork', 'Galway']),
+    'Italy': ('EUR', ['Rome', 'Florence', 'Venice']),
+    'Japan': ('JPY', ['Tokyo', 'Kyoto', 'Osaka']),
+    'Kenya': ('KES', ['Nairobi', 'Mombasa', 'Nakuru']),
+    'Mexico': ('MXN', ['Mexico City', 'Oaxaca', 'Cancun']),
+    'Morocco': ('MAD', ['Marrakesh', 'Fes', 'Casablanca']),
+    'Netherlands': ('EUR', ['Amsterdam', 'Rotterdam', 'Utrecht']),
+    'New Zealand': ('NZD', ['Auckland', 'Wellington', 'Queenstown']),
+    'Norway': ('NOK', ['Oslo', 'Bergen', 'Tromso']),
+    'Peru': ('PEN', ['Lima', 'Cusco', 'Arequipa']),
+    'Poland': ('PLN', ['Warsaw', 'Krakow', 'Gdansk']),
+    'Portugal': ('EUR', ['Lisbon', 'Porto', 'Faro']),
+    'South Africa': ('ZAR', ['Cape Town', 'Johannesburg', 'Durban']),
+    'South Korea': ('KRW', ['Seoul', 'Busan', 'Gyeongju']),
+    'Spain': ('EUR', ['Madrid', 'Barcelona', 'Seville']),
+    'Sweden': ('SEK', ['Stockholm', 'Gothenburg', 'Malmo']),
+    'Switzerland': ('CHF', ['Zurich', 'Geneva', 'Lucerne']),
+    'Thailand': ('THB', ['Bangkok', 'Chiang Mai', 'Phuket']),
+    'Turkey': ('TRY', ['Istanbul', 'Antalya', 'Cappadocia']),
+    'United Kingdom': ('GBP', ['London', 'Edinburgh', 'Belfast']),
+    'United States': ('USD', ['New York', 'Chicago', 'San Francisco']),
+    'Vietnam': ('VND', ['Hanoi', 'Ho Chi Minh City', 'Hoi An'])
+}
+
+# countries in a fixed order, so choices from them are the same every run
+COUNTRY_NAMES = sorted(COUNTRIES)
+
+# trips start on a day within this many days of the first day
+FIRST_START_DATE = datetime(2015, 1, 1)
+START_DATE_DAYS = 3650
+
+# how skewed trip ownership is - user n (from 1) owns trips in proportion to
+# 1 / n ** OWNER_SKEW, so a few users own most of the trips
+OWNER_SKEW = 1.1
+
+# shape of the (Pareto) distribution of the number of stops per trip - lower
+# values give a longer tail of trips with many stops
+STOPS_SKEW = 1.5
+
+
+def _object_id(rng, created):
+    """ Returns an ObjectId for a document created at created, with the rest
+    of its bytes taken from rng so it is the same for every run. """
+    seconds = int((created - datetime(1970, 1, 1)).total_seconds())
+    return ObjectId(struct.pack('>I', seconds) + rng.getrandbits(64)
+                    .to_bytes(8, 'big'))
+
+
+def generate_users(rng, count):
+    """ Returns count new user documents. """
+    users = []
+
+    for number in range(count):
+        users.append({
+            '_id': _object_id(rng, FIRST_START_DATE),
+            'username': 'user%07d' % number,
+            'name': 'User %07d' % number,
+            'display_name': 'User %d' % number,
+            'email': 'user%07d@example.com' % number,
+            'password': ''
+        })
+
+    return users
+
+
+def generate_stop(rng, trip_id):
+    """ Returns a new stop document for a trip. """
+    country = rng.choice(COUNTRY_NAMES)
+    currency, cities = COUNTRIES[country]
+
+    return {
+        '_id': _object_id(rng, FIRST_START_DATE),
+        'trip_id': trip_id,
+        'country': country,
+        'city_town': rng.choice(cities),
+        'duration': rng.randint(1, 14),
+        'order': 1,
+        'currency': currency,
+        'cost_accommodation': round(rng.uniform(10, 200), 2),
+        'cost_food': round(rng.uniform(5, 80), 2),
+        'cost_other': round(rng.uniform(0, 50), 2),
+        'updated_at': utc_now()
+    }
+
+
+def generate_trip(rng, owner, number_of_stops):
+    """ Returns a new trip document for an owner (a user document) along with
+    its stops. The trip summary and end date, and the stop dates and trip
+    fields, are calculated from the stops as the updates in summary.py would
+    leave them. """
+    start_date = FIRST_START_DATE + \
+        timedelta(days=rng.randrange(START_DATE_DAYS))
+    trip_id = _object_id(rng, start_date)
+    stops = [generate_stop(rng, trip_id) for _ in range(number_of_stops)]
+
+    # stops are chained in _id order, as they would be if they were added
+    # one after the other
+    stops.sort(key=itemgetter('_id'))
+
+    summary = dict(EMPTY_SUMMARY, countries=[], cities=[])
+    for stop in stops:
+        stop['start_date'] = start_date + timedelta(days=summary['duration'])
+        stop['end_date'] = stop['start_date'] + \
+            timedelta(days=stop['duration'])
+        for field, value in stop_totals(stop).items():
+            summary[field] += value
+        if stop['country'] not in summary['countries']:
+            summary['countries'].append(stop['country'])
+        if stop['city_town'] not in summary['cities']:
+            summary['cities'].append(stop['city_town'])
+
+    trip = {
+        '_id': trip_id,
+        'name': 'Trip %d' % rng.randrange(1000000),
+        'travelers': rng.randint(1, 4),
+        'start_date': start_date,
+        'end_date': start_date + timedelta(days=summary['duration']),
+        'public': rng.random() < 0.8,
+        'owner_id': owner['_id'],
+        'owner_display_name': owner['display_name'],
+        'summary': summary,
+        'updated_at': utc_now()
+    }
+    for stop in stops:
+        stop.update(trip_fields(trip))
+
+    return trip, stops
+
+
+def number_of_stops(rng, max_stops):
+    """ Returns the number of stops for a trip, between 1 and max_stops -
+    mostly a few, with a long tail of longer trips. """
+    return min(max_stops, int(rng.paretovariate(STOPS_SKEW)))
+
+
+def _insert(store, documents, batch_size):
+    """ Inserts documents into a store with an insert_many for each
+    batch. """
+    for start in range(0, len(documents), batch_size):
+        store.insert_many(documents[start:start + batch_size], ordered=False)
+
+
+def _seed_trips(stores, seed, chunk, trips, users, owner_weights,
+                max_stops, batch_size):
+    """
+    Generates and inserts one chunk of trips along with their stops into the
+    (trip, stop) stores. Each chunk has its own random generator, seeded from
+    the seed and the chunk number, so the data is the same however the chunks
+    are scheduled. Returns the number of (trips, stops) inserted.
+    """
+    rng = random.Random('%s-trips-%d' % (seed, chunk))
+    owners = rng.choices(users, cum_weights=owner_weights, k=trips)
+    new_trips, new_stops = [], []
+
+    for owner in owners:
+        trip, stops = generate_trip(rng, owner,
+                                    number_of_stops(rng, max_stops))
+        new_trips.append(trip)
+        new_stops += stops
+
+    trip_store, stop_store = stores
+    _insert(trip_store, new_trips, batch_size)
+    _insert(stop_store, new_stops, batch_size)
+
+    return len(new_trips), len(new_stops)
+
+
+def seed_database(users=1000, trips=1000, max_stops=20, large_trip_stops=0,
+                  seed=0, batch_size=1000, workers=4):
+    """
+    Generates and inserts users, and trips with between 1 and max_stops stops
+    each. If large_trip_stops is set, one more (public) trip is added with
+    that many stops for the first user, e.g. to benchmark the trip page for a
+    very long trip.
+
+    The trips are generated and inserted in chunks of batch_size by workers
+    threads at the same time. Returns the number of documents inserted into
+    each collection and the _id's of the first user and of the large trip
+    (or None).
+    """
+    new_users = generate_users(random.Random('%s-users' % seed), users)
+    user_ids = [user['_id'] for user in new_users]
+    # the stores of the app are looked up here, as the worker threads run
+    # outside of the app context
+    user_store, stores = STORES.users, (STORES.trips, STORES.stops)
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        # users are inserted before their trips, as the app expects every
+        # owner to exist
+        user_batches = [pool.submit(_insert, user_store,
+                                    new_users[start:start + batch_size],
+                                    batch_size)
+                        for start in range(0, users, batch_size)]
+        for batch in user_batches:
+            batch.result()
+
+        owner_weights = list(accumulate(
+            1 / rank ** OWNER_SKEW for rank in range(1, users + 1)))
+        chunks = [pool.submit(_seed_trips, stores, seed, chunk,
+                              min(batch_size, trips - start), new_users,
+                              owner_weights, max_stops, batch_size)
+                  for chunk, start in enumerate(range(0, trips, batch_size))]
+        counts = [chunk.result() for chunk in chunks]
+
+    trip_count = sum(count[0] for count in counts)
+    stop_count = sum(count[1] for count in counts)
+
+    large_trip_id = None
+    if large_trip_stops and user_ids:
+        trip, stops = generate_trip(random.Random('%s-large' % seed),
+                                    new_users[0], large_trip_stops)
+        trip['public'] = True
+        _insert(stores[0], [trip], batch_size)
+        _insert(stores[1], stops, batch_size)
+        trip_count += 1
+        stop_count += len(stops)
+        large_trip_id = trip['_id']
+
+    return {
+        'users': len(new_users),
+        'trips': trip_count,
+        'stops': stop_count,
+        'user_id': user_ids[0] if user_ids else None,
+        'large_trip_id': large_trip_id
+    }
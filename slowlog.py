@@ -0,0 +1,269 @@
+""" This records slow queries. The collections used by the app are wrapped so
+that any aggregate or find_one which takes longer than a threshold is written
+to a rotating log, along with the route it was run for and the shape of the
+query (with the values taken out). The first time each shape is slow, the
+query is also explained so the log shows which stage is taking the time -
+only a summary of the plan is logged, as the explain itself holds the
+query's values. """
+import json
+import logging
+from hashlib import sha1
+from logging.handlers import RotatingFileHandler
+from threading import Lock, Thread
+from time import perf_counter
+from flask import has_request_context, request
+
+# value used in place of every literal in a query shape
+REDACTED = '?'
+
+
+def _collapse(shapes):
+    """ Returns the shapes of a list of values, or a single REDACTED if they
+    are all values. """
+    if all(shape == REDACTED for shape in shapes):
+        return REDACTED
+    return shapes
+
+
+def _filter_shape(query):
+    """ Returns the shape of a query filter (or $match), where every string
+    is a value - even one starting with '$', which could be user input -
+    apart from those in a $expr, which is an expression. """
+    if isinstance(query, dict):
+        return {key: _expression_shape(value) if key == '$expr'
+                else _filter_shape(value) for key, value in query.items()}
+
+    if isinstance(query, (list, tuple)):
+        return _collapse([_filter_shape(value) for value in query])
+
+    return REDACTED
+
+
+def _expression_shape(expression):
+    """ Returns the shape of an aggregation expression (or stage), where
+    strings starting with '$' are field paths or variables. User input is
+    always wrapped in $literal in these, so it is redacted. """
+    if isinstance(expression, dict):
+        return {key: REDACTED if key == '$literal'
+                else query_shape(value) if key == 'pipeline'
+                else _expression_shape(value)
+                for key, value in expression.items()}
+
+    if isinstance(expression, (list, tuple)):
+        return _collapse([_expression_shape(value) for value in expression])
+
+    if isinstance(expression, str) and expression.startswith('$'):
+        return expression
+
+    return REDACTED
+
+
+def query_shape(query):
+    """
+    Returns a copy of a filter or pipeline with every literal value replaced
+    with REDACTED, so queries which only differ by their values have the same
+    shape. Field paths and variables (e.g. "$start_date", "$$travelers") in
+    the expressions of pipeline stages are kept, as they are part of the
+    shape, but every value in a filter or $match is redacted, whatever it
+    starts with. Lists of values are collapsed to a single REDACTED.
+    """
+    if isinstance(query, (list, tuple)):
+        return [{name: _filter_shape(spec) if name == '$match'
+                 else _expression_shape(spec)
+                 for name, spec in stage.items()} for stage in query]
+
+    return _filter_shape(query)
+
+
+def stage_times(explain):
+    """ Returns the (stage, time in milliseconds, documents returned) of
+    each stage of an explained aggregation, where the server reports them. """
+    times = []
+
+    for stage in explain.get('stages', []):
+        name = next((key for key in stage if key.startswith('$')), None)
+        if name:
+            times.append((name, stage.get('executionTimeMillisEstimate'),
+                          stage.get('nReturned')))
+
+    return times
+
+
+# the keys of a plan stage which hold the stages it reads from
+CHILD_STAGES = ('inputStage', 'inputStages', 'outerStage', 'innerStage')
+
+
+def _plan_stages(plan, stages, indexes):
+    """ Adds the stage names of a query plan, from the top down, to stages
+    and the names of the indexes it scans to indexes. """
+    if not isinstance(plan, dict):
+        return
+
+    if 'stage' in plan:
+        stages.append(plan['stage'])
+    if 'indexName' in plan:
+        indexes.append(plan['indexName'])
+
+    for key in CHILD_STAGES:
+        children = plan.get(key, [])
+        for child in children if isinstance(children, list) else [children]:
+            _plan_stages(child, stages, indexes)
+
+
+def plan_summary(explain):
+    """
+    Returns the parts of an explain (of a find or an aggregation) which hold
+    none of the query's values - the stages of the winning plan, the indexes
+    it scans and the numbers of keys and documents examined. The command, the
+    parsed query and the index bounds are left out, as they hold the values
+    (e.g. user ids or search text).
+    """
+    # an aggregation which is not run as a single query has the query
+    # explain in its first stage
+    cursor = next((stage['$cursor'] for stage in explain.get('stages', [])
+                   if '$cursor' in stage), explain)
+    winning = cursor.get('queryPlanner', {}).get('winningPlan', {})
+    stats = cursor.get('executionStats', {})
+
+    stages, indexes = [], []
+    _plan_stages(winning.get('queryPlan', winning), stages, indexes)
+
+    return {
+        'plan': stages,
+        'indexes': indexes,
+        'keys_examined': stats.get('totalKeysExamined'),
+        'docs_examined': stats.get('totalDocsExamined'),
+        'returned': stats.get('nReturned'),
+        'ms': stats.get('executionTimeMillis')
+    }
+
+
+class SlowQueryLog:
+    """
+    Writes the queries which take longer than SLOW_QUERY_MS to a rotating
+    log file at SLOW_QUERY_LOG. Each distinct query shape is explained (with
+    executionStats) the first time it is slow - the explain is run on a
+    background thread so the request does not wait for it.
+    """
+
+    def __init__(self, config):
+        # each app's log has a logger of its own, which is not shared through
+        # logging.getLogger(), so it only writes to that app's file
+        self.logger = logging.Logger('travelpal.slow_queries', logging.INFO)
+        self.logger.propagate = False
+
+        # 0 turns the log off
+        self.threshold_ms = 0
+        if config['SLOW_QUERY_MS'] and config['SLOW_QUERY_LOG']:
+            self.threshold_ms = config['SLOW_QUERY_MS']
+            # the file is only created once a slow query is logged
+            self.logger.addHandler(RotatingFileHandler(
+                config['SLOW_QUERY_LOG'],
+                maxBytes=config['SLOW_QUERY_LOG_MAX_BYTES'],
+                backupCount=config['SLOW_QUERY_LOG_BACKUPS'], delay=True))
+
+        self._lock = Lock()
+        self._explained = set()
+
+    @classmethod
+    def from_config(cls, app):
+        """ Creates the log for an app from its config. """
+        return cls(app.config)
+
+    def record(self, collection, operation, query, milliseconds):
+        """ Logs a query if it took longer than the threshold. """
+        if milliseconds < self.threshold_ms:
+            return
+
+        shape = query_shape(query)
+        fingerprint = sha1(('%s.%s %s' % (
+            collection.name, operation, json.dumps(shape, sort_keys=True)))
+                           .encode()).hexdigest()[:12]
+
+        entry = {
+            'collection': collection.name,
+            'operation': operation,
+            'ms': round(milliseconds, 1),
+            'route': request.endpoint if has_request_context() else None,
+            'fingerprint': fingerprint,
+            'shape': shape
+        }
+        self.logger.info(json.dumps(entry, default=str))
+
+        with self._lock:
+            first = fingerprint not in self._explained
+            self._explained.add(fingerprint)
+
+        if first:
+            Thread(target=self._explain,
+                   args=(collection, operation, query, entry),
+                   daemon=True).start()
+
+    def _explain(self, collection, operation, query, entry):
+        """ Explains a query and logs the result against its fingerprint. """
+        if operation == 'aggregate':
+            command = {'aggregate': collection.name, 'pipeline': query,
+                       'cursor': {}}
+        else:
+            command = {'find': collection.name, 'filter': query, 'limit': 1}
+
+        try:
+            # the whole command is passed as one document, with explain as
+            # its first key
+            explain = collection.database.command(
+                {'explain': command, 'verbosity': 'executionStats'})
+        except Exception as error:  # pylint: disable=broad-except
+            # only the type of error is logged, as the message may quote
+            # the query
+            self.logger.info(json.dumps({
+                'fingerprint': entry['fingerprint'],
+                'collection': entry['collection'],
+                'operation': operation,
+                'error': type(error).__name__,
+                'code': getattr(error, 'code', None)
+            }))
+            return
+
+        self.logger.info(json.dumps({
+            'fingerprint': entry['fingerprint'],
+            'collection': entry['collection'],
+            'operation': operation,
+            'stages': stage_times(explain),
+            'explain': plan_summary(explain)
+        }, default=str))
+
+
+class TimedCollection:
+    """ Wraps a pymongo collection, timing aggregate and find_one and passing
+    everything else straight through. """
+
+    def __init__(self, collection, slow_queries):
+        self._collection = collection
+        self._slow_queries = slow_queries
+
+    def __getattr__(self, name):
+        return getattr(self._collection, name)
+
+    def aggregate(self, pipeline, *args, **kwargs):
+        """ Runs an aggregation - the time taken is that of the first batch
+        of results, which includes running the pipeline. """
+        if not self._slow_queries.threshold_ms:
+            return self._collection.aggregate(pipeline, *args, **kwargs)
+
+        started = perf_counter()
+        cursor = self._collection.aggregate(pipeline, *args, **kwargs)
+        self._slow_queries.record(self._collection, 'aggregate', pipeline,
+                                  (perf_counter() - started) * 1000)
+        return cursor
+
+    def find_one(self, filter=None, *args, **kwargs):
+        # pylint: disable=redefined-builtin
+        """ Finds a single document. """
+        if not self._slow_queries.threshold_ms:
+            return self._collection.find_one(filter, *args, **kwargs)
+
+        started = perf_counter()
+        document = self._collection.find_one(filter, *args, **kwargs)
+        self._slow_queries.record(self._collection, 'find_one', filter or {},
+                                  (perf_counter() - started) * 1000)
+        return document
@@ -0,0 +1,78 @@
+""" This maintains the start and end dates stored on each stop. Stops are
+chained in the order they were added - the first starts on the trip start date
+and each of the others on the day the previous stop ended - so adding, updating
+or removing a stop changes the dates of the stops after it, and changing the
+trip start date changes them all. The dates are the same as those shown on
+trip_detailed, and are stored so that stops can be searched by date (see
+search.py).
+
+The trip's start date, visibility and owner are copied onto its stops along
+with the dates, so the search can page through the matching trips on the
+stops index before it reads any trips. """
+from datetime import timedelta
+from bson.objectid import ObjectId
+from storage import STORES
+
+# stop field -> the trip field copied onto it
+TRIP_FIELDS = {
+    'trip_start': 'start_date',
+    'trip_public': 'public',
+    'trip_owner_id': 'owner_id'
+}
+
+
+def trip_fields(trip):
+    """ Returns the fields copied onto the stops of a trip. """
+    return {stop_field: trip[field] for stop_field, field
+            in TRIP_FIELDS.items()}
+
+
+def chain_stop_dates(trip_id, from_stop_id=None):
+    """
+    Recalculates the dates of the stops of a trip from from_stop_id onwards
+    (or of every stop) and writes those which have changed, along with the
+    trip fields, in one bulk write - the trip fields are also written to any
+    stop which does not have them as they are on the trip. from_stop_id does
+    not need to exist, e.g. when it is the stop which has just been removed.
+    Returns the number of stops updated.
+    """
+    trip = STORES.trips.find(trip_id)
+    if not trip:
+        return 0
+
+    fields = trip_fields(trip)
+
+    # the stop before from_stop_id, if there is one, is returned first so
+    # the chain can carry on from its end date
+    stops = STORES.stops.date_chain(trip_id, from_stop_id)
+    start_date = trip['start_date']
+
+    if from_stop_id and stops and stops[0]['_id'] < ObjectId(from_stop_id):
+        previous = stops.pop(0)
+        if 'end_date' not in previous:
+            # the earlier stops have not been given dates yet
+            return chain_stop_dates(trip_id)
+        start_date = previous['end_date']
+
+    changed = []
+    for stop in stops:
+        end_date = start_date + timedelta(days=stop['duration'])
+        if stop.get('start_date') != start_date or \
+                stop.get('end_date') != end_date or \
+                any(stop.get(field) != value
+                    for field, value in fields.items()):
+            changed.append((stop['_id'], start_date, end_date))
+        start_date = end_date
+
+    if changed:
+        STORES.stops.set_dates(changed, fields)
+
+    return len(changed)
+
+
+def backfill_stop_dates():
+    """ Gives dates and the trip fields to the stops of every trip with
+    stops which do not have them yet, i.e. those added before they were
+    stored. Returns the number of stops updated. """
+    return sum(chain_stop_dates(trip_id)
+               for trip_id in STORES.stops.trip_ids_without_dates())
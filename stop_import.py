@@ -0,0 +1,151 @@
+""" This imports a file (CSV or JSON) of stops into a trip. Every row is
+validated with the StopForm rules before anything is written, then the stops
+are added with ordered insert_many calls and the trip summary is recalculated
+once for the whole import. If any step fails the stops are removed again, so
+an import is all or nothing. """
+import csv
+import io
+import json
+from bson.objectid import ObjectId
+from flask import current_app
+from werkzeug.datastructures import MultiDict
+from util import utc_now, forget_document
+from forms import StopForm
+from summary import rebuild_summaries
+from stop_dates import chain_stop_dates
+from autocomplete import SUGGESTIONS
+from storage import STORES
+
+# stop fields read from each row of the file
+IMPORT_FIELDS = ('country', 'city_town', 'currency', 'duration',
+                 'cost_accommodation', 'cost_food', 'cost_other')
+
+# number of stops written by each insert_many
+IMPORT_CHUNK_SIZE = 100
+
+
+class StopImportError(Exception):
+    """ Raised when an import file cannot be read at all, as opposed to
+    containing rows which are not valid stops. """
+
+
+def stop_from_form(trip_id, form):
+    """ Creates a new stop document from a validated StopForm. """
+    return {
+        'trip_id': ObjectId(trip_id),
+        'country': form.country.data.strip().title(),
+        'city_town': form.city_town.data.strip().title(),
+        'duration': form.duration.data,
+        'order': 1,
+        'currency': form.currency.data.strip().upper(),
+        'cost_accommodation': float(form.cost_accommodation.data),
+        'cost_food': float(form.cost_food.data),
+        'cost_other': float(form.cost_other.data),
+        'updated_at': utc_now()
+    }
+
+
+def read_rows(file_storage):
+    """
+    Reads the rows from an uploaded file. CSV files must have a header row
+    naming the columns, and JSON files must contain a list of objects.
+    Returns a list of dicts of the IMPORT_FIELDS.
+    """
+    file_type = file_storage.filename.rsplit('.', 1)[-1].lower()
+    if file_type not in ('csv', 'json'):
+        raise StopImportError('Only CSV or JSON files can be imported.')
+
+    try:
+        text = file_storage.read().decode('utf-8-sig')
+    except UnicodeDecodeError:
+        raise StopImportError('The file must be UTF-8 encoded.')
+
+    if file_type == 'json':
+        try:
+            rows = json.loads(text)
+        except ValueError:
+            raise StopImportError('The file is not valid JSON.')
+
+        if not isinstance(rows, list) or \
+                not all(isinstance(row, dict) for row in rows):
+            raise StopImportError('The JSON file must contain a list of '
+                                  'stops.')
+    else:
+        rows = list(csv.DictReader(io.StringIO(text)))
+
+    if not rows:
+        raise StopImportError('The file does not contain any stops.')
+
+    # form data is always text, so values are converted to strings
+    return [{field: '' if row.get(field) is None else str(row[field])
+             for field in IMPORT_FIELDS} for row in rows]
+
+
+def validate_rows(trip_id, rows):
+    """
+    Validates each row with the StopForm rules. Returns a (stops, errors)
+    tuple - the stop documents to insert, and a list of (row number, field,
+    message) for every row which is not valid. Row numbers start at 1.
+    """
+    stops = []
+    errors = []
+
+    for number, row in enumerate(rows, start=1):
+        # rows are not submitted by a form, so there is no csrf token
+        form = StopForm(formdata=MultiDict(row), meta={'csrf': False})
+
+        if form.validate():
+            stops.append(stop_from_form(trip_id, form))
+        else:
+            for field, messages in sorted(form.errors.items()):
+                for message in messages:
+                    errors.append((number, field, message))
+
+    return stops, errors
+
+
+def _remove_stops(trip_id, stops):
+    """ Removes the stops of a failed import again, along with them from the
+    trip summary if it was already recalculated. The other stops' dates are
+    unchanged, as the imported stops come after them. """
+    STORES.stops.delete_many([stop['_id'] for stop in stops])
+    forget_document('trips', trip_id)
+
+    try:
+        rebuild_summaries(trip_ids=[ObjectId(trip_id)])
+    except Exception:  # pylint: disable=broad-except
+        # the error which failed the import is the one raised
+        current_app.logger.exception(
+            'Recalculating the summary of trip %s after a failed import '
+            'failed - run flask rebuild-summaries to repair it.', trip_id)
+
+
+def insert_stops(trip_id, stops):
+    """
+    Adds the stops to a trip in chunks of IMPORT_CHUNK_SIZE and then
+    recalculates the trip summary and the stop dates. If any of these steps
+    fails, the stops which were already added are removed again so the
+    import is all or nothing.
+    """
+    # _id's are set here so they are known even if an insert fails part way
+    for stop in stops:
+        stop['_id'] = ObjectId()
+
+    try:
+        for start in range(0, len(stops), IMPORT_CHUNK_SIZE):
+            STORES.stops.insert_many(stops[start:start + IMPORT_CHUNK_SIZE])
+
+        # one recalculation for the whole import, rather than one update for
+        # each stop
+        rebuild_summaries(trip_ids=[ObjectId(trip_id)])
+        forget_document('trips', trip_id)
+        # the imported stops are added after the trip's other stops
+        chain_stop_dates(trip_id, stops[0]['_id'])
+    except Exception:
+        _remove_stops(trip_id, stops)
+        raise
+
+    # only once the import can no longer be undone
+    SUGGESTIONS.add(*stops)
+
+    return len(stops)
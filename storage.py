@@ -0,0 +1,76 @@
+""" This holds the stores the app reads and writes its users, trips and stops
+through, so the routes and helpers do not depend on where the data is kept.
+Each app is given a set of stores by create_app(), chosen with the STORAGE
+setting - MongoDB (mongo_storage.py) or an in-memory engine (memory_storage.py)
+used for fast isolated tests and for benchmarking the app without a database.
+
+Every set of stores has the same methods:
+
+    users   find, insert, insert_many, update, find_by_username,
+            display_names
+    trips   find, find_with_stop, insert, insert_many, update, update_many,
+            remove, update_summary, update_end_date, summary_batches,
+            listing, search, text_search, detail, with_stops, deleted_ids,
+            record_purge_progress, remove_if_deleted,
+            set_owner_display_names, owners_without_display_name,
+            ids_without_cities
+    stops   find, for_trip, insert, insert_many, update, delete,
+            delete_many, delete_for_trip, ids_for_trip, country_in_use,
+            city_in_use, total_duration, summaries, date_chain, set_dates,
+            mark_trip_deleted, trip_ids_without_dates, value_counts,
+            orphaned_trip_ids
+    meta    record_change, last_change
+"""
+from flask import current_app, has_app_context
+
+
+class Storage:
+    """
+    Looks up the stores of the app being used - the app is taken from the
+    app context or, for code which runs outside of one, is the most recently
+    created app (as for MongoDB in database.py).
+    """
+
+    def __init__(self):
+        self._app = None
+
+    def init_app(self, app, stores):
+        """ Sets the stores used by an app. """
+        app.extensions['storage'] = stores
+        self._app = app
+
+    def _stores(self):
+        """ Returns the stores of the app being used. """
+        # pylint: disable=protected-access
+        app = current_app._get_current_object() if has_app_context() \
+            else self._app
+
+        if app is None or 'storage' not in app.extensions:
+            raise RuntimeError('Storage has not been set up - the app must be '
+                               'created with create_app().')
+
+        return app.extensions['storage']
+
+    @property
+    def users(self):
+        """ Returns the user store. """
+        return self._stores().users
+
+    @property
+    def trips(self):
+        """ Returns the trip store. """
+        return self._stores().trips
+
+    @property
+    def stops(self):
+        """ Returns the stop store. """
+        return self._stores().stops
+
+    @property
+    def meta(self):
+        """ Returns the store for the change stamps. """
+        return self._stores().meta
+
+
+# stores for the app being used
+STORES = Storage()
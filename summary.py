@@ -0,0 +1,346 @@
+""" This maintains the summary figures stored on each trip document, i.e. the
+number of stops, duration, per person costs, countries, cities and end date.
+These are updated incrementally whenever a stop is written so that pages can
+read them directly rather than recomputing them from the stops on every view.
+The dates stored on the stops, and the stop form suggestions, are updated at
+the same time (see stop_dates.py and autocomplete.py). """
+from datetime import timedelta
+from util import forget_document, utc_now
+from storage import STORES
+from stop_dates import chain_stop_dates
+from autocomplete import SUGGESTIONS
+
+# used to convert a duration (in days) to milliseconds for date arithmetic
+MS_PER_DAY = 24 * 3600 * 1000
+
+# summary for a trip which does not have any stops
+EMPTY_SUMMARY = {
+    'number_of_stops': 0,
+    'duration': 0,
+    'total_accom_pp': 0,
+    'total_food_pp': 0,
+    'total_other_pp': 0,
+    'countries': [],
+    'cities': []
+}
+
+# fields in the summary which are running totals
+TOTAL_FIELDS = ('number_of_stops', 'duration', 'total_accom_pp',
+                'total_food_pp', 'total_other_pp')
+
+
+def stop_totals(stop, sign=1):
+    """ Returns the amount a single stop adds to each of the trip totals.
+    Setting sign to -1 returns the amounts to take away. """
+    duration = stop['duration']
+
+    return {
+        'number_of_stops': sign,
+        'duration': sign * duration,
+        'total_accom_pp': sign * duration * stop['cost_accommodation'],
+        'total_food_pp': sign * duration * stop['cost_food'],
+        'total_other_pp': sign * duration * stop['cost_other']
+    }
+
+
+# update pipeline stage which recalculates the trip end date from its start
+# date and the duration in its summary
+END_DATE_STAGE = {
+    u"$set": {
+        u"end_date": {
+            u"$add": [
+                u"$start_date",
+                {
+                    u"$multiply": [
+                        {u"$ifNull": [u"$summary.duration", 0]},
+                        MS_PER_DAY
+                    ]
+                }
+            ]
+        }
+    }
+}
+
+
+def _country_in_use(trip_id, country):
+    """ Checks if any stops for this trip are still in a given country. """
+    return STORES.stops.country_in_use(trip_id, country)
+
+
+def _city_in_use(trip_id, city_town):
+    """ Checks if any stops for this trip are still in a given city or
+    town. """
+    return STORES.stops.city_in_use(trip_id, city_town)
+
+
+def _list_update(field, add=None, remove=None):
+    """ Creates the update pipeline expression for a list in the summary
+    (countries or cities) which removes one value and adds another, keeping
+    each value once. """
+    values = {u"$ifNull": [u"$summary." + field, []]}
+
+    # countries and cities are user input, so are wrapped in $literal to
+    # make sure they are never interpreted as a field path
+    if remove is not None:
+        values = {
+            u"$filter": {
+                u"input": values,
+                u"cond": {u"$ne": [u"$$this", {u"$literal": remove}]}
+            }
+        }
+
+    if add is not None:
+        values = {
+            u"$cond": {
+                u"if": {u"$in": [{u"$literal": add}, values]},
+                u"then": values,
+                u"else": {
+                    u"$concatArrays": [values, {u"$literal": [add]}]
+                }
+            }
+        }
+
+    return values
+
+
+def summary_update_pipeline(totals, add_country=None, remove_country=None,
+                            add_city=None, remove_city=None):
+    """
+    Creates a MongoDB update pipeline which applies the change in totals to
+    the trip summary and recalculates the trip end date. This is done as a
+    single update so that concurrent stop writes cannot overwrite each other.
+    """
+    stage = {}
+
+    for field, value in totals.items():
+        stage[u"summary." + field] = {
+            u"$add": [{u"$ifNull": [u"$summary." + field, 0]}, value]
+        }
+
+    stage[u"summary.countries"] = _list_update('countries', add_country,
+                                               remove_country)
+    stage[u"summary.cities"] = _list_update('cities', add_city, remove_city)
+    # the trip page shows the summary, so it has changed too
+    stage[u"updated_at"] = utc_now()
+
+    return [{u"$set": stage}, END_DATE_STAGE]
+
+
+def _update_summary(trip_id, totals, **places):
+    """ Applies the change in totals (and the countries and cities added or
+    removed, see summary_update_pipeline) to the trip summary and
+    recalculates the trip end date. """
+    STORES.trips.update_summary(trip_id, totals, **places)
+    forget_document('trips', trip_id)
+
+
+def stop_added(trip_id, stop):
+    """ Adds a new stop to the trip summary, gives it its dates and adds its
+    country and city to the stop form suggestions. """
+    _update_summary(trip_id, stop_totals(stop), add_country=stop['country'],
+                    add_city=stop['city_town'])
+    chain_stop_dates(trip_id, stop['_id'])
+    SUGGESTIONS.add(stop)
+
+
+def stop_removed(trip_id, stop):
+    """ Removes a deleted stop from the trip summary (and the suggestions),
+    and moves the stops after it forward. """
+    places = {}
+    if not _country_in_use(trip_id, stop['country']):
+        places['remove_country'] = stop['country']
+    if not _city_in_use(trip_id, stop['city_town']):
+        places['remove_city'] = stop['city_town']
+
+    _update_summary(trip_id, stop_totals(stop, sign=-1), **places)
+    chain_stop_dates(trip_id, stop['_id'])
+    SUGGESTIONS.remove(stop)
+
+
+def stop_updated(trip_id, old_stop, new_stop):
+    """ Replaces the previous values of an updated stop with the new values
+    in the trip summary (and the suggestions), and moves the stops after it
+    if its duration has changed. """
+    old_totals = stop_totals(old_stop, sign=-1)
+    totals = {field: value + old_totals[field]
+              for field, value in stop_totals(new_stop).items()}
+
+    places = {'add_country': new_stop['country'],
+              'add_city': new_stop['city_town']}
+    if old_stop['country'] != new_stop['country'] and \
+            not _country_in_use(trip_id, old_stop['country']):
+        places['remove_country'] = old_stop['country']
+    if old_stop['city_town'] != new_stop['city_town'] and \
+            not _city_in_use(trip_id, old_stop['city_town']):
+        places['remove_city'] = old_stop['city_town']
+
+    _update_summary(trip_id, totals, **places)
+    SUGGESTIONS.remove(old_stop)
+    SUGGESTIONS.add(new_stop)
+
+    if old_stop['duration'] != new_stop['duration']:
+        chain_stop_dates(trip_id, old_stop['_id'])
+
+
+def trip_dates_changed(trip_id):
+    """ Recalculates the end date of a trip, and the dates of its stops,
+    after its start date has been changed. """
+    STORES.trips.update_end_date(trip_id)
+    forget_document('trips', trip_id)
+    chain_stop_dates(trip_id)
+
+
+def summaries_pipeline(trip_ids):
+    """
+    Creates an aggregate MongoDB query which calculates the summary for each
+    trip_id in the list directly from the stops collection - the countries
+    and cities are listed once for each stop.
+    """
+    return [
+        {
+            u"$match": {
+                u"trip_id": {u"$in": list(trip_ids)}
+            }
+        },
+        {
+            # countries and cities are listed in the order stops were added
+            u"$sort": {
+                u"_id": 1
+            }
+        },
+        {
+            u"$group": {
+                u"_id": u"$trip_id",
+                u"number_of_stops": {
+                    u"$sum": 1
+                },
+                u"duration": {
+                    u"$sum": u"$duration"
+                },
+                u"total_accom_pp": {
+                    u"$sum": {
+                        u"$multiply": [u"$duration", u"$cost_accommodation"]
+                    }
+                },
+                u"total_food_pp": {
+                    u"$sum": {
+                        u"$multiply": [u"$duration", u"$cost_food"]
+                    }
+                },
+                u"total_other_pp": {
+                    u"$sum": {
+                        u"$multiply": [u"$duration", u"$cost_other"]
+                    }
+                },
+                u"countries": {
+                    u"$push": u"$country"
+                },
+                u"cities": {
+                    u"$push": u"$city_town"
+                }
+            }
+        }
+    ]
+
+
+def calculate_summaries(trip_ids):
+    """ Calculates the summary for each trip_id in the list directly from
+    its stops. Returns a dict of trip_id to summary - trips without any
+    stops are not included. """
+    return STORES.stops.summaries(list(trip_ids))
+
+
+def rebuild_summaries(batch_size=500, trip_ids=None, missing=False):
+    """
+    Recalculates the summary for every trip (or those in trip_ids, or those
+    whose summary does not list their cities yet if missing is True) from
+    the stops collection. This is used to backfill existing trips and to
+    repair any drift. Returns the number of trips updated.
+    """
+    if missing:
+        trip_ids = STORES.trips.ids_without_cities()
+        if not trip_ids:
+            return 0
+
+    updated = 0
+
+    for trips in STORES.trips.summary_batches(batch_size, trip_ids):
+        summaries = calculate_summaries(trip['_id'] for trip in trips)
+        updates = []
+
+        for trip in trips:
+            summary = summaries.get(trip['_id'], EMPTY_SUMMARY)
+            updates.append((trip['_id'], {
+                'summary': summary,
+                'end_date': trip['start_date'] +
+                            timedelta(days=summary['duration']),
+                'updated_at': utc_now()
+            }))
+
+        STORES.trips.update_many(updates)
+        updated += len(updates)
+
+    return updated
+
+
+def summaries_match(stored, calculated):
+    """ Compares a stored trip summary with a calculated one. Costs are
+    compared to 2 decimal places to allow for floating point drift from
+    the incremental updates. """
+    if not stored:
+        return False
+
+    for field in TOTAL_FIELDS:
+        if round(stored.get(field, 0), 2) != round(calculated[field], 2):
+            return False
+
+    return all(sorted(stored.get(field, [])) == sorted(calculated[field])
+               for field in ('countries', 'cities'))
+
+
+def check_summaries(batch_size=500, trip_ids=None):
+    """ Compares the stored summary of every trip (or those in trip_ids)
+    against the summary calculated from the stops collection. Returns a list
+    of the trip_id's which do not match. """
+    mismatched = []
+
+    for trips in STORES.trips.summary_batches(batch_size, trip_ids):
+        summaries = calculate_summaries(trip['_id'] for trip in trips)
+
+        for trip in trips:
+            calculated = summaries.get(trip['_id'], EMPTY_SUMMARY)
+            if not summaries_match(trip.get('summary'), calculated):
+                mismatched.append(trip['_id'])
+
+    return mismatched
+
+
+def get_trip_detail(trip):
+    """ Builds the trip overview figures used by trip_detailed from the
+    summary stored on the trip document. """
+    summary = trip.get('summary') or EMPTY_SUMMARY
+    travelers = trip['travelers']
+
+    trip_detail = dict(trip)
+    trip_detail.update({
+        'total_duration': summary['duration'],
+        'total_stops': summary['number_of_stops'],
+        'total_countries': len(summary['countries']),
+        'total_accom_pp': summary['total_accom_pp'],
+        'total_food_pp': summary['total_food_pp'],
+        'total_other_pp': summary['total_other_pp'],
+        'total_accom': travelers * summary['total_accom_pp'],
+        'total_food': travelers * summary['total_food_pp'],
+        'total_other': travelers * summary['total_other_pp']
+    })
+
+    trip_detail['trip_total_cost_pp'] = trip_detail['total_accom_pp'] + \
+        trip_detail['total_food_pp'] + trip_detail['total_other_pp']
+    trip_detail['trip_total_cost'] = trip_detail['total_accom'] + \
+        trip_detail['total_food'] + trip_detail['total_other']
+
+    if summary['duration']:
+        trip_detail['avg_cost_pn'] = trip_detail['trip_total_cost'] / \
+            summary['duration']
+
+    return trip_detail
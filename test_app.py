@@ -1,13 +1,42 @@
 # pylint: disable=redefined-outer-name
 """ Test travelPal functionality. """
+import io
+import json
+import os
+from collections import Counter
+from datetime import datetime, timedelta
 import tempfile
+from time import monotonic, sleep
 import pytest
-from app import APP
+from flask import current_app
+from bson.objectid import ObjectId
+from app import create_app
+from summary import check_summaries, trip_dates_changed
+from detail import server_version, trip_details_match, WINDOW_FUNCTIONS_VERSION
+from cache import ResultCache, RESULTS
+from monitoring import CommandStats, PoolStats
+from slowlog import plan_summary, query_shape
+from metrics import remove_snapshot, snapshot, start_writer
+from seed import seed_database
+from purge import delete_trip
+from storage import STORES
+from util import last_change, record_change
+from owners import set_display_name, backfill_owner_names
+from listing import date_filter
+from trip_calendar import feed_token, calendar_days
+from autocomplete import PrefixIndex, SUGGESTIONS
+from search import first_trip_ids, search_stops_pipeline
+import parallel
+from parallel import start_query
+
+
+# the settings (including the MongoDB URI) are read from the environment
+APP = create_app()
 
 
 @pytest.fixture
 def test_client():
-    """ APP is initialised in db.py.
+    """ APP is created above with create_app().
     Set additional config variables for testing environment. """
     # set flask config vars for testing
     APP.config["TESTING"] = True
@@ -17,9 +46,31 @@ def test_client():
     with APP.test_client() as test_client:
         yield test_client
 
+
+@pytest.fixture
+def memory_client():
+    """ A test client for an app which keeps its data in memory, seeded with
+    a small synthetic dataset - these tests do not need MongoDB. Yields the
+    client and the seeded counts (including the _id of the first user). """
+    app = create_app({"STORAGE": "memory", "TESTING": True,
+                      "WTF_CSRF_ENABLED": False})
+
+    with app.app_context():
+        counts = seed_database(users=20, trips=150, max_stops=10,
+                               large_trip_stops=30, seed=1)
+
+    with app.test_client() as test_client:
+        yield test_client, counts
+
 # helper functions used in the test functions
 
 
+def context_app():
+    """ Helper function run on a query pool, returning the app whose context
+    it is run in. """
+    return current_app._get_current_object()  # pylint: disable=protected-access
+
+
 def login(test_client, username):
     """ Helper function used to perform a user login. """
     return test_client.post("/user/login",
@@ -319,3 +370,805 @@ def test_add_update_stop_invalid_entry(test_client, username, url, valid_entry,
         # if this is a valid entry, expect to see inverse of above
         assert b'<span class="error">' not in response.data
         assert b'added a new stop' in response.data
+
+
+@pytest.mark.parametrize("page", [("/trips/?after=fakeCursor"),
+                                  ("/trips/all/?before=123_fakeID"),
+                                  ("/trips/all/?after=notanumber_5dee3e228f1db52b29cfce59")])
+def test_trips_invalid_cursor(test_client, page):
+    """ Pass invalid page cursors to the trips listing and ensure that
+    the first page of trips is displayed rather than an error. """
+    response = load_page(test_client, page)
+
+    assert response.status_code == 200
+    assert b"Trips" in response.data
+    # the first page never has a link to a previous page
+    assert b'rel="prev"' not in response.headers.get("Link", "").encode("utf-8")
+
+
+def test_trip_summary_matches_stops(test_client):
+    """ Add a stop to a trip and ensure the summary stored on the trip
+    still matches the figures calculated from its stops. """
+    login(test_client, "john")
+    submit_form(test_client, "/trip/5dee3e228f1db52b29cfce59/stop/new", {
+        'country': 'Ireland', 'city_town': 'Cork', 'currency': 'EUR',
+        'duration': '1', 'cost_accommodation': '40', 'cost_food': '20',
+        'cost_other': '10'})
+
+    assert check_summaries(trip_ids=[ObjectId("5dee3e228f1db52b29cfce59")]) == []
+
+
+def test_trip_detail_aggregation_matches_loop(test_client):
+    """ The trip_detailed aggregation should produce the same stop dates and
+    costs as the Python loop used for older MongoDB servers. """
+    with APP.app_context():
+        if server_version() < WINDOW_FUNCTIONS_VERSION:
+            pytest.skip("MongoDB server does not support $setWindowFields")
+
+        assert trip_details_match("5dee3e228f1db52b29cfce59")
+
+
+def test_result_cache_eviction_and_invalidation():
+    """ The result cache should evict the least recently used entry when full
+    and only remove the entries containing a trip when it changes. """
+    trip_id = ObjectId("5dee3e228f1db52b29cfce59")
+    cache = ResultCache(max_size=2)
+
+    cache.set(("trips", "", "all", False, False), ["page 1"], trip_ids=[trip_id])
+    cache.set(("trips", "", "all", "after", False), ["page 2"])
+    # reading page 1 makes page 2 the least recently used entry
+    assert cache.get(("trips", "", "all", False, False)) == ["page 1"]
+    cache.set(("trip", trip_id), "detail", trip_ids=[trip_id])
+
+    assert cache.get(("trips", "", "all", "after", False)) is None
+    assert cache.stats()["evictions"] == 1
+
+    cache.invalidate_trip(trip_id)
+    assert cache.get(("trips", "", "all", False, False)) is None
+    assert cache.get(("trip", trip_id)) is None
+    assert cache.stats()["size"] == 0
+
+
+def test_result_cache_versioned(memory_client):
+    """ A write made without removing the cached results, as one made by
+    another process would be, should still be seen on the next request -
+    the cached listing and trip detail are keyed by the data version. """
+    test_client, counts = memory_client
+    trip_id = str(counts["large_trip_id"])
+
+    def names():
+        return ([trip["name"] for trip in
+                 test_client.get("/api/trips/").get_json()["trips"]],
+                test_client.get("/api/trip/%s/" % trip_id).get_json()["trip"]["name"])
+
+    # the trip is moved onto the first page of the listing, and both pages
+    # are cached
+    with test_client.application.app_context():
+        STORES.trips.update(trip_id, {"public": True, "start_date": datetime(2000, 1, 1)})
+        record_change()
+    names()
+
+    with test_client.application.app_context():
+        STORES.trips.update(trip_id, {"name": "Renamed", "updated_at": datetime(2030, 1, 1)})
+        record_change()
+    listing, detail = names()
+    assert "Renamed" in listing and detail == "Renamed"
+
+
+@pytest.mark.parametrize("page", [("/trips/"),
+                                  ("/trip/5dee3e228f1db52b29cfce59/detailed/")])
+def test_conditional_get(test_client, page):
+    """ Request a page again with the ETag it was sent with and ensure that
+    a 304 response is returned without the page. """
+    response = test_client.get(page)
+    etag = response.headers.get("ETag")
+
+    assert response.status_code == 200
+    assert etag
+
+    response = test_client.get(page, headers={"If-None-Match": etag})
+
+    assert response.status_code == 304
+    assert response.data == b""
+
+
+@pytest.mark.parametrize("page,mimetype,expected", [
+    ("/export/trips.ndjson", "application/x-ndjson", b'"trip_id": "5dee3e228f1db52b29cfce59"'),
+    ("/export/trips.csv?batch_size=1", "text/csv", b"trip_id,name,owner_id")])
+def test_trips_export(test_client, page, mimetype, expected):
+    """ Export the trips in each format and ensure that the trips are
+    included in the response. """
+    response = test_client.get(page)
+
+    assert response.status_code == 200
+    assert response.mimetype == mimetype
+    assert expected in response.data
+
+
+@pytest.mark.parametrize("filename,contents,expected", [
+    # the second row has an invalid currency and duration
+    ("stops.csv", b"country,city_town,currency,duration,cost_accommodation,cost_food,cost_other\n"
+                  b"Ireland,Cork,EUR,2,50,20,10\nIreland,Dublin,EUROS,0,50,20,10\n",
+     b"No stops were imported"),
+    ("stops.json", b"not json", b"not valid JSON"),
+    ("stops.txt", b"Ireland", b"Only CSV or JSON files")])
+def test_stop_import_invalid_file(test_client, filename, contents, expected):
+    """ Import a file containing invalid stops and ensure that the errors are
+    shown and no stops are added. """
+    login(test_client, "john")
+    response = test_client.post("/trip/5dee3e228f1db52b29cfce59/stop/import/",
+                                data={"stops_file": (io.BytesIO(contents), filename)},
+                                content_type="multipart/form-data",
+                                follow_redirects=True)
+
+    assert response.status_code == 200
+    assert expected in response.data
+    assert b"stops have been imported" not in response.data
+
+
+def test_stop_import_rolled_back(memory_client, monkeypatch):
+    """ If the stop dates cannot be set after the stops of an import have
+    been added, the stops should be removed again and the trip summary
+    should not count them. """
+    test_client, counts = memory_client
+    trip_id = counts["large_trip_id"]
+    with test_client.session_transaction() as session:
+        session["USERNAME"] = str(counts["user_id"])
+    with test_client.application.app_context():
+        stop_ids = set(STORES.stops.ids_for_trip(trip_id))
+
+    def fail(*args):
+        raise RuntimeError("chaining failed")
+    monkeypatch.setattr("stop_import.chain_stop_dates", fail)
+
+    contents = (b"country,city_town,currency,duration,cost_accommodation,cost_food,cost_other\n"
+                b"Ireland,Cork,EUR,2,50,20,10\nIreland,Dublin,EUR,1,50,20,10\n")
+    response = test_client.post("/trip/%s/stop/import/" % trip_id,
+                                data={"stops_file": (io.BytesIO(contents), "stops.csv")},
+                                content_type="multipart/form-data",
+                                follow_redirects=True)
+
+    assert b"no stops were imported" in response.data
+    with test_client.application.app_context():
+        assert set(STORES.stops.ids_for_trip(trip_id)) == stop_ids
+        assert check_summaries(trip_ids=[trip_id]) == []
+
+
+def test_trip_clone(test_client):
+    """ Clone a trip and ensure that the copy, with its stops, is shown. """
+    login(test_client, "john")
+    response = load_page(test_client, "/trip/5dee3e228f1db52b29cfce59/clone/")
+
+    assert response.status_code == 200
+    assert b"copied to your trips" in response.data
+
+
+def test_deleted_trip_hidden(test_client):
+    """ Create and then delete a trip, and ensure that it can no longer be
+    viewed even before its stops have been purged. """
+    login(test_client, "john")
+    response = test_client.post("/trip/new/", data={
+        'name': 'Deleted Trip', 'travelers': '1', 'start_date': '12 Dec 2020',
+        'public': 'True'})
+    trip_page = response.headers["Location"]
+
+    load_page(test_client, trip_page.replace("/detailed/", "/delete/"))
+    response = load_page(test_client, trip_page)
+
+    assert b"does not exist" in response.data
+    assert b"Deleted Trip" not in response.data
+
+
+@pytest.mark.parametrize("page,status_code,expected", [
+    ("/api/trips/", 200, b'"trips"'),
+    ("/api/trips/user/", 401, b'"error"'),
+    ("/api/trip/5dee3e228f1db52b29cfce59/", 200, b'"stops"'),
+    ("/api/trip/fakeID/", 404, b'"error"')])
+def test_json_api(test_client, page, status_code, expected):
+    """ Request the JSON read API when not logged in and ensure that the
+    expected status code and data is returned. """
+    response = test_client.get(page)
+
+    assert response.status_code == status_code
+    assert response.is_json
+    assert expected in response.data
+
+
+def test_db_monitoring_listeners():
+    """ The monitoring listeners should record command latency by command
+    name and the number of pool connections in use. """
+    class Event:  # pylint: disable=too-few-public-methods
+        """ Stand in for the pymongo monitoring events. """
+        command_name = "find"
+        duration_micros = 3000
+
+    commands = CommandStats()
+    commands.succeeded(Event())
+    commands.failed(Event())
+
+    assert commands.stats()["find"]["count"] == 2
+    assert commands.stats()["find"]["failures"] == 1
+    assert commands.stats()["find"]["buckets"]["5"] == 2
+
+    pool = PoolStats()
+    for _ in range(2):
+        pool.connection_check_out_started(Event())
+        pool.connection_checked_out(Event())
+    pool.connection_checked_in(Event())
+
+    assert pool.stats()["in_use"] == 1
+    assert pool.stats()["max_in_use"] == 2
+    assert pool.stats()["checkout_wait"]["count"] == 2
+
+
+def test_metrics(memory_client):
+    """ Make a request and ensure that it is counted in the metrics, which
+    are in the Prometheus text format, labelled with each worker and served
+    only with the STATS_TOKEN, and that the worker's metrics are written to
+    METRICS_DIR by the writer thread rather than by the request. """
+    test_client, _ = memory_client
+    app = test_client.application
+    headers = {"Authorization": "Bearer secret"}
+
+    for page in ("/metrics", "/db/stats/", "/cache/stats/"):
+        assert test_client.get(page, headers=headers).status_code == 404
+
+    app.config["STATS_TOKEN"] = "secret"
+    assert test_client.get("/cache/stats/").status_code == 404
+    assert test_client.get("/cache/stats/", headers=headers).status_code == 200
+
+    with tempfile.TemporaryDirectory() as directory:
+        app.config["METRICS_DIR"] = directory
+        # another worker's metrics, as written to METRICS_DIR
+        with open(os.path.join(directory, "worker-1.json"), "w") as other:
+            json.dump(dict(snapshot(), requests=[["main.api_trips", "GET", 200, 3]]),
+                      other)
+
+        response = test_client.get("/metrics", headers=headers)
+        path = os.path.join(directory, "worker-%d.json" % os.getpid())
+        assert not os.path.exists(path)
+
+        start_writer(directory)
+        deadline = monotonic() + 5
+        while not os.path.exists(path) and monotonic() < deadline:
+            sleep(0.01)
+        with open(path) as written:
+            assert json.load(written)["requests"]
+        remove_snapshot(directory)
+        assert not os.path.exists(path)
+
+    assert response.status_code == 200
+    assert response.mimetype == "text/plain"
+    assert b'# TYPE travelpal_http_request_duration_seconds histogram' in response.data
+    assert ('travelpal_http_requests_total{endpoint="main.cache_stats",method="GET",'
+            'status="200",worker="%d"}' % os.getpid()).encode() in response.data
+    assert b'travelpal_http_requests_total{endpoint="main.api_trips",method="GET",' \
+        b'status="200",worker="1"} 3' in response.data
+
+
+def test_slow_query_shape():
+    """ Ensure the values in a query are redacted from its shape in the slow
+    query log, while the fields, operators and field paths are kept. """
+    pipeline = [
+        {"$match": {"owner_id": ObjectId(), "name": "Paris",
+                    "country": "$secret", "city_town": {"$in": ["$a", "$b"]},
+                    "start_date": {"$gte": "2020-01-01"},
+                    "_id": {"$in": [ObjectId(), ObjectId()]}}},
+        {"$addFields": {"country": {"$literal": "France"},
+                        "total": {"$add": ["$cost", 10]}}},
+        {"$group": {"_id": "$trip_id"}}
+    ]
+
+    assert query_shape(pipeline) == [
+        {"$match": {"owner_id": "?", "name": "?", "country": "?", "city_town": {"$in": "?"},
+                    "start_date": {"$gte": "?"}, "_id": {"$in": "?"}}},
+        {"$addFields": {"country": {"$literal": "?"}, "total": {"$add": ["$cost", "?"]}}},
+        {"$group": {"_id": "$trip_id"}}
+    ]
+    assert query_shape({"country": "$secret"}) == {"country": "?"}
+
+
+def test_slow_query_plan_summary():
+    """ Ensure only the plan of an explained query is logged, without the
+    command, parsed query or index bounds, which hold the query's values. """
+    owner_id = ObjectId()
+    scan = {"stage": "IXSCAN", "indexName": "owner_id_start_date",
+            "indexBounds": {"owner_id": ["[%s, %s]" % (owner_id, owner_id)]}}
+    planner = {"parsedQuery": {"owner_id": {"$eq": owner_id}},
+               "winningPlan": {"stage": "FETCH", "filter": {"name": "Paris"},
+                               "inputStage": scan}}
+    stats = {"totalKeysExamined": 12, "totalDocsExamined": 10,
+             "nReturned": 10, "executionTimeMillis": 3}
+    expected = {"plan": ["FETCH", "IXSCAN"], "indexes": ["owner_id_start_date"],
+                "keys_examined": 12, "docs_examined": 10, "returned": 10, "ms": 3}
+
+    aggregate = {"command": {"pipeline": [{"$match": {"owner_id": owner_id}}]},
+                 "stages": [{"$cursor": {"queryPlanner": planner,
+                                         "executionStats": stats}},
+                            {"$group": {"_id": "$trip_id"}}]}
+    find = {"command": {"filter": {"owner_id": owner_id}},
+            "queryPlanner": dict(planner, winningPlan={
+                "queryPlan": planner["winningPlan"]}),
+            "executionStats": stats}
+
+    for explain in (aggregate, find):
+        summary = plan_summary(explain)
+        assert summary == expected
+        assert str(owner_id) not in json.dumps(summary)
+        assert "Paris" not in json.dumps(summary)
+
+
+def test_memory_storage_listing(memory_client):
+    """ Page forwards and back through the trips listing of the in-memory
+    store and ensure that every trip is listed once, in order. """
+    test_client, counts = memory_client
+    with test_client.session_transaction() as session:
+        session["USERNAME"] = str(counts["user_id"])
+
+    pages, url = [], "/api/trips/"
+    while url:
+        data = test_client.get(url).get_json()
+        pages.append([(trip["start_date"], trip["_id"]) for trip in data["trips"]])
+        url = data["next"]
+
+    trips = [trip for page in pages for trip in page]
+    assert len(pages) > 2
+    assert trips == sorted(set(trips))
+
+    # the previous page links lead back through the same pages
+    for page in reversed(pages[:-1]):
+        data = test_client.get(data["prev"]).get_json()
+        assert [(trip["start_date"], trip["_id"]) for trip in data["trips"]] == page
+
+
+@pytest.mark.parametrize("args, dates", [
+    ({}, None),
+    ({"when": "upcoming"}, (datetime(2020, 5, 2), None, None)),
+    ({"when": "in_progress"}, (None, datetime(2020, 5, 1), datetime(2020, 5, 1))),
+    ({"when": "between", "from": "2019-01-01", "to": "2019-02-01"},
+     (None, datetime(2019, 2, 1), datetime(2019, 1, 1))),
+    ({"when": "between", "from": "2019-02-01", "to": "2019-01-01"}, None),
+    ({"when": "between", "from": "bad"}, None),
+    ({"when": "soon"}, None)
+])
+def test_date_filter(args, dates):
+    """ The date filter of the trips listing should be read from the query
+    string, and ignored if it is not valid. """
+    assert date_filter(args, today=datetime(2020, 5, 1))[0] == dates
+
+
+def test_memory_storage_date_filter(memory_client):
+    """ Page through the trips listing filtered to trips taking place between
+    two dates, and ensure that it lists exactly those trips. """
+    test_client, _ = memory_client
+
+    def listed(url):
+        trips = []
+        while url:
+            data = test_client.get(url).get_json()
+            trips += [trip["_id"] for trip in data["trips"]]
+            url = data["next"]
+        return trips
+
+    with test_client.application.app_context():
+        everything = STORES.trips.listing("", "all", False, False, 1000)
+    expected = [str(trip["_id"]) for trip in everything
+                if trip["start_date"] <= datetime(2018, 12, 31) and
+                trip["end_date"] >= datetime(2017, 1, 1)]
+
+    assert 0 < len(expected) < len(everything)
+    assert listed("/api/trips/?when=between&from=2017-01-01&to=2018-12-31") == expected
+
+
+def test_memory_storage_stops(memory_client):
+    """ Add, update and remove stops of a trip in the in-memory store and
+    ensure that the trip summary and detail match its stops. """
+    test_client, counts = memory_client
+    trip_id = str(counts["large_trip_id"])
+    stop = {"country": "Ireland", "city_town": "Cork", "currency": "EUR",
+            "duration": "3", "cost_accommodation": "40", "cost_food": "20",
+            "cost_other": "10"}
+
+    with test_client.session_transaction() as session:
+        session["USERNAME"] = str(counts["user_id"])
+
+    submit_form(test_client, "/trip/%s/stop/new/" % trip_id, stop)
+    stops = test_client.get("/api/trip/%s/" % trip_id).get_json()["stops"]
+    assert len(stops) == 31
+    assert stops[-1]["city_town"] == "Cork"
+
+    stop_url = "/trip/%s/stop/%s/" % (trip_id, stops[0]["stop_id"])
+    submit_form(test_client, stop_url + "update/", dict(stop, country="France"))
+    load_page(test_client, stop_url.replace(stops[0]["stop_id"], stops[1]["stop_id"]) + "delete/")
+
+    with test_client.application.app_context():
+        assert check_summaries() == []
+        assert trip_details_match(trip_id)
+
+    data = test_client.get("/api/trip/%s/" % trip_id).get_json()
+    assert data["trip"]["total_stops"] == 30
+    assert data["stops"][0]["country"] == "France"
+
+
+def test_apps_do_not_share_results():
+    """ Ensure that two apps in the same process each list and suggest from
+    their own data rather than from the other app's cached results. """
+    apps = [create_app({"STORAGE": "memory", "TESTING": True})
+            for _ in range(2)]
+    listings = []
+
+    for seed, app in enumerate(apps, 1):
+        with app.app_context():
+            counts = seed_database(users=5, trips=20, max_stops=3,
+                                   large_trip_stops=5, seed=seed)
+
+        with app.test_client() as test_client:
+            with test_client.session_transaction() as session:
+                session["USERNAME"] = str(counts["user_id"])
+            listings.append([trip["_id"] for trip in
+                             test_client.get("/api/trips/").get_json()["trips"]])
+            with app.app_context():
+                assert RESULTS.stats()["size"] == 1
+                SUGGESTIONS.build()
+
+    assert listings[0] != listings[1]
+    assert not set(listings[0]) & set(listings[1])
+    assert apps[0].extensions["result_cache"] is not \
+        apps[1].extensions["result_cache"]
+    assert apps[0].extensions["suggestions"] is not \
+        apps[1].extensions["suggestions"]
+
+    # the second app's listing is read again from its own cache
+    with apps[1].test_client() as test_client:
+        with test_client.session_transaction() as session:
+            session["USERNAME"] = str(counts["user_id"])
+        trips = test_client.get("/api/trips/").get_json()["trips"]
+    assert [trip["_id"] for trip in trips] == listings[1]
+
+
+def test_query_pool_per_app():
+    """ Ensure that each app runs its queries on its own pool, and that
+    shutting down the pool of one app leaves the other app's pool running
+    and the first app running its queries one after another. """
+    first = create_app({"STORAGE": "memory", "QUERY_WORKERS": 2})
+    second = create_app({"STORAGE": "memory", "QUERY_WORKERS": 2})
+    first_pool = first.extensions["query_pool"]
+    assert first_pool is not second.extensions["query_pool"]
+
+    parallel.shutdown(first)
+    assert first.extensions["query_pool"] is None
+
+    with first.app_context():
+        assert start_query(context_app).result() is first
+    with second.app_context():
+        assert start_query(context_app).result() is second
+
+    parallel.shutdown(second)
+
+
+def test_stop_form_duration_after_permission(memory_client, monkeypatch):
+    """ The stop forms should only query the trip's total duration once the
+    user has been found to own the trip. """
+    test_client, counts = memory_client
+    with test_client.session_transaction() as session:
+        session["USERNAME"] = str(counts["user_id"])
+    queried = []
+    monkeypatch.setattr("views.get_trip_duration",
+                        lambda trip_id: queried.append(trip_id) or 0)
+
+    missing = str(ObjectId())
+    load_page(test_client, "/trip/%s/stop/new/" % missing)
+    load_page(test_client, "/trip/%s/stop/%s/update/" % (missing, missing))
+    assert queried == []
+
+    trip_id = str(counts["large_trip_id"])
+    assert test_client.get("/trip/%s/stop/new/" % trip_id).status_code == 200
+    assert queried == [trip_id]
+
+
+def test_server_version_per_app():
+    """ Ensure that each app asks its own MongoDB server for its version,
+    and only once. """
+    class Client:
+        """ Stands in for a MongoClient connected to a server of a version. """
+
+        def __init__(self, version):
+            self.version = version
+            self.calls = 0
+
+        def server_info(self):
+            """ Returns the version of the server. """
+            self.calls += 1
+            return {"versionArray": list(self.version) + [0, 0]}
+
+    old, new = Client((4, 4)), Client((6, 0))
+    first = create_app({"STORAGE": "memory", "MONGO_CLIENT": old})
+    second = create_app({"STORAGE": "memory", "MONGO_CLIENT": new})
+
+    for _ in range(2):
+        with first.app_context():
+            assert server_version() == (4, 4) < WINDOW_FUNCTIONS_VERSION
+        with second.app_context():
+            assert server_version() == (6, 0)
+    assert (old.calls, new.calls) == (1, 1)
+
+
+def test_owner_display_names(memory_client):
+    """ Rename a user, and backfill trips which do not have the owner's
+    display name, and ensure that the trips listing shows the new names. """
+    test_client, counts = memory_client
+    user_id = counts["user_id"]
+    with test_client.session_transaction() as session:
+        session["USERNAME"] = str(user_id)
+
+    def owner_names():
+        trips = test_client.get("/api/trips/user/").get_json()["trips"]
+        return {trip.get("username") for trip in trips}
+
+    assert owner_names() == {"User 0"}
+
+    with test_client.application.app_context():
+        set_display_name(user_id, "Renamed")
+    assert owner_names() == {"Renamed"}
+
+    # a trip created before the owner's display name was stored on trips
+    with test_client.application.app_context():
+        trip = STORES.trips.find(counts["large_trip_id"])
+        STORES.trips.insert({field: value for field, value in trip.items()
+                             if field not in ("_id", "owner_display_name")})
+        assert STORES.trips.owners_without_display_name() == [user_id]
+        assert backfill_owner_names(batch_size=1) == 1
+        assert STORES.trips.owners_without_display_name() == []
+        assert {trip["username"] for trip in STORES.trips.listing(
+            user_id, "user", False, False, 1000)} == {"Renamed"}
+
+
+def test_calendar_feed(memory_client, monkeypatch):
+    """ The calendar feed should have an event for each stop of the user's
+    trips, send a 304 while they are unchanged and be rebuilt when one of
+    their stops changes, or a trip is changed by another process (without
+    removing the cached feed), but not when another user's trips change. """
+    test_client, counts = memory_client
+    trip_id = str(counts["large_trip_id"])
+    with test_client.session_transaction() as session:
+        session["USERNAME"] = str(counts["user_id"])
+    with test_client.application.test_request_context():
+        feed_url = "/calendar/%s.ics" % feed_token(counts["user_id"])
+
+    feed = test_client.get(feed_url)
+    assert feed.mimetype == "text/calendar"
+    assert feed.data.count(b"BEGIN:VEVENT") >= 30
+    assert all(len(line) <= 75 for line in feed.data.split(b"\r\n"))
+    etag = feed.headers["ETag"]
+    assert test_client.get(feed_url, headers={"If-None-Match": etag}).status_code == 304
+
+    submit_form(test_client, "/trip/%s/stop/new/" % trip_id,
+                {"country": "Ireland", "city_town": "Cork", "currency": "EUR",
+                 "duration": "3", "cost_accommodation": "40", "cost_food": "20",
+                 "cost_other": "10"})
+    feed = test_client.get(feed_url, headers={"If-None-Match": etag})
+    assert feed.status_code == 200
+    assert b"SUMMARY:Cork\\, Ireland" in feed.data
+
+    with test_client.application.app_context():
+        STORES.trips.update(trip_id, {"name": "Renamed"})
+        record_change(counts["user_id"])
+    feed = test_client.get(feed_url, headers={"If-None-Match": feed.headers["ETag"]})
+    assert feed.status_code == 200
+    assert b"DESCRIPTION:Renamed" in feed.data
+
+    # another user's change leaves the cached feed in use
+    built = []
+    monkeypatch.setattr("trip_calendar.build_calendar",
+                        lambda user_id: built.append(user_id))
+    with test_client.application.app_context():
+        version = last_change()["version"]
+        record_change(ObjectId())
+        assert last_change()["version"] > version
+    feed = test_client.get(feed_url, headers={"If-None-Match": feed.headers["ETag"]})
+    assert feed.status_code == 304
+    assert built == []
+
+    assert test_client.get("/calendar/%s.ics" % "not-a-token").status_code == 404
+    assert test_client.get("/calendar/?view=week").status_code == 200
+
+
+@pytest.mark.parametrize("day, view, first, last", [
+    (datetime(2021, 2, 10), "month", datetime(2021, 2, 1), datetime(2021, 2, 28)),
+    (datetime(2021, 3, 31), "month", datetime(2021, 3, 1), datetime(2021, 4, 4)),
+    (datetime(2021, 3, 31), "week", datetime(2021, 3, 29), datetime(2021, 4, 4))
+])
+def test_calendar_days(day, view, first, last):
+    """ The calendar page should show whole weeks, from Monday to Sunday,
+    covering the month or week of the day. """
+    weeks = calendar_days(day, view)[0]
+    assert (weeks[0][0], weeks[-1][-1]) == (first, last)
+    assert all(len(week) == 7 for week in weeks)
+
+
+def test_stop_dates_and_search(memory_client):
+    """ The dates stored on the stops should follow the trip's stops as they
+    are changed, and the trip search should find the trip by them - including
+    on a day after a stop started which it is still going on. """
+    test_client, counts = memory_client
+    trip_id = str(counts["large_trip_id"])
+    stop = {"country": "Ireland", "city_town": "Cork", "currency": "EUR",
+            "duration": "3", "cost_accommodation": "40", "cost_food": "20",
+            "cost_other": "10"}
+    with test_client.session_transaction() as session:
+        session["USERNAME"] = str(counts["user_id"])
+
+    def stop_dates():
+        with test_client.application.app_context():
+            return [(stop["start_date"], stop["end_date"])
+                    for stop in STORES.stops.for_trip(trip_id)]
+
+    def detail_dates():
+        stops = test_client.get("/api/trip/%s/" % trip_id).get_json()["stops"]
+        return [(datetime.fromisoformat(stop["stop_start_date"]),
+                 datetime.fromisoformat(stop["stop_end_date"])) for stop in stops]
+
+    submit_form(test_client, "/trip/%s/stop/new/" % trip_id, stop)
+    stops = test_client.get("/api/trip/%s/" % trip_id).get_json()["stops"]
+    stop_url = "/trip/%s/stop/%s/" % (trip_id, stops[3]["stop_id"])
+    submit_form(test_client, stop_url + "update/", dict(stop, duration="10"))
+    load_page(test_client, "/trip/%s/stop/%s/delete/" % (trip_id, stops[1]["stop_id"]))
+    assert stop_dates() == detail_dates()
+
+    with test_client.application.app_context():
+        start_date = [stop["start_date"] for stop in STORES.stops.for_trip(trip_id)
+                      if stop["city_town"] == "Cork"][-1]
+    for day in (start_date, start_date + timedelta(days=2)):
+        day = day.strftime("%Y-%m-%d")
+        search = "/api/search/?country=ireland&city_town=cork&from=%s&to=%s" % (day, day)
+        assert trip_id in [trip["_id"] for trip in test_client.get(search).get_json()["trips"]]
+    assert test_client.get("/api/search/?from=2020-01-01").status_code == 400
+
+
+def test_search_stops_read_in_page_order():
+    """ The trip search should read the matching stops in page order, with
+    no blocking stage, and stop reading them once a page of trips has been
+    found. """
+    search = {"text": None, "country": "Japan", "city_town": None,
+              "date_from": None, "date_to": None}
+    stages = [next(iter(stage)) for stage in
+              search_stops_pipeline(ObjectId(), search, None, None)]
+    assert stages == ["$match", "$sort", "$project"]
+
+    read = []
+
+    def stops():
+        for trip_id in (1, 1, 2, 3, 3, 3, 4, 5):
+            read.append(trip_id)
+            yield {"trip_id": trip_id}
+
+    assert first_trip_ids(stops(), 3) == [1, 2, 3]
+    assert read == [1, 1, 2, 3]
+
+
+def test_search_pages(memory_client):
+    """ Paging through the trip search forwards and back should give every
+    trip the user can see with a stop in the country once, in listing order,
+    and follow changes to a trip's visibility and deletion. """
+    test_client, counts = memory_client
+    user_id = counts["user_id"]
+    test_client.application.config["TRIPS_PER_PAGE"] = 3
+    with test_client.session_transaction() as session:
+        session["USERNAME"] = str(user_id)
+
+    def visible_stops():
+        """ Yields each stop of the trips the user can see, with its trip. """
+        with test_client.application.app_context():
+            for trip in STORES.trips.listing(user_id, "all", False, False, limit=1000):
+                for stop in STORES.stops.for_trip(trip["_id"]):
+                    yield trip, stop
+
+    def expected():
+        """ The trips with a stop in the country, in listing order. """
+        trips = {trip["_id"]: trip for trip, stop in visible_stops()
+                 if stop["country"] == country}
+        return [str(trip["_id"]) for trip in
+                sorted(trips.values(), key=lambda trip: (trip["start_date"], trip["_id"]))]
+
+    def pages(url):
+        found, urls = [], []
+        while url:
+            data = test_client.get(url).get_json()
+            found += [trip["_id"] for trip in data["trips"]]
+            urls.append(url)
+            url = data["next"]
+        return found, urls, data
+
+    country = Counter(stop["country"] for _, stop in visible_stops()).most_common(1)[0][0]
+    found, urls, last = pages("/api/search/?country=%s" % country)
+    assert len(urls) > 2
+    assert found == expected()
+
+    # and back again from the last page
+    previous = test_client.get(last["prev"]).get_json()
+    assert [trip["_id"] for trip in previous["trips"]] == \
+        found[-len(last["trips"]) - len(previous["trips"]):-len(last["trips"])]
+
+    # the user's own trip is hidden once deleted, and another user's trip
+    # once it is made private
+    with test_client.application.app_context():
+        own = next(trip_id for trip_id in found
+                   if STORES.trips.find(trip_id)["owner_id"] == user_id)
+        other = next(trip_id for trip_id in found
+                     if STORES.trips.find(trip_id)["owner_id"] != user_id)
+        delete_trip(own)
+        STORES.trips.update(other, {"public": False})
+        trip_dates_changed(other)
+        record_change()
+
+    found, _, _ = pages("/api/search/?country=%s" % country)
+    assert own not in found and other not in found
+    assert found == expected()
+
+
+def test_text_search_and_autocomplete(memory_client):
+    """ The text search should find trips by the words in their name and the
+    cities of their stops, and the stop form suggestions should follow the
+    stops as they are added and updated. """
+    test_client, counts = memory_client
+    trip_id = str(counts["large_trip_id"])
+    stop = {"country": "Brazil", "city_town": "Ouro Prêto", "currency": "BRL",
+            "duration": "2", "cost_accommodation": "40", "cost_food": "20",
+            "cost_other": "10"}
+    with test_client.session_transaction() as session:
+        session["USERNAME"] = str(counts["user_id"])
+
+    # the suggestions are built before the stop is added, so it is added
+    # to them incrementally
+    assert test_client.get("/api/autocomplete/city_town/?q=ouro").get_json() == \
+        {"suggestions": []}
+    submit_form(test_client, "/trip/%s/stop/new/" % trip_id, stop)
+    assert test_client.get("/api/autocomplete/city_town/?q=OURO PRE").get_json() == \
+        {"suggestions": ["Ouro Prêto"]}
+
+    search = test_client.get("/api/search/?q=ouro+preto").get_json()
+    assert [trip["_id"] for trip in search["trips"]] == [trip_id]
+
+    stops = test_client.get("/api/trip/%s/" % trip_id).get_json()["stops"]
+    submit_form(test_client, "/trip/%s/stop/%s/update/" % (trip_id, stops[-1]["stop_id"]),
+                dict(stop, city_town="Rio"))
+    assert test_client.get("/api/autocomplete/city_town/?q=ouro").get_json() == \
+        {"suggestions": []}
+    assert test_client.get("/api/search/?q=preto").get_json()["trips"] == []
+    with test_client.application.app_context():
+        assert check_summaries() == []
+
+    assert test_client.get("/api/autocomplete/currency/?q=e").status_code == 404
+
+
+def test_autocomplete_rebuild(memory_client):
+    """ Once the stop form suggestions are too old they should be rebuilt
+    in the background, with the old suggestions used until it has finished,
+    and the suggestions kept for short prefixes should follow the stops this
+    process writes. """
+    test_client, counts = memory_client
+    stop = {"trip_id": counts["large_trip_id"], "country": "Brazil",
+            "city_town": "Ouro Prêto", "duration": 2}
+    index = PrefixIndex(max_age=60)
+
+    with test_client.application.app_context():
+        assert index.suggest("city_town", "ou") == []
+
+        # written by another process, so only the rebuild finds it - the
+        # rebuild waits for the build lock, so is still running
+        STORES.stops.insert(dict(stop))
+        index.built_at -= 120
+        built_at = index.built_at
+        with index._build_lock:  # pylint: disable=protected-access
+            assert index.suggest("city_town", "ou") == []
+
+        started = monotonic()
+        while index.built_at == built_at and monotonic() - started < 5:
+            sleep(0.01)
+        assert index.suggest("city_town", "ou") == ["Ouro Prêto"]
+
+        ourense = dict(stop, city_town="Ourense")
+        index.add(ourense, ourense)
+        assert index.suggest("city_town", "ou") == ["Ourense", "Ouro Prêto"]
+        index.remove(ourense, ourense)
+        assert index.suggest("city_town", "ou") == ["Ouro Prêto"]
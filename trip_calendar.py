@@ -0,0 +1,208 @@
+""" This builds the calendar of a user's trips, where each stop is an event
+with the start and end dates chained as on trip_detailed (see
+detail.stop_details). It is shown a month or a week at a time by the calendar
+page and published as an iCalendar (.ics) feed for calendar clients to
+subscribe to. Clients poll the feed constantly, so each user's calendar is
+built once and kept in the query cache until one of their trips or stops
+changes. """
+from datetime import datetime, timedelta
+from hashlib import sha1
+from flask import current_app, url_for
+from itsdangerous import URLSafeSerializer, BadData
+from cache import RESULTS
+from conditional import trip_last_modified
+from export import export_trips
+from util import check_id
+
+# longest line of an iCalendar file in octets (RFC 5545), longer lines are
+# folded onto continuation lines
+ICS_LINE_OCTETS = 75
+
+
+def _serializer():
+    """ Returns the serializer which signs the feed tokens. """
+    return URLSafeSerializer(current_app.config['SECRET_KEY'],
+                             salt='calendar-feed')
+
+
+def feed_token(user_id):
+    """ Returns the token in the URL of a user's calendar feed - calendar
+    clients do not log in, so the token identifies the user. """
+    return _serializer().dumps(str(user_id))
+
+
+def feed_user(token):
+    """ Returns the user_id of a calendar feed token, or False if the token
+    is not valid. """
+    try:
+        return check_id(_serializer().loads(token))
+    except BadData:
+        return False
+
+
+def _escape(text):
+    """ Escapes a text value of an iCalendar property. """
+    return str(text).replace('\\', '\\\\').replace(';', '\\;') \
+        .replace(',', '\\,').replace('\n', '\\n')
+
+
+def _fold(line):
+    """ Returns an iCalendar content line, folded so that no line is longer
+    than ICS_LINE_OCTETS, and ending with CRLF. """
+    folded, length = [], 0
+
+    for char in line:
+        octets = len(char.encode('utf-8'))
+        if length + octets > ICS_LINE_OCTETS:
+            # continuation lines start with a space, which counts towards
+            # their length
+            folded.append('\r\n ')
+            length = 1
+        folded.append(char)
+        length += octets
+
+    return ''.join(folded) + '\r\n'
+
+
+def _ics_date(value):
+    """ Formats a date as an iCalendar DATE value. """
+    return value.strftime('%Y%m%d')
+
+
+def trip_events(trip, stops):
+    """ Returns an event for each stop of a trip, in the order of the
+    stops. """
+    updated_at = trip_last_modified(trip)
+
+    return [{
+        'trip_id': trip['_id'],
+        'trip_name': trip['name'],
+        'stop_id': stop['stop_id'],
+        'city_town': stop['city_town'],
+        'country': stop['country'],
+        'start': stop['stop_start_date'],
+        'end': stop['stop_end_date'],
+        'updated_at': updated_at
+    } for stop in stops]
+
+
+def ics_event(event):
+    """ Returns the iCalendar VEVENT for an event. Stops take whole days, so
+    the dates are all-day values and the end date is the day after the stop
+    ends, as the stop end date already is. """
+    lines = [
+        'BEGIN:VEVENT',
+        'UID:%s@travelpal' % event['stop_id'],
+        'DTSTAMP:%s' % event['updated_at'].strftime('%Y%m%dT%H%M%SZ'),
+        'DTSTART;VALUE=DATE:%s' % _ics_date(event['start']),
+        'DTEND;VALUE=DATE:%s' % _ics_date(event['end']),
+        'SUMMARY:%s' % _escape('%s, %s' % (event['city_town'],
+                                           event['country'])),
+        'DESCRIPTION:%s' % _escape(event['trip_name']),
+        'URL:%s' % url_for('main.trip_detailed', trip_id=event['trip_id'],
+                           _external=True),
+        'END:VEVENT'
+    ]
+
+    return ''.join(_fold(line) for line in lines)
+
+
+def build_calendar(user_id):
+    """ Returns a (calendar, trip_ids) tuple for a user, where trip_ids are
+    the _id's of their trips and calendar is an (events, feed, etag) tuple -
+    feed is the .ics file as a list of chunks, the header, one for each
+    event and the footer. """
+    events, trip_ids = [], []
+
+    for trip, stops in export_trips(user_id, owned=True):
+        events += trip_events(trip, stops)
+        trip_ids.append(trip['_id'])
+
+    feed = [''.join(_fold(line) for line in (
+        'BEGIN:VCALENDAR',
+        'VERSION:2.0',
+        'PRODID:-//travelPal//Trips//EN',
+        'CALSCALE:GREGORIAN',
+        'X-WR-CALNAME:travelPal trips'))]
+    feed += [ics_event(event) for event in events]
+    feed.append(_fold('END:VCALENDAR'))
+
+    checksum = sha1()
+    for chunk in feed:
+        checksum.update(chunk.encode('utf-8'))
+
+    return (events, feed, checksum.hexdigest()), trip_ids
+
+
+def load_calendar(user_id, version=None):
+    """ Returns a user's calendar (see build_calendar) from the query cache,
+    building it if it is not cached. The calendar is cached against the
+    version of the user's change stamp it was built at (see
+    util.owner_version), so a change to their trips or stops made through
+    another process is seen straight away while other users' changes leave
+    it cached - the cached calendar is also removed when one of the user's
+    trips or stops changes, or they add or remove a trip. """
+    cache_key = ('calendar', str(user_id), version)
+    calendar = RESULTS.get(cache_key)
+
+    if calendar is None:
+        calendar, trip_ids = build_calendar(user_id)
+        RESULTS.set(cache_key, calendar, trip_ids=trip_ids)
+
+    return calendar
+
+
+def calendar_days(day, view):
+    """
+    Returns the days shown by the calendar page for a day, as a
+    (weeks, previous_day, next_day) tuple. weeks is a list of weeks (Monday
+    to Sunday) covering the month the day is in, or just its week if view
+    is 'week', and previous_day and next_day are days in the previous and
+    next month (or week).
+    """
+    if view == 'week':
+        first = last = day
+        previous_day, next_day = day - timedelta(days=7), \
+            day + timedelta(days=7)
+    else:
+        first = day.replace(day=1)
+        last = (first + timedelta(days=31)).replace(day=1) - \
+            timedelta(days=1)
+        previous_day, next_day = first - timedelta(days=1), \
+            last + timedelta(days=1)
+
+    # weeks run from Monday to Sunday
+    start = first - timedelta(days=first.weekday())
+    end = last + timedelta(days=6 - last.weekday())
+
+    days = [start + timedelta(days=offset)
+            for offset in range((end - start).days + 1)]
+    weeks = [days[offset:offset + 7] for offset in range(0, len(days), 7)]
+
+    return weeks, previous_day, next_day
+
+
+def events_by_day(events, first, last):
+    """ Returns a dict of each day from first to last (inclusive) to the
+    events taking place on it. A stop takes the days from its start date up
+    to, but not including, its end date. """
+    days = {}
+
+    for event in events:
+        start = max(event['start'], first)
+        end = min(event['end'], last + timedelta(days=1))
+
+        while start < end:
+            days.setdefault(start, []).append(event)
+            start += timedelta(days=1)
+
+    return days
+
+
+def parse_day(value):
+    """ Returns the day from a YYYY-MM-DD string, or None if it is not
+    valid. """
+    try:
+        return datetime.strptime(value or '', '%Y-%m-%d')
+    except ValueError:
+        return None
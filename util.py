@@ -1,27 +1,200 @@
-""" This creates a connection to MongoDB and creates collection variables """
-import os
+""" This creates the MongoDB collection variables and contains the helper
+functions shared by the routes. The collections are connected to the app's
+database when they are first used (see database.py) - the routes and helpers
+read and write through the app's stores (see storage.py) rather than using
+them directly. """
+from datetime import datetime, timedelta
 import bson
 from bson.objectid import ObjectId
-from flask import Flask, flash, session
-from flask_pymongo import PyMongo
+from flask import flash, session, g, has_app_context
+from flask.json import JSONEncoder
+from pymongo import ASCENDING, TEXT, IndexModel
 from wtforms.validators import ValidationError
-from dotenv import load_dotenv
-
-
-# get environment variables
-load_dotenv()
-
-APP = Flask(__name__)
-APP.config['MONGO_URI'] = os.getenv('MONGODB_URI')
-APP.config['SECRET_KEY'] = os.getenv('SECRET_KEY')
-
-# initialise mongoDb
-MONGO = PyMongo(APP)
-
-# set collections variables
-USERS = MONGO.db.users
-TRIPS = MONGO.db.trips
-STOPS = MONGO.db.stops
+from database import MongoDB
+from monitoring import COMMAND_STATS, POOL_STATS
+from slowlog import SlowQueryLog, TimedCollection
+from extension import AppExtension
+from storage import STORES
+
+
+class TravelPalJSONEncoder(JSONEncoder):
+    """ Encodes ObjectId's as strings and dates in ISO 8601 format, which
+    are used in the JSON read API. """
+
+    def default(self, o):  # pylint: disable=method-hidden
+        if isinstance(o, ObjectId):
+            return str(o)
+
+        if isinstance(o, datetime):
+            return o.isoformat()
+
+        return super().default(o)
+
+
+# mongoDb client for the app - the listeners record command latency and
+# connection pool usage
+MONGO = MongoDB(event_listeners=[COMMAND_STATS, POOL_STATS])
+
+# writes the slow queries of the app being used to its log - each app is
+# given its own by create_app()
+SLOW_QUERIES = AppExtension('slow_queries', SlowQueryLog.from_config)
+
+# set collections variables - aggregate and find_one on these are timed for
+# the slow query log
+USERS = TimedCollection(MONGO.collection('users'), SLOW_QUERIES)
+TRIPS = TimedCollection(MONGO.collection('trips'), SLOW_QUERIES)
+STOPS = TimedCollection(MONGO.collection('stops'), SLOW_QUERIES)
+# holds the change stamp used to validate cached trips listings
+META = MONGO.collection('meta')
+
+# matches trips which have not been deleted - deleted trips are hidden
+# straight away and removed, with their stops, in the background (see
+# purge.py)
+NOT_DELETED = {'deleted_at': {'$exists': False}}
+
+# the stop fields tested by the trip search besides the country (or city or
+# town) and the page cursor - they end the search indexes, so every stop the
+# search reads is filtered in the index (see search.stop_filter)
+SEARCH_FIELDS = [('trip_deleted', ASCENDING), ('trip_public', ASCENDING),
+                 ('trip_owner_id', ASCENDING), ('start_date', ASCENDING),
+                 ('end_date', ASCENDING)]
+
+# indexes needed by the queries the app issues, by collection - these are
+# created by ensure_indexes()
+INDEXES = {
+    'users': [
+        # user_exists and user_login look users up by username
+        IndexModel([('username', ASCENDING)], name='username', unique=True)
+    ],
+    'trips': [
+        # trips listing for a user (and trip ownership checks)
+        IndexModel([('owner_id', ASCENDING), ('public', ASCENDING),
+                    ('start_date', ASCENDING)],
+                   name='owner_id_public_start_date'),
+        # trips listing for public trips - the end date is included for the
+        # date filters (upcoming, in progress, between dates)
+        IndexModel([('public', ASCENDING), ('start_date', ASCENDING),
+                    ('end_date', ASCENDING)],
+                   name='public_start_date_end_date'),
+        # deleted trips waiting to be purged
+        IndexModel([('deleted_at', ASCENDING)], name='deleted_at',
+                   sparse=True),
+        # text search of trip names, countries and cities - place names are
+        # in many languages, so words are not stemmed and none are skipped
+        IndexModel([('name', TEXT), ('summary.countries', TEXT),
+                    ('summary.cities', TEXT)],
+                   name='name_countries_cities_text', default_language='none')
+    ],
+    'stops': [
+        # stops for a trip, including the $lookup from trips
+        IndexModel([('trip_id', ASCENDING)], name='trip_id'),
+        # trip search by country, or city or town, read in the order the
+        # trips are paged - the visibility and date fields tested by the
+        # search follow, so the stops which do not match are skipped in the
+        # index rather than read (see search.stop_filter)
+        IndexModel([('country', ASCENDING), ('trip_start', ASCENDING),
+                    ('trip_id', ASCENDING)] + SEARCH_FIELDS,
+                   name='trip_search_country'),
+        IndexModel([('country', ASCENDING), ('city_town', ASCENDING),
+                    ('trip_start', ASCENDING), ('trip_id', ASCENDING)] +
+                   SEARCH_FIELDS,
+                   name='trip_search_city_town')
+    ]
+}
+
+# indexes which have been replaced by those in INDEXES, by collection - these
+# are dropped by ensure_indexes()
+RETIRED_INDEXES = {
+    'trips': ['public_start_date'],
+    'stops': ['country_start_date', 'country_city_town_start_date',
+              'country_trip_start_trip_id',
+              'country_city_town_trip_start_trip_id']
+}
+
+# the shape of each query the app issues - (collection, filter, sort). These
+# are explained by check_indexes() to make sure none of them scan the whole
+# collection. Values are placeholders as only the shape matters
+QUERY_SHAPES = [
+    ('users', {'username': ''}, None),
+    ('trips', dict(NOT_DELETED, **{'$or': [{'owner_id': ObjectId()},
+                                           {'public': True}]}),
+     [('start_date', ASCENDING), ('_id', ASCENDING)]),
+    ('trips', dict(NOT_DELETED, **{'$or': [{'owner_id': ObjectId()}]}),
+     [('start_date', ASCENDING), ('_id', ASCENDING)]),
+    ('trips', dict(NOT_DELETED, **{'$or': [{'owner_id': ObjectId()},
+                                           {'public': True}],
+                                   'start_date': {'$lte': datetime.min},
+                                   'end_date': {'$gte': datetime.min}}),
+     [('start_date', ASCENDING), ('_id', ASCENDING)]),
+    ('trips', dict(NOT_DELETED, **{'$text': {'$search': 'x'},
+                                   '$or': [{'owner_id': ObjectId()},
+                                           {'public': True}]}),
+     [('start_date', ASCENDING), ('_id', ASCENDING)]),
+    ('trips', {'$and': [{'owner_id': ObjectId()}, NOT_DELETED]},
+     [('_id', ASCENDING)]),
+    ('trips', dict(NOT_DELETED, _id=ObjectId()), None),
+    ('trips', {'deleted_at': {'$exists': True}}, None),
+    ('stops', {'trip_id': ObjectId()}, [('_id', ASCENDING)]),
+    ('stops', {'trip_id': ObjectId(), 'country': ''}, None),
+    ('stops', {'_id': ObjectId(), 'trip_id': ObjectId()}, None),
+    ('stops', {'country': '', 'trip_deleted': {'$ne': True},
+               '$or': [{'trip_owner_id': ObjectId()}, {'trip_public': True}],
+               'start_date': {'$lte': datetime.min},
+               'end_date': {'$gte': datetime.min}},
+     [('trip_start', ASCENDING), ('trip_id', ASCENDING)]),
+    ('stops', {'country': '', 'city_town': '',
+               'trip_deleted': {'$ne': True},
+               '$or': [{'trip_owner_id': ObjectId()}, {'trip_public': True}]},
+     [('trip_start', ASCENDING), ('trip_id', ASCENDING)]),
+    ('meta', {'_id': ''}, None),
+    ('meta', {'_id': {'$in': ['']}}, None)
+]
+
+
+def ensure_indexes():
+    """ Creates the indexes in INDEXES and drops those in RETIRED_INDEXES.
+    Indexes which already exist are left as they are, so this is safe to run
+    on every startup. """
+    created = []
+
+    for collection, names in RETIRED_INDEXES.items():
+        existing = MONGO.db[collection].index_information()
+        for name in names:
+            if name in existing:
+                MONGO.db[collection].drop_index(name)
+
+    for collection, indexes in INDEXES.items():
+        created += MONGO.db[collection].create_indexes(indexes)
+
+    return created
+
+
+def _plan_stages(plan):
+    """ Generator which yields every stage name in a query plan. """
+    yield plan.get('stage')
+
+    for child in [plan.get('inputStage')] + plan.get('inputStages', []):
+        if child:
+            for stage in _plan_stages(child):
+                yield stage
+
+
+def check_indexes():
+    """ Runs explain() for each query in QUERY_SHAPES and returns those which
+    would perform a collection scan (COLLSCAN). """
+    collection_scans = []
+
+    for collection, query, sort in QUERY_SHAPES:
+        cursor = MONGO.db[collection].find(query).limit(1)
+        if sort:
+            cursor = cursor.sort(sort)
+
+        plan = cursor.explain()['queryPlanner']['winningPlan']
+
+        if 'COLLSCAN' in _plan_stages(plan):
+            collection_scans.append((collection, query, sort))
+
+    return collection_scans
 
 
 def check_user_permission(check_trip_owner=False,
@@ -30,6 +203,10 @@ def check_user_permission(check_trip_owner=False,
     This checks if a user has been logged in by default. Additional checks
     are included to determine if a user is the owner of a trip and thus
     should have permission to add, update, and/or, remove trip details/stops.
+
+    When checking ownership, the authorised trip (or stop, if check_stop_owner
+    is True) is returned rather than True. The documents are kept for the rest
+    of the request and can be retrieved with get_trip() and get_stop().
     """
     if not session.get('USERNAME'):
         return False
@@ -45,46 +222,140 @@ def check_user_permission(check_trip_owner=False,
     # if checkTripOwner is True, OR, checkStopOwner is True - need to check
     # that User owns the Trip
     if check_trip_owner or check_stop_owner:
-        query = {'_id': ObjectId(trip_id),
-                 'owner_id': ObjectId(session.get('USERNAME'))}
+        owner_id = ObjectId(session.get('USERNAME'))
+        trip = _get_document('trips', trip_id)
 
-        # check user is the user that owns this trip
-        trip = TRIPS.find_one(query)
+        if check_stop_owner:
+            stop = _get_document('stops', stop_id)
 
-        # check if any results were returned by the query - i.e. does this user
-        # own this trip?
-        if not trip:
-            # user does not own the trip
+            if not trip or not stop:
+                # fetch the trip and stop in one query - the stop is only
+                # returned if it is part of the trip
+                trip, stop = _find_trip_and_stop(trip_id, stop_id)
+        else:
+            stop = None
+
+            if not trip:
+                trip = STORES.trips.find(trip_id)
+                _set_document('trips', trip)
+
+        # check if the trip exists and is owned by this user, and, if checking
+        # the stop, that the Stop is part of the Trip - by association the
+        # User owns this Stop
+        if not trip or trip['owner_id'] != owner_id or \
+                (check_stop_owner and
+                 (not stop or stop['trip_id'] != trip['_id'])):
+            # user does not own the trip or stop is not part of trip
             flash(
                 'The page you are trying to access does not exist or you do'
                 ' not have permission.')
             return False
 
-    if check_stop_owner:
-        query = {'_id': ObjectId(stop_id), 'trip_id': ObjectId(trip_id)}
+        # return the documents the user has been authorised for
+        return stop if check_stop_owner else trip
+
+    # User is Logged In
+    return True
+
 
-        # check that the Stop is part of the Trip and by association the User
-        # owns this Stop
-        stop = STOPS.find_one(query)
+def _identity_map():
+    """ Returns the documents which have already been fetched during this
+    request, keyed by collection and _id, so they are only queried once. """
+    if not has_app_context():
+        return {}
 
-        # does the stop belong to the trip?
-        if not stop:
-            # stop is not part of trip
-            flash('The page you are trying to access does not exist or you do'
-                  ' not have permission.')
+    if 'identity_map' not in g:
+        g.identity_map = {}
 
-            return False
+    return g.identity_map
 
-    # User is Logged In
-    return True
 
+def _get_document(collection, doc_id):
+    """ Returns a document from the identity map, or None if it has not been
+    fetched during this request. """
+    return _identity_map().get((collection, ObjectId(doc_id)))
 
-def get_trip_duration(trip_id):
+
+def _set_document(collection, document):
+    """ Adds a document to the identity map. """
+    if document:
+        _identity_map()[(collection, document['_id'])] = document
+
+
+def forget_document(collection, doc_id):
+    """ Removes a document from the identity map - this should be called
+    after the document has been changed in the database. """
+    _identity_map().pop((collection, ObjectId(doc_id)), None)
+
+
+def trip_and_stop_pipeline(trip_id, stop_id):
+    """
+    Creates an aggregate MongoDB query which returns a trip along with one of
+    its stops (in a list named stop, which is empty if the stop does not
+    exist or is part of another trip) in a single round trip.
+    """
+    return [
+        {
+            u"$match": dict(NOT_DELETED, _id=ObjectId(trip_id))
+        },
+        {
+            u"$lookup": {
+                u"from": u"stops",
+                u"pipeline": [
+                    {
+                        u"$match": {
+                            u"_id": ObjectId(stop_id),
+                            u"trip_id": ObjectId(trip_id)
+                        }
+                    }
+                ],
+                u"as": u"stop"
+            }
+        }
+    ]
+
+
+def _find_trip_and_stop(trip_id, stop_id):
+    """ Returns a trip along with one of its stops as a (trip, stop) tuple -
+    either is None if it does not exist. """
+    trip, stop = STORES.trips.find_with_stop(trip_id, stop_id)
+
+    _set_document('trips', trip)
+    _set_document('stops', stop)
+
+    return trip, stop
+
+
+def get_trip(trip_id):
+    """ Returns a trip, using the copy already fetched during this request
+    (e.g. by check_user_permission) if there is one. """
+    trip = _get_document('trips', trip_id)
+
+    if not trip:
+        trip = STORES.trips.find(trip_id)
+        _set_document('trips', trip)
+
+    return trip
+
+
+def get_stop(stop_id):
+    """ Returns a stop, using the copy already fetched during this request
+    (e.g. by check_user_permission) if there is one. """
+    stop = _get_document('stops', stop_id)
+
+    if not stop:
+        stop = STORES.stops.find(stop_id)
+        _set_document('stops', stop)
+
+    return stop
+
+
+def trip_duration_pipeline(trip_id):
     """
     Creates an aggregate MongoDB query which returns the total duration
     for all stops for a given trip_id.
     """
-    pipeline = [
+    return [
         {
             u"$match": {
                 u"trip_id": ObjectId(trip_id)
@@ -105,16 +376,42 @@ def get_trip_duration(trip_id):
         }
     ]
 
+
+def get_trip_duration(trip_id):
+    """ Returns the total duration for all stops for a given trip_id. """
     try:
         # set total trip duration if query is successful
-        get_total_duration = STOPS.aggregate(pipeline)
-        total_duration = get_total_duration.next()['total_duration']
+        total_duration = STORES.stops.total_duration(trip_id)
     except Exception:
         # if query throws exception set total_duration to zero
         total_duration = 0
 
     return total_duration
 
+
+def get_stop_costs(stop, travelers):
+    """
+    Calculates the costs for a single stop - per person (the daily costs
+    multiplied by the stop duration) and in total for all travelers.
+    """
+    duration = stop['duration']
+
+    costs = {
+        'stop_total_accom_pp': duration * stop['cost_accommodation'],
+        'stop_total_food_pp': duration * stop['cost_food'],
+        'stop_total_other_pp': duration * stop['cost_other']
+    }
+    costs['stop_total_accom'] = travelers * costs['stop_total_accom_pp']
+    costs['stop_total_food'] = travelers * costs['stop_total_food_pp']
+    costs['stop_total_other'] = travelers * costs['stop_total_other_pp']
+
+    costs['stop_total_cost_pp'] = costs['stop_total_accom_pp'] + \
+        costs['stop_total_food_pp'] + costs['stop_total_other_pp']
+    costs['stop_total_cost'] = costs['stop_total_accom'] + \
+        costs['stop_total_food'] + costs['stop_total_other']
+
+    return costs
+
 # Custom validation for use in forms
 
 
@@ -127,7 +424,7 @@ def user_exists(for_login=False):
     when logging in.
     """
     def _user_exists(form, field):
-        username = USERS.find_one({"username": field.data.strip().lower()})
+        username = STORES.users.find_by_username(field.data.strip().lower())
 
         if for_login:
             if not username:
@@ -183,3 +480,76 @@ def check_id(id_value):
         return ObjectId(id_value)
     except bson.errors.InvalidId:
         return False
+
+
+# Change stamps for HTTP conditional requests
+
+
+def utc_now():
+    """ Returns the current UTC time, truncated to milliseconds as that is
+    the precision MongoDB stores dates with. """
+    now = datetime.utcnow()
+    return now.replace(microsecond=now.microsecond // 1000 * 1000)
+
+
+def owner_stamp_id(owner_id=None):
+    """ Returns the _id of the change stamp of an owner's trips and stops in
+    the meta collection, or of the stamp bumped by changes which can touch
+    any owner's trips (e.g. backfills) if owner_id is None. """
+    return 'owner_%s' % owner_id if owner_id else 'owners'
+
+
+def record_change(owner_id=None):
+    """ Bumps the change stamp for the trips listings - this should be
+    called after any trip or stop is added, changed, or removed, with the
+    _id of the owner of the trip if the change only touches one owner's
+    trips. Returns the new stamp. """
+    return STORES.meta.record_change(owner_id)
+
+
+def owner_version(owner_id):
+    """ Returns the version of an owner's trips and stops, as a tuple which
+    changes whenever one of them is added, changed or removed (or every
+    owner's trips may have been changed) - used to cache what is built from
+    only the owner's trips, such as their calendar. """
+    return STORES.meta.owner_version(ObjectId(owner_id))
+
+
+def last_change():
+    """ Returns the current change stamp for the trips listings, i.e. a
+    dict with the version number and the time of the last change. """
+    stamp = STORES.meta.last_change()
+
+    if not stamp:
+        # nothing has been written since stamps were introduced
+        stamp = {'version': 0, 'updated_at': None}
+
+    return stamp
+
+
+# Keyset pagination for the trips listing
+
+
+def encode_cursor(trip):
+    """ Creates a page cursor from the sort key of a trip, i.e. its start_date
+    (as milliseconds since epoch) and _id. """
+    start_ms = (trip['start_date'] - datetime(1970, 1, 1)) // \
+        timedelta(milliseconds=1)
+    return '%d_%s' % (start_ms, trip['_id'])
+
+
+def decode_cursor(cursor):
+    """ Converts a page cursor back into a (start_date, _id) tuple. If the
+    cursor is not in the expected format, return False. """
+    try:
+        start_ms, trip_id = cursor.split('_')
+        start_date = datetime(1970, 1, 1) + \
+            timedelta(milliseconds=int(start_ms))
+    except (AttributeError, ValueError, OverflowError):
+        return False
+
+    trip_id = check_id(trip_id)
+    if not trip_id:
+        return False
+
+    return start_date, trip_id
@@ -0,0 +1,1030 @@
+""" This file contains the main functionality and routing for the programme
+ travelPal. The routes are registered on the app by create_app() in app.py. """
+from functools import wraps
+from hmac import compare_digest
+from bson.objectid import ObjectId
+from flask import Blueprint, current_app, render_template, url_for, \
+    redirect, flash, session, request, make_response, jsonify, Response, \
+    stream_with_context, abort
+# user created files
+from util import check_user_permission, get_trip_duration, check_id, \
+    decode_cursor, get_trip, forget_document, utc_now, record_change, \
+    last_change, owner_version
+from forms import RegistrationForm, TripForm, StopForm, LoginForm, \
+    StopImportForm
+from summary import EMPTY_SUMMARY, stop_added, stop_removed, \
+    stop_updated, trip_dates_changed
+from detail import cached_trip_detail
+from cache import RESULTS
+from monitoring import COMMAND_STATS, POOL_STATS
+from metrics import prometheus_text, worker_snapshots
+from conditional import make_etag, not_modified, add_validators, \
+    trip_last_modified
+from export import FORMATS, export_trips
+from clone import clone_trip
+from listing import DATE_FILTERS, date_filter, load_trips, page_cursors
+from parallel import start_query
+from purge import delete_trip, start_purge
+from stop_import import StopImportError, stop_from_form, read_rows, \
+    validate_rows, insert_stops
+from storage import STORES
+from search import search_args, search_trips
+from autocomplete import FIELDS, SUGGESTIONS
+from trip_calendar import feed_token, feed_user, load_calendar, \
+    calendar_days, events_by_day, parse_day
+
+# the flask cli commands (in commands.py) are also registered on this
+# blueprint, as top level commands
+BP = Blueprint('main', __name__, cli_group=None)
+
+
+# trips functionality
+@BP.route('/')
+@BP.route('/trips/')
+@BP.route('/trips/<show>/')
+def show_trips(show='all'):
+    """
+    Shows a filtered list of trips from the DB - those marked as public and
+    those the user owners (if logged in, otherwise just public trips displayed).
+
+    Trips are paged using a keyset on (start_date, _id) - the 'after' and
+    'before' query string values are cursors for the last trip of the
+    previous page and the first trip of the next page respectively. The
+    'when' query string value filters the trips by date (see
+    listing.date_filter).
+    """
+
+    if check_user_permission():
+        user_id = ObjectId(session.get('USERNAME'))
+    else:
+        user_id = ''
+
+    if show == 'user':
+        # check if user logged in, if not redirect to all trips
+        if not check_user_permission():
+            return redirect(url_for('.show_trips'))
+
+    # work out which page is being requested - if the cursor is invalid
+    # then the first page is shown
+    per_page = current_app.config['TRIPS_PER_PAGE']
+    after = decode_cursor(request.args.get('after'))
+    before = decode_cursor(request.args.get('before')) if not after else False
+    dates, filter_args = date_filter(request.args)
+
+    # the listing changes whenever any trip or stop is written, so the
+    # change stamp identifies the version of the page - if the client
+    # already has it then nothing needs to be queried or rendered
+    stamp = last_change()
+    etag = make_etag('trips', show, after, before, dates, per_page,
+                     stamp['version'])
+    unchanged = not_modified(etag, stamp['updated_at'])
+    if unchanged:
+        return unchanged
+
+    get_trips, more_trips = load_trips(user_id, show, after, before, dates,
+                                       stamp['version'])
+
+    # build the cursor links for the previous and next pages, keeping the
+    # date filter
+    prev_cursor, next_cursor = page_cursors(get_trips, after, before,
+                                            more_trips)
+    prev_url = prev_cursor and url_for('.show_trips', show=show,
+                                       before=prev_cursor, **filter_args)
+    next_url = next_cursor and url_for('.show_trips', show=show,
+                                       after=next_cursor, **filter_args)
+
+    response = make_response(
+        render_template('trips_show.html', trips=get_trips, user_id=user_id,
+                        trips_showing=show, prev_url=prev_url,
+                        next_url=next_url, date_filters=DATE_FILTERS,
+                        filter_args=filter_args))
+
+    # cursor links are also included in the header for non-browser clients
+    links = ['<%s>; rel="%s"' % (url, rel) for url, rel in
+             ((prev_url, 'prev'), (next_url, 'next')) if url]
+    if links:
+        response.headers['Link'] = ', '.join(links)
+
+    return add_validators(response, etag, stamp['updated_at'])
+
+
+@BP.route('/search/')
+def trip_search():
+    """
+    Shows the trips (public trips and the user's own) which visit the
+    country in the 'country' query string value - or the city or town in
+    'city_town' - with a stop starting between the 'from' and 'to' dates, if
+    they are given. A 'q' value searches the trip names, countries and
+    cities for its words instead (see search.search_args). Results are paged
+    as on show_trips.
+    """
+    user_id = ObjectId(session.get('USERNAME')) \
+        if check_user_permission() else ''
+    search, carried = search_args(request.args)
+    after = decode_cursor(request.args.get('after'))
+    before = decode_cursor(request.args.get('before')) if not after else False
+
+    stamp = last_change()
+    etag = make_etag('search', sorted(carried.items()), after, before,
+                     current_app.config['TRIPS_PER_PAGE'], stamp['version'])
+    unchanged = not_modified(etag, stamp['updated_at'])
+    if unchanged:
+        return unchanged
+
+    found, more_trips, prev_url, next_url = [], False, None, None
+    if search:
+        found, more_trips = search_trips(
+            user_id, search, after, before,
+            current_app.config['TRIPS_PER_PAGE'])
+        prev_cursor, next_cursor = page_cursors(found, after, before,
+                                                more_trips)
+        prev_url = prev_cursor and url_for('.trip_search',
+                                           before=prev_cursor, **carried)
+        next_url = next_cursor and url_for('.trip_search',
+                                           after=next_cursor, **carried)
+
+    response = make_response(
+        render_template('trips_show.html', trips=found, user_id=user_id,
+                        trips_showing='search', prev_url=prev_url,
+                        next_url=next_url, search=carried))
+
+    return add_validators(response, etag, stamp['updated_at'])
+
+
+@BP.route('/trip/new/', methods=['POST', 'GET'])
+def trip_new():
+    """ This creates a new user in the database. """
+    # check if the user is logged in - if not redirect them
+    if not check_user_permission():
+        flash('Please login if you wish to perform this action.')
+        return redirect(url_for('.show_trips'))
+
+    form = TripForm()
+    # check input validation
+    if form.validate_on_submit():
+        # create new entry if validation is successful
+        try:
+            owner = STORES.users.find(session.get('USERNAME'))
+            new_trip = {
+                'name': form.name.data.strip().title(),
+                'travelers': form.travelers.data,
+                'start_date': form.start_date.data,
+                # the trip has no stops yet, so it ends on the day it starts
+                'end_date': form.start_date.data,
+                'public': form.public.data,
+                'owner_id': owner['_id'],
+                # copied so the trips listing does not need to read the
+                # users collection - see owners.py
+                'owner_display_name': owner['display_name'],
+                'summary': dict(EMPTY_SUMMARY, countries=[], cities=[]),
+                'updated_at': utc_now()
+            }
+            new_trip_id = STORES.trips.insert(new_trip)
+            record_change(owner['_id'])
+            # the new trip will appear in the owner's (and if public, all)
+            # trip listings
+            RESULTS.invalidate_listings(new_trip['owner_id'],
+                                        new_trip['public'])
+            flash('New trip has been created - you can add stops below.')
+
+            return redirect(url_for('.trip_detailed', trip_id=new_trip_id))
+        except Exception:
+            flash('Database insertion error - please try again.')
+            # if there is an exception error, redirect to user's trips page
+            return redirect(url_for('.show_trips', show='user'))
+
+    # form has not been submitted, show new trip form
+    return render_template('trip_add_edit.html', form=form, action='new')
+
+
+@BP.route('/trip/<trip_id>/update/', methods=['POST', 'GET'])
+def trip_update(trip_id):
+    """
+    Subject to user permissions, this will display an input form with
+    values retrieved from the database to facilitate update.
+    """
+    # check that the trip_id passed through is a valid ObjectId
+    if not check_id(trip_id):
+        flash('The trip you are trying to access does not exist.')
+        return redirect(url_for('.show_trips'))
+
+    # check that the user has permission to update this trip
+    trip = check_user_permission(check_trip_owner=True, trip_id=trip_id)
+
+    if trip:
+        # user owns the trip
+        form = TripForm()
+        # check input validation
+        if form.validate_on_submit():
+            # create new entry if validation is successful
+            try:
+                update_fields = {
+                    'name': form.name.data.strip().title(),
+                    'travelers': form.travelers.data,
+                    'start_date': form.start_date.data,
+                    'public': form.public.data,
+                    'updated_at': utc_now()
+                }
+
+                STORES.trips.update(trip_id, update_fields)
+                record_change(trip['owner_id'])
+                forget_document('trips', trip_id)
+                RESULTS.invalidate_trip(trip_id)
+                # changing the start date or visibility can move the trip
+                # between listing pages
+                if trip['start_date'] != form.start_date.data or \
+                        trip['public'] != form.public.data:
+                    RESULTS.invalidate_listings(
+                        trip['owner_id'], trip['public'] or form.public.data)
+                # end date is based on the start date, so needs updated
+                trip_dates_changed(trip_id)
+
+                flash('Your trip has been updated.')
+                return redirect(url_for('.trip_detailed', trip_id=trip_id))
+            except Exception:
+                flash('Database update error - please try again.')
+
+            # if error then redirect back to the update form with flash message
+            return redirect(url_for('.trip_update', trip_id=trip_id))
+        # form has not been submitted, show update form - the trip was
+        # fetched by the permission check
+        trip_query = get_trip(trip_id)
+
+        if trip_query:
+            for field in trip_query:
+                # populate the form with values from trip_query
+                if field in form:
+                    # limit to only those fields which are in the form and
+                    # in the database
+                    form[field].data = trip_query[field]
+
+            return render_template('trip_add_edit.html', form=form,
+                                   action='update', trip=trip_query)
+        # trip does not exist
+        flash('The trip you tried to access does not exist.')
+        return redirect(url_for('.show_trips'))
+
+    # user does not own this trip, redirect to all trips
+    return redirect(url_for('.show_trips'))
+
+
+@BP.route('/trip/<trip_id>/delete/')
+def trip_delete(trip_id):
+    """
+    Subject to user permissions, this will delete a trip and all
+    linked (via trip_id) stops.
+    """
+    # check that the trip_id passed through is a valid ObjectId
+    if not check_id(trip_id):
+        flash('The trip you are trying to access does not exist.')
+        return redirect(url_for('.show_trips'))
+
+    # check that the user has permission to update this trip
+    trip = check_user_permission(check_trip_owner=True, trip_id=trip_id)
+
+    if trip:
+        # if user owns this entry then delete
+        flash(
+            'The trip and all associated stops have now been '
+            'deleted.')
+        try:
+            # the trip is hidden straight away and its stops are removed in
+            # the background, so the user does not wait for them
+            delete_trip(trip_id)
+            start_purge(trip_id)
+            record_change(trip['owner_id'])
+            RESULTS.invalidate_trip(trip_id)
+            RESULTS.invalidate_listings(trip['owner_id'], trip['public'])
+        except Exception:
+            flash("There was a problem removing the trip and/or it's associated stops."
+                  "Please try again.")
+    else:
+        flash(
+            'The trip you are trying to access does not exist or you do not '
+            'have permission to perform this action.')
+
+    # bring the user back to the 'my trips' page, which will display flash message
+    return redirect(url_for('.show_trips', show='user'))
+
+
+@BP.route('/trip/<trip_id>/clone/')
+def trip_clone(trip_id):
+    """
+    Copies a trip, along with all of its stops, into the user's account so
+    they can use it as a template for their own trip. Any public trip (or
+    one of the user's own) can be cloned.
+    """
+    # check that the trip_id passed through is a valid ObjectId
+    if not check_id(trip_id):
+        flash('The trip you are trying to access does not exist.')
+        return redirect(url_for('.show_trips'))
+
+    if not check_user_permission():
+        flash('Please login if you wish to perform this action.')
+        return redirect(url_for('.trip_detailed', trip_id=trip_id))
+
+    user_id = ObjectId(session.get('USERNAME'))
+    trip = get_trip(trip_id)
+
+    if not trip or not (trip['public'] or trip['owner_id'] == user_id):
+        flash(
+            'The trip you are trying to access does not exist or you do not '
+            'have permission to perform this action.')
+        return redirect(url_for('.show_trips'))
+
+    try:
+        new_trip_id = clone_trip(trip, user_id)
+        RESULTS.invalidate_listings(user_id, False)
+        record_change(user_id)
+    except Exception:
+        flash('Database insertion error - please try again.')
+        return redirect(url_for('.trip_detailed', trip_id=trip_id))
+
+    flash('The trip has been copied to your trips - you can change it below.')
+    return redirect(url_for('.trip_detailed', trip_id=new_trip_id))
+
+
+@BP.route('/trip/<trip_id>/detailed/')
+def trip_detailed(trip_id):
+    """
+    This will display all trip information, including stops. If the user
+    owns this trip they will also be prompted with buttons to add, update,
+    and delete various attributes.
+    """
+    # check that the trip_id passed through is a valid ObjectId
+    if not check_id(trip_id):
+        flash('The trip you are trying to access does not exist.')
+        return redirect(url_for('.show_trips'))
+
+    # every write to the trip or its stops updates the trip's updated_at, so
+    # this identifies the version of the page - if the client already has
+    # it then the aggregation and render are skipped
+    trip = get_trip(trip_id)
+    if trip:
+        last_modified = trip_last_modified(trip)
+        etag = make_etag('trip', trip_id, last_modified.isoformat())
+        unchanged = not_modified(etag, last_modified)
+        if unchanged:
+            return unchanged
+
+    try:
+        # the trip overview and stop dates/costs are calculated in a single
+        # query where the server supports it
+        trip_detail, stops_detail = cached_trip_detail(
+            trip_id, trip_last_modified(trip) if trip else None)
+    except Exception:
+        # if there were any errors then redirect user back to homepage
+        flash('There was an error performing this task. Please try again '
+              'later.')
+        return redirect(url_for('.show_trips'))
+
+    # check that the trip exists
+    if not trip_detail:
+        flash('The trip you are trying to access does not exist.')
+        return redirect(url_for('.show_trips'))
+
+    # render template
+    response = make_response(
+        render_template('trip_detailed.html', trip=trip_detail,
+                        stops=stops_detail))
+
+    if trip:
+        add_validators(response, etag, last_modified)
+
+    return response
+
+
+# stops functionality
+@BP.route('/trip/<trip_id>/stop/new/', methods=['POST', 'GET'])
+def trip_stop_new(trip_id):
+    """
+    Subject to user permissions, this enables a user to add new stops
+    to their trip.
+    """
+    # check that the trip_id passed through is a valid ObjectId
+    if not check_id(trip_id):
+        flash('The trip you are trying to access does not exist.')
+        return redirect(url_for('.show_trips'))
+
+    if not check_user_permission():
+        flash('Please login if you wish to perform this action.')
+        return redirect(url_for('.trip_detailed', trip_id=trip_id))
+
+    # check that the user has permission to add a new stop to this trip
+    trip = check_user_permission(check_trip_owner=True, trip_id=trip_id)
+
+    if trip:
+        form = StopForm()
+
+        if form.validate_on_submit():
+            # create new entry if validation is successful
+            try:
+                new_stop = stop_from_form(trip_id, form)
+                STORES.stops.insert(new_stop)
+                stop_added(trip_id, new_stop)
+                record_change(trip['owner_id'])
+                RESULTS.invalidate_trip(trip_id)
+                flash('You have added a new stop to this trip.')
+            except Exception:
+                flash('Database insertion error - please try again.')
+
+            # if the stop was added or there was an exception error then redirect
+            # back to trip_detailed view with flash message
+            return redirect(url_for('.trip_detailed', trip_id=trip_id))
+        else:
+            # the form shows the total duration of the trip, which is only
+            # queried once the user is known to own the trip
+            trip_duration = start_query(get_trip_duration, trip_id)
+
+            # the trip was fetched by the permission check
+            trip_query = get_trip(trip_id)
+            prefix = 'trip_'  # used to identify trip form fields
+            if trip_query:
+                for field in trip_query:
+                    # populate the form with values from trip_query
+                    if prefix + field in form:
+                        # limit to only those fields which are in the form and
+                        # in the database
+                        form[(prefix + field)].data = trip_query[field]
+
+            # set form values
+            form.current_stop_duration.data = 0
+            form.total_trip_duration.data = trip_duration.result()
+            form.duration.data = 1
+
+            return render_template('stop_add_edit.html', form=form,
+                                   action='new', trip=trip_query)
+
+    # if no trip_id or user not logged in then redirect to show all trips
+    return redirect(url_for('.show_trips'))
+
+
+@BP.route('/trip/<trip_id>/stop/import/', methods=['POST', 'GET'])
+def trip_stop_import(trip_id):
+    """
+    Subject to user permissions, this enables a user to add many stops to
+    their trip at once from a CSV or JSON file. If any row is not a valid
+    stop then nothing is imported and the errors for each row are shown.
+    """
+    # check that the trip_id passed through is a valid ObjectId
+    if not check_id(trip_id):
+        flash('The trip you are trying to access does not exist.')
+        return redirect(url_for('.show_trips'))
+
+    if not check_user_permission():
+        flash('Please login if you wish to perform this action.')
+        return redirect(url_for('.trip_detailed', trip_id=trip_id))
+
+    # check that the user has permission to add stops to this trip
+    trip = check_user_permission(check_trip_owner=True, trip_id=trip_id)
+
+    if not trip:
+        return redirect(url_for('.show_trips'))
+
+    form = StopImportForm()
+    row_errors = []
+
+    if form.validate_on_submit():
+        try:
+            new_stops, row_errors = validate_rows(
+                trip_id, read_rows(form.stops_file.data))
+        except StopImportError as error:
+            form.stops_file.errors.append(str(error))
+            new_stops = []
+
+        if new_stops and not row_errors:
+            try:
+                imported = insert_stops(trip_id, new_stops)
+                RESULTS.invalidate_trip(trip_id)
+                record_change(trip['owner_id'])
+                flash('%d stops have been imported to this trip.' % imported)
+            except Exception:
+                # the trip may have been read with the stops before they
+                # were removed again
+                RESULTS.invalidate_trip(trip_id)
+                flash('Database insertion error - no stops were imported, '
+                      'please try again.')
+
+            return redirect(url_for('.trip_detailed', trip_id=trip_id))
+
+    return render_template('stop_import.html', form=form, trip=trip,
+                           row_errors=row_errors)
+
+
+@BP.route('/trip/<trip_id>/stop/<stop_id>/duplicate/',
+           methods=['POST', 'GET'])
+def trip_stop_duplicate(trip_id, stop_id):
+    """
+    Duplicates a trip 'stop' for the user, to save time from filling in repeat
+    fields, such as country, city, etc.
+    """
+    # check that the trip_id and stop_id passed through are valid ObjectId's
+    if not check_id(trip_id) or not check_id(stop_id):
+        flash('The trip and/or stop you are trying to access do not exist.')
+        return redirect(url_for('.show_trips'))
+
+    if not check_user_permission():
+        flash('Please login if you wish to perform this action.')
+        return redirect(url_for('.trip_detailed', trip_id=trip_id))
+
+    # check that the user has permission to add a new stop to this trip
+    stop = check_user_permission(check_stop_owner=True,
+                                 trip_id=trip_id, stop_id=stop_id)
+    if stop:
+        # the stop was fetched by the permission check, copy it without
+        # its _id so a new one is created
+        copy_of_stop = {field: value for field, value in stop.items()
+                        if field != '_id'}
+        copy_of_stop['updated_at'] = utc_now()
+
+        new_stop_id = STORES.stops.insert(copy_of_stop)
+        stop_added(trip_id, copy_of_stop)
+        record_change(ObjectId(session.get('USERNAME')))
+        RESULTS.invalidate_trip(trip_id)
+        flash('Stop added - you can modify the details below.')
+        return redirect(url_for('.trip_stop_update', trip_id=trip_id,
+                                stop_id=new_stop_id))
+
+    # user does not have permission
+    flash(
+        'The stop you are trying to access does not exist or you do '
+        'not have permission to perform the action.')
+    return redirect(url_for('.trip_detailed', trip_id=trip_id))
+
+
+@BP.route('/trip/<trip_id>/stop/<stop_id>/update/', methods=['POST', 'GET'])
+def trip_stop_update(trip_id, stop_id):
+    """
+    Subject to user permissions, this will enable a permitted user to update a
+    stop within a trip they own.
+    """
+    # check that the trip_id and stop_id passed through are valid ObjectId's
+    if not check_id(trip_id) or not check_id(stop_id):
+        flash('The trip and/or stop you are trying to access do not exist.')
+        return redirect(url_for('.show_trips'))
+
+    if not check_user_permission():
+        flash('Please login if you wish to perform this action.')
+        return redirect(url_for('.trip_detailed', trip_id=trip_id))
+
+    stop = check_user_permission(check_stop_owner=True,
+                                 trip_id=trip_id, stop_id=stop_id)
+    # if query returns a result, this indicates the user owns this stop
+    if stop:
+        # user owns the trip - proceed
+        form = StopForm()
+        # check input validation
+        if form.validate_on_submit():
+            # create new entry if validation is successful
+            try:
+                # build update
+                update_fields = {
+                    'trip_id': ObjectId(trip_id),
+                    'country': form.country.data.strip().title(),
+                    'city_town': form.city_town.data.strip().title(),
+                    'duration': form.duration.data,
+                    'order': 1,
+                    'currency': form.currency.data.strip().upper(),
+                    'cost_accommodation': float(form.cost_accommodation.data),
+                    'cost_food': float(form.cost_food.data),
+                    'cost_other': float(form.cost_other.data),
+                    'updated_at': utc_now()
+                }
+
+                # the previous values of the stop are returned so they can
+                # be taken away from the trip summary
+                old_stop = STORES.stops.update(stop_id, update_fields)
+                forget_document('stops', stop_id)
+                if old_stop:
+                    stop_updated(trip_id, old_stop, update_fields)
+                    record_change(ObjectId(session.get('USERNAME')))
+                RESULTS.invalidate_trip(trip_id)
+
+                flash('The stop has been updated.')
+            except Exception:
+                flash('Database insertion error - please try again.')
+
+            # if stop was updated or there was an exception error then redirect
+            # back to trip_detailed view with flash message
+            return redirect(url_for('.trip_detailed', trip_id=trip_id))
+        else:
+            # form has not be submitted/not validated, therefore display form
+            # using the trip and stop fetched by the permission check - the
+            # trip duration is only queried once the user is known to own it
+            trip_duration = start_query(get_trip_duration, trip_id)
+            trip_query = get_trip(trip_id)
+            stop_query = stop
+
+            if trip_query and stop_query:
+                prefix = 'trip_'  # used to identify trip form fields
+
+                # update the form fields with trip data
+                for field in trip_query:
+                    # populate the form with values from query
+                    if prefix + field in form:
+                        # limit to only those fields which are in the form and
+                        # in the database
+                        form[(prefix + field)].data = trip_query[field]
+
+                # update the form fields with stop data
+                for field in stop_query:
+                    # populate the form with values from query
+                    if field in form:
+                        form[field].data = stop_query[field]
+
+                # set hidden varialbes
+                form.total_trip_duration.data = trip_duration.result()
+                form.current_stop_duration.data = stop_query['duration']
+
+                return render_template('stop_add_edit.html', form=form,
+                                       action='update', trip=trip_query,
+                                       stop=stop_query)
+            else:
+                flash('The trip or stop you tried to access does not exist.')
+                return redirect(url_for('.show_trips'))
+    # user does not own the trip
+    flash(
+        'The stop you are trying to access does not exist or you do '
+        'not have permission to perform the action.')
+
+    return redirect(url_for('.trip_detailed', trip_id=trip_id))
+
+
+@BP.route('/trip/<trip_id>/stop/<stop_id>/delete/')
+def trip_stop_delete(trip_id, stop_id):
+    """
+    Subject to user permissions, this will enable a user to delete a
+    stop from a trip they own.
+    """
+    # check that the trip_id and stop_id passed through are valid ObjectId's
+    if not check_id(trip_id) or not check_id(stop_id):
+        flash('The trip and/or stop you are trying to access do not exist.')
+        return redirect(url_for('.show_trips'))
+
+    stop = check_user_permission(check_stop_owner=True,
+                                 trip_id=trip_id, stop_id=stop_id)
+
+    if stop:
+        # if user owns this entry then delete - the removed stop is returned
+        # if it existed
+        removed_stop = STORES.stops.delete(stop_id, trip_id)
+        forget_document('stops', stop_id)
+        if removed_stop:
+            stop_removed(trip_id, removed_stop)
+            record_change(ObjectId(session.get('USERNAME')))
+            RESULTS.invalidate_trip(trip_id)
+            flash('The stop has been removed from this trip.')
+        else:
+            flash('The stop you are trying to delete does not exist.')
+    else:
+        flash(
+            'The stop you are trying to access does not exist or you do '
+            'not have permission to perform the action.')
+
+    return redirect(url_for('.trip_detailed', trip_id=trip_id))
+
+
+@BP.route('/export/trips.<export_format>')
+def trips_export(export_format):
+    """
+    Streams every trip the user can see (public trips and their own) along
+    with its stops and costs, as newline delimited JSON or CSV. The number
+    of trips read from the database at a time can be set with batch_size.
+    """
+    if export_format not in FORMATS:
+        abort(404)
+
+    user_id = None
+    if check_user_permission():
+        user_id = ObjectId(session.get('USERNAME'))
+
+    batch_size = request.args.get('batch_size', type=int) or \
+        current_app.config['EXPORT_BATCH_SIZE']
+    batch_size = max(1, batch_size)
+
+    rows, mimetype = FORMATS[export_format]
+    trips = export_trips(user_id, batch_size=batch_size)
+    response = Response(stream_with_context(rows(trips)), mimetype=mimetype)
+    response.headers['Content-Disposition'] = \
+        'attachment; filename=trips.%s' % export_format
+
+    return response
+
+
+@BP.route('/calendar/')
+def calendar_view():
+    """
+    Shows the stops of the user's trips on a calendar, a month at a time (or
+    a week, if the 'view' query string value is 'week') from the day in the
+    'date' query string value, or today. The page also links to the user's
+    calendar feed.
+    """
+    if not check_user_permission():
+        flash('Please login if you wish to perform this action.')
+        return redirect(url_for('.show_trips'))
+
+    user_id = ObjectId(session.get('USERNAME'))
+    view = 'week' if request.args.get('view') == 'week' else 'month'
+    day = parse_day(request.args.get('date')) or \
+        parse_day(utc_now().strftime('%Y-%m-%d'))
+
+    events, _, feed_etag = load_calendar(user_id, owner_version(user_id))
+    etag = make_etag('calendar', view, day, feed_etag)
+    unchanged = not_modified(etag)
+    if unchanged:
+        return unchanged
+
+    weeks, previous_day, next_day = calendar_days(day, view)
+    days = events_by_day(events, weeks[0][0], weeks[-1][-1])
+
+    response = make_response(render_template(
+        'calendar.html', weeks=weeks, days=days, day=day, view=view,
+        previous_day=previous_day, next_day=next_day,
+        feed_url=url_for('.calendar_feed', token=feed_token(user_id),
+                         _external=True)))
+
+    return add_validators(response, etag)
+
+
+@BP.route('/calendar/<token>.ics')
+def calendar_feed(token):
+    """
+    Streams a user's calendar feed - an iCalendar file with an event for each
+    stop of their trips - for calendar clients to subscribe to. The user is
+    identified by the signed token in the URL, as calendar clients do not
+    log in. The feed is served from the query cache and clients which
+    already have it get a 304.
+    """
+    user_id = feed_user(token)
+    if not user_id:
+        abort(404)
+
+    _, feed, etag = load_calendar(user_id, owner_version(user_id))
+    unchanged = not_modified(etag)
+    if unchanged:
+        return unchanged
+
+    response = Response(iter(feed), mimetype='text/calendar')
+    response.headers['Content-Disposition'] = \
+        'inline; filename=trips.ics'
+
+    return add_validators(response, etag)
+
+
+def internal_only(view):
+    """ Serves a monitoring route only to requests with the STATS_TOKEN
+    bearer token (e.g. from Prometheus) - anyone else, or everyone while
+    STATS_TOKEN is unset, gets a 404 as if the route did not exist. """
+    @wraps(view)
+    def wrapped(*args, **kwargs):
+        token = current_app.config['STATS_TOKEN']
+        if not token or not compare_digest(
+                request.headers.get('Authorization', '').encode(),
+                ('Bearer ' + token).encode()):
+            abort(404)
+
+        return view(*args, **kwargs)
+
+    return wrapped
+
+
+@BP.route('/cache/stats/')
+@internal_only
+def cache_stats():
+    """ Returns the query cache counters (hits, misses, evictions, etc.) as
+    JSON, which are used to size the cache. """
+    return jsonify(RESULTS.stats())
+
+
+@BP.route('/metrics')
+@internal_only
+def metrics():
+    """ Returns the request, MongoDB and connection pool metrics of every
+    worker in the Prometheus text format. """
+    return Response(prometheus_text(worker_snapshots(
+        current_app.config['METRICS_DIR'])),
+                    mimetype='text/plain; version=0.0.4; charset=utf-8')
+
+
+@BP.route('/db/stats/')
+@internal_only
+def db_stats():
+    """ Returns the MongoDB command latencies and connection pool usage as
+    JSON, which are used to size the connection pool. """
+    config = current_app.config
+
+    return jsonify(commands=COMMAND_STATS.stats(), pool=POOL_STATS.stats(),
+                   settings={
+                       'max_pool_size': config['MONGO_MAX_POOL_SIZE'],
+                       'min_pool_size': config['MONGO_MIN_POOL_SIZE'],
+                       'wait_queue_timeout_ms':
+                           config['MONGO_WAIT_QUEUE_TIMEOUT_MS'],
+                       'server_selection_timeout_ms':
+                           config['MONGO_SERVER_SELECTION_TIMEOUT_MS']
+                   })
+
+
+#
+# json read api
+#
+@BP.route('/api/trips/')
+@BP.route('/api/trips/<show>/')
+def api_trips(show='all'):
+    """
+    Returns a page of the trips listing as JSON, with the same trips and page
+    cursors and date filter as show_trips. The 'prev' and 'next' values are
+    the URL's of the previous and next pages, if there are any.
+    """
+    if check_user_permission():
+        user_id = ObjectId(session.get('USERNAME'))
+    elif show == 'user':
+        return jsonify(error='Please login to view your trips.'), 401
+    else:
+        user_id = ''
+
+    after = decode_cursor(request.args.get('after'))
+    before = decode_cursor(request.args.get('before')) if not after else False
+    dates, filter_args = date_filter(request.args)
+
+    stamp = last_change()
+    etag = make_etag('api_trips', show, after, before, dates,
+                     current_app.config['TRIPS_PER_PAGE'], stamp['version'])
+    unchanged = not_modified(etag, stamp['updated_at'])
+    if unchanged:
+        return unchanged
+
+    get_trips, more_trips = load_trips(user_id, show, after, before, dates,
+                                       stamp['version'])
+    prev_cursor, next_cursor = page_cursors(get_trips, after, before,
+                                            more_trips)
+
+    response = jsonify(
+        trips=get_trips,
+        prev=prev_cursor and url_for('.api_trips', show=show,
+                                     before=prev_cursor, **filter_args),
+        next=next_cursor and url_for('.api_trips', show=show,
+                                     after=next_cursor, **filter_args))
+
+    return add_validators(response, etag, stamp['updated_at'])
+
+
+@BP.route('/api/search/')
+def api_search():
+    """ Returns a page of the trips matching a search as JSON, with the same
+    query string values, trips and page cursors as trip_search. """
+    user_id = ObjectId(session.get('USERNAME')) \
+        if check_user_permission() else ''
+    search, carried = search_args(request.args)
+    if not search:
+        return jsonify(error='Please give the words to search for, or a '
+                             'country and any dates as YYYY-MM-DD.'), 400
+
+    after = decode_cursor(request.args.get('after'))
+    before = decode_cursor(request.args.get('before')) if not after else False
+
+    stamp = last_change()
+    etag = make_etag('api_search', sorted(carried.items()), after, before,
+                     current_app.config['TRIPS_PER_PAGE'], stamp['version'])
+    unchanged = not_modified(etag, stamp['updated_at'])
+    if unchanged:
+        return unchanged
+
+    found, more_trips = search_trips(user_id, search, after, before,
+                                     current_app.config['TRIPS_PER_PAGE'])
+    prev_cursor, next_cursor = page_cursors(found, after, before, more_trips)
+
+    response = jsonify(
+        trips=found,
+        prev=prev_cursor and url_for('.api_search', before=prev_cursor,
+                                     **carried),
+        next=next_cursor and url_for('.api_search', after=next_cursor,
+                                     **carried))
+
+    return add_validators(response, etag, stamp['updated_at'])
+
+
+@BP.route('/api/autocomplete/<field>/')
+def api_autocomplete(field):
+    """ Returns the values of a stop form field ('country' or 'city_town')
+    already used on stops which start with the 'q' query string value, as
+    JSON - those used most first. The stop form asks for these as each key
+    is pressed, so they are read from the prefix index in memory rather than
+    the database (see autocomplete.py). """
+    if not check_user_permission():
+        return jsonify(error='Please login to add stops.'), 401
+
+    if field not in FIELDS:
+        return jsonify(error='There are no suggestions for %s.' % field), 404
+
+    return jsonify(suggestions=SUGGESTIONS.suggest(field,
+                                                   request.args.get('q', '')))
+
+
+@BP.route('/api/trip/<trip_id>/')
+def api_trip(trip_id):
+    """ Returns the trip overview and stops (with their dates and costs)
+    shown by trip_detailed as JSON. """
+    trip = get_trip(trip_id) if check_id(trip_id) else None
+
+    if not trip:
+        return jsonify(error='The trip does not exist.'), 404
+
+    last_modified = trip_last_modified(trip)
+    etag = make_etag('api_trip', trip_id, last_modified.isoformat())
+    unchanged = not_modified(etag, last_modified)
+    if unchanged:
+        return unchanged
+
+    trip_detail, stops_detail = cached_trip_detail(trip_id, last_modified)
+
+    if not trip_detail:
+        return jsonify(error='The trip does not exist.'), 404
+
+    response = jsonify(trip=trip_detail, stops=stops_detail)
+    return add_validators(response, etag, last_modified)
+
+
+#
+# user functionality
+#
+@BP.route('/user/register/', methods=['POST', 'GET'])
+def user_new():
+    """ This creates a new user in the database. """
+    # if the user is already logged in then redirect them
+    if check_user_permission():
+        return redirect(url_for('.show_trips'))
+
+    form = RegistrationForm()
+    # check input validation
+    if form.validate_on_submit():
+        try:
+            # create new entry if validation is successful
+            new_user = {
+                'username': form.username.data.strip().lower(),
+                'name': form.name.data.strip().title(),
+                'display_name': form.display_name.data.strip(),
+                'email': form.email.data.strip().lower(),
+                'password': ''
+            }
+            STORES.users.insert(new_user)
+
+            flash('A new account has been successfully created - you '
+                  'can now login.')
+            return redirect(url_for('.show_trips'))
+
+        except Exception:
+            flash('There was a problem creating this user account - please '
+                  'try again later.')
+    else:
+        return render_template('user_register.html', form=form)
+
+
+# login
+@BP.route('/user/login/', methods=['POST', 'GET'])
+def user_login():
+    """
+    This enables a user to login, allowing them to perform CRUD
+    operations on their own trips and/or stops.
+    """
+    if check_user_permission():
+        # if user already logged in then redirect away from login page
+        return redirect(url_for('.show_trips'))
+
+    form = LoginForm()
+    # check input validation
+    if form.validate_on_submit():
+        # check that the username exists in the database
+        user = STORES.users.find_by_username(
+            form.username.data.strip().lower())
+
+        if user:
+            flash('You are now logged in to your account.')
+            # save mongodb user _id as session to indicate logged in
+            # convert ObjectId to string
+            session['USERNAME'] = str(user['_id'])
+            session['DISPLAY_NAME'] = str(user['display_name'])
+
+            # return user to 'My Trips' page
+            return redirect(url_for('.show_trips', show='user'))
+        else:
+            flash('No user exists with this username - please try again.')
+            return redirect(url_for('.user_login'))
+    # if no form submitted, show login page
+    return render_template('user_login.html', form=form)
+
+
+# logout
+@BP.route('/user/logout/')
+def user_logout():
+    """ This logs a user out and removes session variables. """
+    # if user is not logged in then redirect them
+    if not check_user_permission():
+        return redirect(url_for('.show_trips'))
+
+    # if user is logged in, then remove session variables
+    session.pop('USERNAME', None)
+    session.pop('DISPLAY_NAME', None)
+
+    flash('You have been logged out.')
+    return redirect(url_for('.show_trips'))
+
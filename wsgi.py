@@ -0,0 +1,57 @@
+""" This is the entry point used to serve the app in production, with a
+preforking WSGI server (see gunicorn.conf.py):
+
+    gunicorn -c gunicorn.conf.py wsgi:APP
+
+Each worker process imports this module once it has been forked, so its
+app, MongoDB client and query thread pool are its own. The dev server started
+by running app.py directly is only meant for local use. """
+from app import create_app
+from util import MONGO, last_change
+from listing import load_trips
+from autocomplete import SUGGESTIONS
+from metrics import remove_snapshot, start_writer
+import parallel
+
+APP = create_app()
+
+
+def warm_up():
+    """
+    Gets a worker ready before it accepts requests, so the first requests it
+    handles are not slower than the rest - connects to MongoDB, compiles every
+    template and runs the first page of the public trips listing (the page
+    most visitors land on) so it is in the query cache, builds the stop
+    form suggestions and starts writing the worker's metrics to METRICS_DIR.
+    """
+    with APP.app_context():
+        # the client is created on first use - ping makes it select a server
+        # and open a connection now (the in-memory stores do not use it)
+        if APP.config['STORAGE'] == 'mongo':
+            MONGO.db.command('ping')
+
+        for template in APP.jinja_env.list_templates():
+            APP.jinja_env.get_template(template)
+
+        # same arguments as show_trips uses for a visitor who is not logged in
+        load_trips('', 'all', False, False,
+                   version=last_change()['version'])
+
+        SUGGESTIONS.build()
+
+    if APP.config['METRICS_DIR']:
+        start_writer(APP.config['METRICS_DIR'])
+
+
+def shut_down():
+    """ Lets any queries still running on the thread pool finish and then
+    closes the connections to MongoDB and removes the worker's metrics from
+    METRICS_DIR. This runs once the server has stopped sending the worker
+    requests. """
+    parallel.shutdown(APP)
+
+    if APP.config['METRICS_DIR']:
+        remove_snapshot(APP.config['METRICS_DIR'])
+
+    with APP.app_context():
+        MONGO.close()